@@ -0,0 +1,73 @@
+'''Measures the memory used by the in-process certificate index.
+
+Loads synthetic certificates into a CertificateIndex, and for comparison
+into a dictionary of the parsed certificate JSON, each in a fresh process,
+and reports the growth in peak memory.
+
+Usage:
+    python benchmarks/certificate_index_memory.py [number_of_certificates]
+'''
+
+import json
+import multiprocessing
+import resource
+import sys
+
+from ckanext.certificates.certificate_index import CertificateIndex
+
+LEVELS = ['raw', 'pilot', 'standard', 'exemplar']
+TYPES = ['self certified', 'community certified', 'automatically awarded']
+
+
+def certificates(number):
+    for i in xrange(number):
+        yield ('%08d-0000-0000-0000-000000000000' % i, json.dumps({
+            'level': LEVELS[i % len(LEVELS)],
+            'certification_type': TYPES[i % len(TYPES)],
+            'source': 'Self-Certified by Publisher %d (unverified)' % (i % 200),
+            'badge_url': 'https://certificates.theodi.org/en/datasets/%d/'
+                         'certificate/badge.png' % i,
+            'certificate_url': 'https://certificates.theodi.org/en/datasets/'
+                               '%d/certificate' % i,
+            'created_at': '2014-01-01T00:00:00Z',
+            'jurisdiction': 'GB',
+            'status': 'published',
+            'title': 'Dataset number %d' % i,
+            'cert_title': 'Pilot Level Certificate',
+        }))
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run(mode, number, results):
+    # Generate the rows first, so that only the index itself is measured
+    rows = list(certificates(number))
+    baseline = max_rss_mb()
+    if mode == 'index':
+        index = CertificateIndex(ttl=None)
+        index.load(rows)
+        assert len(index) == number
+    else:
+        parsed = dict((package_id, json.loads(certificate_json))
+                      for package_id, certificate_json in rows)
+        assert len(parsed) == number
+    results.put((mode, max_rss_mb() - baseline))
+
+
+def main(number):
+    print 'Loading %d certificates' % number
+    results = multiprocessing.Queue()
+    for mode in ('index', 'parsed JSON'):
+        process = multiprocessing.Process(target=run,
+                                          args=(mode, number, results))
+        process.start()
+        process.join()
+        mode, mb = results.get()
+        print '%-12s +%6.1f MB  %4d bytes/certificate' % (
+            mode, mb, mb * 1024 * 1024 / number)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
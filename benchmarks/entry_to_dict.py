@@ -0,0 +1,73 @@
+'''Micro-benchmark of converting feed entries to dictionaries.
+
+Compares the original regex and xpath based entry_to_dict with the current
+one, producing both plain dicts and compact CertificateEntry records.
+
+Usage:
+    python benchmarks/entry_to_dict.py [number_of_entries]
+'''
+
+import re
+import sys
+import time
+
+from ckanext.certificates import client
+from feed_parsing_memory import feed_chunks
+
+Q_NAME = re.compile("{(?P<ns>.*)}(?P<element>.*)")
+
+
+def legacy_entry_to_dict(entry):
+    '''entry_to_dict as it was before the tag cache.'''
+    d = {}
+    for node in entry.xpath('*'):
+        match = Q_NAME.search(node.tag)
+        name = match.groupdict().get("element") if match else node.tag
+        if name == 'link':
+            rel = node.get('rel')
+            href = node.get('href')
+            if rel == 'http://schema.theodi.org/certificate#badge':
+                types = {
+                    'text/html': 'badge_html',
+                    'application/javascript': 'badge_json',
+                }
+                d[types[node.get('type')]] = href
+            elif rel:
+                d[rel] = href
+            else:
+                d[name] = href
+        else:
+            d[name] = node.text
+    return d
+
+
+def main(number_of_entries):
+    entries = client.parse_feed_page(
+        ''.join(feed_chunks(number_of_entries)), {})
+    converters = [
+        ('legacy', legacy_entry_to_dict),
+        ('dict', client.entry_to_dict),
+        ('compact', lambda entry: client.entry_to_dict(
+            entry, client.CertificateEntry)),
+    ]
+    assert len(set(repr(sorted(dict(convert(entries[0]).items()).items()))
+                   for name, convert in converters)) == 1
+    print 'Converting %d entries' % number_of_entries
+    for name, convert in converters:
+        best = None
+        for repeat in range(3):
+            started = time.time()
+            for entry in entries:
+                convert(entry)
+            elapsed = time.time() - started
+            best = elapsed if best is None else min(best, elapsed)
+        record = convert(entries[0])
+        size = sys.getsizeof(record)
+        if isinstance(record, client.CertificateEntry) and record._extra:
+            size += sys.getsizeof(record._extra)
+        print '%-8s %6.2f us/entry  %4d bytes/record' % (
+            name, best * 1e6 / number_of_entries, size)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
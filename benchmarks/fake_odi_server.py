@@ -0,0 +1,209 @@
+'''A local stand-in for certificates.theodi.org, for benchmarks.
+
+Serves a paginated Atom feed of synthetic certificates at /datasets.feed,
+and the JSON of each certificate at /datasets/<n>/certificates/<n>.json.
+Every response can be delayed, and a proportion of them can fail with a
+503, to see how the client copes with a slow or flaky server. The server
+runs in its own process, so it doesn't add to the memory or CPU use of the
+client being measured, and counts the requests it serves.
+
+Usage:
+    python benchmarks/fake_odi_server.py [--entries N] [--per-page N]
+        [--latency SECONDS] [--error-rate FRACTION] [--badge-size BYTES]
+        [--port PORT]
+'''
+
+import BaseHTTPServer
+import SocketServer
+import json
+import multiprocessing
+import optparse
+import random
+import time
+import urlparse
+
+SITE_URL = 'http://data.gov.uk'
+
+HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Open Data Certificates</title>
+%(links)s
+'''
+LINK = '  <link rel="%s" href="%s"/>\n'
+ENTRY = '''  <entry>
+    <title>Dataset number %(i)d</title>
+    <id>%(url)sdatasets/%(i)d</id>
+    <updated>2014-01-01T00:00:00Z</updated>
+    <content>Pilot Level Certificate</content>
+    <link rel="about" href="''' + SITE_URL + '''/dataset/dataset-%(i)d"/>
+    <link rel="alternate" href="%(url)sdatasets/%(i)d/certificates/%(i)d.json"/>
+    <link rel="http://schema.theodi.org/certificate#badge" type="text/html" href="%(url)sdatasets/%(i)d/certificates/%(i)d/badge.html"/>
+    <link rel="http://schema.theodi.org/certificate#badge" type="application/javascript" href="%(url)sdatasets/%(i)d/certificates/%(i)d/badge.js"/>
+  </entry>
+'''
+FOOTER = '</feed>\n'
+
+
+def feed_page(url, page, entries, per_page):
+    '''Returns the Atom for a page of the feed of the given size.'''
+    pages = max((entries + per_page - 1) // per_page, 1)
+    feed = url + 'datasets.feed'
+    links = [('self', page), ('last', pages)]
+    if page < pages:
+        links.append(('next', page + 1))
+    start = (page - 1) * per_page
+    return ''.join(
+        [HEADER % {'links': ''.join(LINK % (rel, '%s?page=%d' % (feed, n))
+                                    for rel, n in links)}] +
+        [ENTRY % {'i': i, 'url': url}
+         for i in xrange(start, min(start + per_page, entries))] +
+        [FOOTER])
+
+
+def badge_json(url, i, badge_size=0):
+    '''Returns the JSON for certificate number i, padded to make it about
+    badge_size bytes long.'''
+    certificate = {
+        'level': 'pilot',
+        'created_at': '2014-01-01T00:00:00Z',
+        'jurisdiction': 'GB',
+        'status': 'published',
+        'uri': '%sdatasets/%d/certificates/%d' % (url, i, i),
+        'certification_type': 'self certified',
+        'dataset': {'title': 'Dataset number %d' % i,
+                    'publisher': 'A publisher'},
+        'badges': {'image/png': '%sdatasets/%d/certificates/%d/badge.png'
+                   % (url, i, i)},
+    }
+    content = json.dumps({'certificate': certificate})
+    if badge_size > len(content):
+        certificate['padding'] = 'x' * (badge_size - len(content))
+        content = json.dumps({'certificate': certificate})
+    return content
+
+
+class FakeODIRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one go, rather than a packet per header, which
+    # would be held up by delayed ACKs on a kept-alive connection
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        with server.requests.get_lock():
+            server.requests.value += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and random.random() < server.error_rate:
+            return self.respond(503, 'Service unavailable')
+
+        path, _, query = self.path.partition('?')
+        if path == '/datasets.feed':
+            page = int(urlparse.parse_qs(query).get('page', ['1'])[0])
+            self.respond(200, feed_page(server.url, page, server.entries,
+                                        server.per_page),
+                         'application/atom+xml')
+        elif path.startswith('/datasets/') and path.endswith('.json'):
+            i = int(path.split('/')[2])
+            self.respond(200, badge_json(server.url, i, server.badge_size),
+                         'application/json')
+        else:
+            self.respond(404, 'Not found')
+
+    def respond(self, status, body, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeODIServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class FakeODI(object):
+    '''Runs a FakeODIServer in a separate process.
+
+    entries - the number of certificates in the feed
+    per_page - the number of entries on each page of the feed
+    latency - seconds to wait before each response
+    error_rate - the fraction of requests to fail with a 503
+    badge_size - pad each certificate's JSON to about this many bytes
+    '''
+
+    def __init__(self, entries=1000, per_page=100, latency=0, error_rate=0,
+                 badge_size=0, port=0):
+        self.options = dict(entries=entries, per_page=per_page,
+                            latency=latency, error_rate=error_rate,
+                            badge_size=badge_size)
+        self.port = port
+        self.requests = multiprocessing.Value('i', 0)
+        self.process = None
+        self.url = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        ready = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=self._serve,
+                                               args=(ready,))
+        self.process.daemon = True
+        self.process.start()
+        self.url = ready.get()
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    @property
+    def feed_url(self):
+        return self.url + 'datasets.feed'
+
+    def request_count(self):
+        return self.requests.value
+
+    def _serve(self, ready):
+        server = FakeODIServer(('127.0.0.1', self.port),
+                               FakeODIRequestHandler)
+        server.url = 'http://127.0.0.1:%d/' % server.server_port
+        server.requests = self.requests
+        for name, value in self.options.items():
+            setattr(server, name, value)
+        ready.put(server.url)
+        server.serve_forever()
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.split('Usage:')[1])
+    parser.add_option('--entries', type='int', default=1000)
+    parser.add_option('--per-page', type='int', default=100)
+    parser.add_option('--latency', type='float', default=0)
+    parser.add_option('--error-rate', type='float', default=0)
+    parser.add_option('--badge-size', type='int', default=0)
+    parser.add_option('--port', type='int', default=8000)
+    options, args = parser.parse_args()
+    fake = FakeODI(options.entries, options.per_page, options.latency,
+                   options.error_rate, options.badge_size, options.port)
+    with fake:
+        print 'Serving %s' % fake.feed_url
+        try:
+            fake.process.join()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+'''Compares peak memory of whole-page and streaming parsing of the feed.
+
+Builds a synthetic Atom feed page with many entries, and parses it in a
+fresh process for each mode, converting every entry with entry_to_dict as
+generate_entries does. The page is produced in chunks, as it would arrive
+from the network. The whole-page mode joins the chunks together, as
+requests does for response.content.
+
+Usage:
+    python benchmarks/feed_parsing_memory.py [number_of_entries]
+'''
+
+import multiprocessing
+import resource
+import sys
+import time
+
+from ckanext.certificates import client
+
+DEFAULT_ENTRIES = 50000
+
+HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Open Data Certificates</title>
+  <link rel="self" href="https://certificates.theodi.org/datasets.feed?page=1"/>
+  <link rel="last" href="https://certificates.theodi.org/datasets.feed?page=1"/>
+'''
+ENTRY = '''  <entry>
+    <title>Dataset number %(i)d</title>
+    <id>https://certificates.theodi.org/datasets/%(i)d</id>
+    <updated>2014-01-01T00:00:00Z</updated>
+    <content>Pilot Level Certificate</content>
+    <link rel="about" href="http://data.gov.uk/dataset/dataset-%(i)d"/>
+    <link rel="alternate" href="https://certificates.theodi.org/datasets/%(i)d/certificates/%(i)d.json"/>
+    <link rel="http://schema.theodi.org/certificate#badge" type="text/html" href="https://certificates.theodi.org/datasets/%(i)d/certificates/%(i)d/badge.html"/>
+    <link rel="http://schema.theodi.org/certificate#badge" type="application/javascript" href="https://certificates.theodi.org/datasets/%(i)d/certificates/%(i)d/badge.js"/>
+  </entry>
+'''
+FOOTER = '</feed>\n'
+
+
+def feed_chunks(entries, entries_per_chunk=100):
+    yield HEADER
+    for start in xrange(0, entries, entries_per_chunk):
+        yield ''.join(ENTRY % {'i': i} for i in
+                      xrange(start, min(start + entries_per_chunk, entries)))
+    yield FOOTER
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run(mode, entries, results):
+    baseline = max_rss_mb()
+    started = time.time()
+    links = {}
+    if mode == 'whole page':
+        parsed = client.parse_feed_page(''.join(feed_chunks(entries)), links)
+    else:
+        parsed = client.iterparse_feed_page(feed_chunks(entries), links)
+    count = 0
+    for entry in parsed:
+        client.entry_to_dict(entry)
+        count += 1
+    assert count == entries and links['self'] == links['last']
+    results.put((mode, time.time() - started, max_rss_mb() - baseline))
+
+
+def main(entries):
+    print 'Parsing a feed page of %d entries' % entries
+    results = multiprocessing.Queue()
+    for mode in ('whole page', 'streaming'):
+        process = multiprocessing.Process(target=run,
+                                          args=(mode, entries, results))
+        process.start()
+        process.join()
+        mode, seconds, peak_mb = results.get()
+        print '%-12s %6.2fs  peak memory +%.1f MB' % (mode, seconds, peak_mb)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ENTRIES)
@@ -0,0 +1,212 @@
+'''Measures the throughput of each stage of fetching certificates.
+
+Starts a fake certificates.theodi.org (see fake_odi_server.py) and runs
+each stage against it in a fresh process, reporting the entries or badges
+handled per second, the increase in peak memory, and the number of
+requests the server saw:
+
+  generate_entries        walking every page of the feed
+  entry_to_dict           converting the entries of pages already parsed
+  get_badge_data          fetching badges one at a time
+  BadgeFetcher            fetching badges with a pool of threads
+  AsyncClient             fetching badges on greenlets (needs gevent)
+  CertificateFetcher      the whole of fetch_certs, with an in-memory
+                          SQLite table standing in for the CKAN model
+
+Usage:
+    python benchmarks/fetch_pipeline.py [--entries N] [--per-page N]
+        [--latency SECONDS] [--error-rate FRACTION] [--badge-size BYTES]
+        [--badges N] [--workers N]
+'''
+
+import multiprocessing
+import optparse
+import sqlite3
+import time
+
+from ckanext.certificates import client
+from fake_odi_server import FakeODI, SITE_URL
+from feed_parsing_memory import max_rss_mb
+
+
+def stage_generate_entries(fake, options):
+    return sum(1 for entry in client.generate_entries(url=fake.feed_url))
+
+
+def stage_entry_to_dict(fake, options):
+    pages = []
+    url = fake.feed_url
+    while url:
+        links = {}
+        pages.append(client.parse_feed_page(client.http_get(url).content,
+                                            links))
+        url = client._next_page_url(links)
+    return lambda: sum(1 for entries in pages for entry in entries
+                       if client.entry_to_dict(entry))
+
+
+def _badge_urls(fake, options):
+    urls = []
+    for entry in client.generate_entries(url=fake.feed_url):
+        urls.append(entry['alternate'])
+        if len(urls) >= options.badges:
+            break
+    return urls
+
+
+def stage_get_badge_data(fake, options):
+    urls = _badge_urls(fake, options)
+    return lambda: sum(1 for url in urls if client.get_badge_data(url))
+
+
+def stage_badge_fetcher(fake, options):
+    urls = _badge_urls(fake, options)
+
+    def run():
+        fetcher = client.BadgeFetcher(options.workers)
+        try:
+            return sum(1 for badge in fetcher.fetch(urls) if badge)
+        finally:
+            fetcher.close()
+    return run
+
+
+def stage_async_client(fake, options):
+    from ckanext.certificates.async_client import AsyncClient
+    urls = _badge_urls(fake, options)
+
+    def run():
+        async_client = AsyncClient(options.workers * 10)
+        try:
+            return sum(1 for badge in async_client.fetch_badges(urls)
+                       if badge)
+        finally:
+            async_client.close()
+    return run
+
+
+class _Package(object):
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+def stage_certificate_fetcher(fake, options):
+    from ckanext.certificates.fetcher import CertificateFetcher, \
+        CertificateWriter
+    from ckanext.certificates.site_url import SiteUrlMatcher
+
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE package (id TEXT PRIMARY KEY, name TEXT UNIQUE, '
+               'certificate TEXT)')
+    db.executemany('INSERT INTO package VALUES (?, ?, NULL)',
+                   (('id-%d' % i, 'dataset-%d' % i)
+                    for i in xrange(options.entries)))
+    db.commit()
+
+    class StubFetcher(CertificateFetcher):
+        @classmethod
+        def _get_packages_from_urls(cls, urls, names=None,
+                                    storage='extras'):
+            names = dict((names[url], url) for url in urls)
+            rows = db.execute(
+                'SELECT id, name, certificate FROM package WHERE name IN '
+                '(%s)' % ','.join('?' * len(names)), names.keys())
+            return dict((names[name], (_Package(id, name), certificate))
+                        for id, name, certificate in rows)
+
+    class StubWriter(CertificateWriter):
+        def flush(self):
+            pending = self._pending.values()
+            self._pending.clear()
+            db.executemany('UPDATE package SET certificate = ? WHERE id = ?',
+                           ((badge_json, pkg.id)
+                            for pkg, badge_json, operation, description
+                            in pending))
+            db.commit()
+            for pkg, badge_json, operation, description in pending:
+                self.stats.add('Certificate %s' % operation, description)
+
+    site_url_filter = SiteUrlMatcher([SITE_URL])
+
+    def run():
+        stats = StubFetcher.fetch(site_url_filter, None,
+                                  badge_workers=options.workers,
+                                  writer=StubWriter(batch_size=100),
+                                  feed_url=fake.feed_url, report=False)
+        return stats.count('Certificate added')
+    return run
+
+
+STAGES = [
+    ('generate_entries', stage_generate_entries),
+    ('entry_to_dict', stage_entry_to_dict),
+    ('get_badge_data', stage_get_badge_data),
+    ('BadgeFetcher', stage_badge_fetcher),
+    ('AsyncClient', stage_async_client),
+    ('CertificateFetcher', stage_certificate_fetcher),
+]
+
+
+def run(stage, fake, options, results):
+    '''Runs a stage in this process, and puts its results on the queue.
+    A stage either does its work and returns the number of items, or
+    prepares and returns a function that does so, so that only the work
+    itself is timed. If the stage fails, the error is put on the queue
+    instead, so that the benchmark carries on with the next stage.'''
+    try:
+        baseline = max_rss_mb()
+        requests_before = fake.request_count()
+        started = time.time()
+        items = stage(fake, options)
+        if callable(items):
+            baseline = max_rss_mb()
+            requests_before = fake.request_count()
+            started = time.time()
+            items = items()
+        seconds = time.time() - started
+        results.put((items, seconds, max_rss_mb() - baseline,
+                     fake.request_count() - requests_before))
+    except ImportError, e:
+        results.put('skipped (%s)' % e)
+    except Exception, e:
+        results.put('failed (%s: %s)' % (type(e).__name__, e))
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.split('Usage:')[1])
+    parser.add_option('--entries', type='int', default=2000)
+    parser.add_option('--per-page', type='int', default=100)
+    parser.add_option('--latency', type='float', default=0.005)
+    parser.add_option('--error-rate', type='float', default=0)
+    parser.add_option('--badge-size', type='int', default=0)
+    parser.add_option('--badges', type='int', default=500,
+                      help='number of badges to fetch in the badge stages')
+    parser.add_option('--workers', type='int', default=8)
+    options, args = parser.parse_args()
+
+    print 'Feed of %d entries, %d per page, %.0fms latency, %.0f%% errors' % (
+        options.entries, options.per_page, options.latency * 1000,
+        options.error_rate * 100)
+    print '%-20s %8s %8s %10s %10s %9s' % (
+        'stage', 'items', 'seconds', 'items/sec', 'peak MB', 'requests')
+    with FakeODI(options.entries, options.per_page, options.latency,
+                 options.error_rate, options.badge_size) as fake:
+        results = multiprocessing.Queue()
+        for name, stage in STAGES:
+            process = multiprocessing.Process(
+                target=run, args=(stage, fake, options, results))
+            process.start()
+            result = results.get()
+            process.join()
+            if isinstance(result, basestring):
+                print '%-20s %s' % (name, result)
+                continue
+            items, seconds, peak_mb, requests = result
+            print '%-20s %8d %8.2f %10.0f %+10.1f %9d' % (
+                name, items, seconds, items / max(seconds, 1e-9), peak_mb,
+                requests)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+'''Compares the site URL regex with the SiteUrlMatcher.
+
+Times deciding whether each of a mix of 'about' URLs is a dataset on the
+site and finding its package name, as fetch does for every feed entry: with
+the regular expression built from the site URL, the '/dataset/' check and
+urlparse; and with a SiteUrlMatcher. It also times the matcher with a
+number of extra sites configured, e.g. mirrors and old domains.
+
+Usage:
+    python benchmarks/site_url_matching.py [number_of_urls]
+'''
+
+import re
+import sys
+import time
+import urlparse
+
+from ckanext.certificates.site_url import SiteUrlMatcher
+
+DEFAULT_URLS = 200000
+SITE_URL = 'http://data.gov.uk'
+
+
+def regex_filter(site_url):
+    '''The regular expression fetch used to build from the site URL.'''
+    site_url_regex = '^' + re.escape(site_url) + '.*'
+    site_url_regex = re.sub(r'https?\\:', r'https?\:', site_url_regex)
+    site_url_regex = re.sub(r'\\/\\/(www\\\.)?', r'\/\/(www.)?',
+                            site_url_regex)
+    return re.compile(site_url_regex)
+
+
+def regex_match(site_url_filter, url):
+    if not site_url_filter.search(url):
+        return None
+    if '/dataset/' not in url:
+        return ''
+    return urlparse.urlparse(url).path.rstrip('/').split('/')[-1]
+
+
+def urls(count):
+    templates = ['http://data.gov.uk/dataset/dataset-%d',
+                 'https://www.data.gov.uk/dataset/dataset-%d/',
+                 'http://data.gov.uk/publisher/publisher-%d',
+                 'http://opendata.example.com/dataset/dataset-%d']
+    return [templates[i % len(templates)] % i for i in xrange(count)]
+
+
+def timed(name, match, urls):
+    started = time.time()
+    matched = sum(1 for url in urls if match(url))
+    seconds = time.time() - started
+    print '%-32s %6.3fs %9.0f URLs/sec  %d datasets' % (
+        name, seconds, len(urls) / seconds, matched)
+    return matched
+
+
+def main(count):
+    print 'Matching %d URLs' % count
+    about_urls = urls(count)
+    site_url_filter = regex_filter(SITE_URL)
+    matcher = SiteUrlMatcher([SITE_URL])
+    mirrors = SiteUrlMatcher([SITE_URL] + [
+        'https://mirror%d.example.org/catalogue' % i for i in range(50)])
+    expected = timed('regex + urlparse',
+                     lambda url: regex_match(site_url_filter, url),
+                     about_urls)
+    assert expected == timed('SiteUrlMatcher', matcher.match, about_urls)
+    assert expected == timed('SiteUrlMatcher, 51 sites', mirrors.match,
+                             about_urls)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_URLS)
@@ -0,0 +1,235 @@
+"""
+A cooperative variant of the client, for fetching from many connections at
+once without a thread for each.
+
+Requests are made on gevent greenlets, all on the calling thread, so
+thousands of them can be in flight with little memory. The standard library
+is not monkey-patched: the connections are opened with gevent's sockets,
+and only this module's requests yield to one another.
+
+The entries and badges it returns are the same as those of the client
+module's generate_entries and get_badge_data.
+
+Needs gevent, e.g. ``pip install ckanext-certificates[async]``.
+"""
+import collections
+import httplib
+import socket
+import urlparse
+
+import gevent
+import gevent.pool
+from gevent import socket as gsocket
+from gevent import ssl as gssl
+from gevent.lock import BoundedSemaphore
+
+import ckanext.certificates.client as client
+from ckanext.certificates import instrumentation
+
+log = __import__('logging').getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 100
+
+Response = collections.namedtuple('Response',
+                                  'url status_code headers content')
+
+
+class _HTTPConnection(httplib.HTTPConnection):
+    connect_timeout = None
+
+    def connect(self):
+        self.sock = gsocket.create_connection((self.host, self.port),
+                                              self.connect_timeout)
+        self.sock.settimeout(self.timeout)
+
+
+class _HTTPSConnection(_HTTPConnection):
+    default_port = httplib.HTTPS_PORT
+    ssl_context = None
+
+    def connect(self):
+        _HTTPConnection.connect(self)
+        self.sock = self.ssl_context.wrap_socket(self.sock,
+                                                 server_hostname=self.host)
+
+
+class AsyncClient(object):
+    """
+    Makes GET requests on greenlets, keeping connections alive between
+    them. No more than concurrency requests are in flight at once, nor
+    host_concurrency to any one host. Failed connections and 429/5xx
+    responses are retried with exponential backoff, honouring any
+    Retry-After header, as the shared requests session does.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY,
+                 host_concurrency=None):
+        self.concurrency = max(int(concurrency or 1), 1)
+        self.host_concurrency = int(host_concurrency or self.concurrency)
+        self.connect_timeout = client._http_option('connect_timeout')
+        self.read_timeout = client._http_option('read_timeout')
+        self.retries = client._http_option('retries')
+        self.backoff_factor = client._http_option('backoff_factor')
+        self.stats = {'opened': 0, 'reused': 0}
+        self._pool = gevent.pool.Pool(self.concurrency)
+        self._idle = collections.defaultdict(list)
+        self._host_semaphores = {}
+        self._ssl_context = None
+
+    def get(self, url, headers=None):
+        """
+        GETs the url and returns a Response, whose headers have lower case
+        names. Errors that are still failing after retrying are raised; a
+        429/5xx response is returned once the retries are used up.
+        """
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        with self._host_semaphore(parts.hostname):
+            attempt = 0
+            while True:
+                attempt += 1
+                conn = self._connection(key)
+                try:
+                    conn.request('GET', path, headers=headers or {})
+                    response = conn.getresponse()
+                    content = response.read()
+                except (socket.error, httplib.HTTPException):
+                    conn.close()
+                    if attempt > self.retries:
+                        raise
+                    self._backoff(attempt)
+                    continue
+                if response.will_close:
+                    conn.close()
+                else:
+                    self._idle[key].append(conn)
+                response_headers = dict(response.getheaders())
+                if response.status in client.RETRY_STATUSES and \
+                        attempt <= self.retries:
+                    self._backoff(attempt, response_headers.get('retry-after'))
+                    continue
+                return Response(url, response.status, response_headers,
+                                content)
+
+    def iter_entries(self, url=None, since=None, compact=False, on_page=None,
+                     max_pages=None):
+        """
+        Yields the entries of the feed, as client.generate_entries does.
+        Each page is requested on its own greenlet as soon as the previous
+        one has been parsed, so it downloads while that page's entries are
+        being processed. Errors are logged and end the feed.
+        """
+        factory = client.CertificateEntry if compact else dict
+        pages = 1
+        page_url = client.feed_url(url, since)
+        pending = gevent.spawn(self._get_page, page_url)
+        try:
+            while pending is not None:
+                response = pending.get()
+                if response.status_code >= 400:
+                    raise IOError('Status %s fetching %s' % (
+                        response.status_code, response.url))
+                links = {}
+                with instrumentation.timer('feed_parse'):
+                    entries = client.parse_feed_page(response.content,
+                                                     links)
+                next_url = client._next_page_url(links)
+                pending = None
+                if next_url and (max_pages is None or pages < max_pages):
+                    pages += 1
+                    pending = gevent.spawn(self._get_page, next_url)
+                for entry in entries:
+                    yield client.entry_to_dict(entry, factory)
+                if on_page:
+                    on_page(page_url, next_url)
+                page_url = next_url
+        except Exception, e:
+            log.exception(e)
+        finally:
+            if pending is not None:
+                pending.kill()
+
+    def fetch_badges(self, urls, cache=None):
+        """
+        Returns a list of the badge of each certificate url, in the same
+        order, as client.get_badge_data would: None if the request failed
+        and {} if the server returned an error.
+
+        cache - a BadgeCache to make the requests conditional on. It
+                defaults to the configured cache.
+        """
+        cache = cache if cache is not None else client.get_badge_cache()
+        return self._pool.map(lambda url: self._fetch_badge(url, cache), urls)
+
+    def fetch(self, urls):
+        """
+        Fetches the badges of a batch of urls, so the client can stand in
+        for a client.BadgeFetcher.
+        """
+        return self.fetch_badges(urls)
+
+    def close(self):
+        self._pool.kill()
+        for connections in self._idle.values():
+            for conn in connections:
+                conn.close()
+        self._idle.clear()
+
+    def _get_page(self, url):
+        instrumentation.count('feed_requests')
+        with instrumentation.timer('feed_http'):
+            response = self.get(url)
+        instrumentation.count('feed_bytes', len(response.content))
+        return response
+
+    def _fetch_badge(self, url, cache):
+        cached = cache.get(url) if cache is not None else None
+        instrumentation.count('badge_requests')
+        headers = cached.validators() if cached else None
+        while True:
+            try:
+                with instrumentation.timer('badge_http'):
+                    response = self.get(url, headers)
+            except Exception, request_err:
+                log.exception("There was a problem with the request at {0}: {1}".format(url, request_err))
+                return None
+            badge = client.badge_from_response(
+                url, response.status_code, response.headers,
+                response.content, cached, cache)
+            if badge is not None or headers == client.REFETCH_HEADERS:
+                return badge or {}
+            cached, headers = None, client.REFETCH_HEADERS
+
+    def _connection(self, key):
+        idle = self._idle[key]
+        if idle:
+            self.stats['reused'] += 1
+            return idle.pop()
+        self.stats['opened'] += 1
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = _HTTPSConnection(host, port, timeout=self.read_timeout)
+            if self._ssl_context is None:
+                self._ssl_context = gssl.create_default_context()
+            conn.ssl_context = self._ssl_context
+        else:
+            conn = _HTTPConnection(host, port, timeout=self.read_timeout)
+        conn.connect_timeout = self.connect_timeout
+        return conn
+
+    def _host_semaphore(self, host):
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = \
+                BoundedSemaphore(self.host_concurrency)
+        return self._host_semaphores[host]
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after and retry_after.isdigit():
+            delay = int(retry_after)
+        else:
+            delay = self.backoff_factor * (2 ** (attempt - 1))
+        gevent.sleep(delay)
+
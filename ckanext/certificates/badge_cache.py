@@ -0,0 +1,113 @@
+'''Persistent cache of certificate badge data, keyed by certificate URL.
+
+Each entry stores the normalized badge dictionary returned by
+client.get_badge_data along with the ETag and Last-Modified validators of
+the response it came from, so that the next fetch can be a conditional GET
+and reuse the cached badge if the certificate is unchanged (304).
+
+The cache is a small SQLite database. When it grows beyond max_entries the
+least recently used entries are evicted.
+'''
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+log = __import__('logging').getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 100000
+
+
+class CachedBadge(object):
+    __slots__ = ('etag', 'last_modified', 'badge')
+
+    def __init__(self, etag, last_modified, badge):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.badge = badge
+
+    def validators(self):
+        '''Returns the request headers for a conditional GET.'''
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class BadgeCache(object):
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS badge (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            badge TEXT NOT NULL,
+            accessed REAL NOT NULL)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS badge_accessed '
+                           'ON badge (accessed)')
+        self._size = self._conn.execute(
+            'SELECT COUNT(*) FROM badge').fetchone()[0]
+
+    def __len__(self):
+        return self._size
+
+    def get(self, url):
+        '''Returns the CachedBadge for the url, or None.'''
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT etag, last_modified, badge FROM badge WHERE url = ?',
+                (url,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute('UPDATE badge SET accessed = ? WHERE url = ?',
+                               (time.time(), url))
+        etag, last_modified, badge = row
+        return CachedBadge(etag, last_modified, json.loads(badge))
+
+    def set(self, url, etag, last_modified, badge):
+        '''
+        Stores the badge with its response validators. Without either
+        validator a conditional GET is impossible, so nothing is stored.
+        '''
+        if not (etag or last_modified):
+            return
+        with self._lock:
+            exists = self._conn.execute(
+                'SELECT 1 FROM badge WHERE url = ?', (url,)).fetchone()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO badge '
+                '(url, etag, last_modified, badge, accessed) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (url, etag, last_modified, json.dumps(badge), time.time()))
+            if not exists:
+                self._size += 1
+            if self._size > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        # Evict down to 90% so that we don't evict on every insert
+        excess = self._size - int(self.max_entries * 0.9)
+        self._conn.execute(
+            'DELETE FROM badge WHERE url IN (SELECT url FROM badge '
+            'ORDER BY accessed, rowid LIMIT ?)', (excess,))
+        self._size = self._conn.execute(
+            'SELECT COUNT(*) FROM badge').fetchone()[0]
+        log.debug('Evicted %s badges from the cache', excess)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
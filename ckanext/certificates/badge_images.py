@@ -0,0 +1,314 @@
+'''A local mirror of the certificates' badge images.
+
+Each certificate's badge_url is a PNG on certificates.theodi.org, which
+every view of a dataset page would otherwise fetch from there. With
+ckanext.certificates.badge_image_dir set, fetch_certs downloads the badge
+image of each certificate it stores, and the images are served by CKAN
+from /certificates/badge/<hash>.png with long cache headers (see
+controller.py). get_certificate_data then gives that as the badge_url.
+
+Each image is stored once, in a file named by the SHA-1 of its content, so
+the many certificates sharing a badge design share its file. A small
+SQLite database alongside records the image of each badge URL, so a badge
+is only downloaded once. The images take up at most max_bytes; when they
+would take more, those least recently downloaded are dropped, and their
+certificates fall back to the ODI's URL. "paster certificates
+mirror_badges", run now and then, downloads any stored certificates' images
+that are missing, e.g. those stored before the mirror was set up, and
+removes the images no stored certificate refers to any more.
+'''
+
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+log = __import__('logging').getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+# Larger than any badge, to keep out anything that isn't one
+MAX_IMAGE_BYTES = 1024 * 1024
+DEFAULT_URL_PREFIX = '/certificates/badge/'
+INDEX_FILENAME = 'index.db'
+IMAGE_HASH = re.compile(r'^[0-9a-f]{40}$')
+# URLs looked up per query, within SQLite's limit on parameters
+LOOKUP_BATCH_SIZE = 500
+
+
+class BadgeImageStore(object):
+    '''
+    The badge images in a directory. Images are downloaded by a pool of
+    worker threads, and stored from the thread calling mirror.
+
+    Only the directory and options are pickled, so that a store can be
+    passed to the worker processes of CertificateFetcher.fetch_sharded,
+    which each open it afresh.
+    '''
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, workers=1):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.workers = max(int(workers or 1), 1)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._conn = sqlite3.connect(
+            os.path.join(directory, INDEX_FILENAME), timeout=30,
+            check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS image (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            downloaded REAL NOT NULL)''')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS badge (
+            url TEXT PRIMARY KEY,
+            hash TEXT NOT NULL)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS badge_hash '
+                           'ON badge (hash)')
+
+    def __getstate__(self):
+        return (self.directory, self.max_bytes, self.workers)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __len__(self):
+        '''The number of images stored.'''
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM image').fetchone()[0]
+
+    def total_bytes(self):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM image').fetchone()[0]
+
+    def image_path(self, image_hash):
+        return os.path.join(self.directory, image_hash + '.png')
+
+    def lookup(self, url):
+        '''Returns the hash of the image for a badge URL, or None.'''
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT hash FROM badge WHERE url = ?', (url,)).fetchone()
+        return row[0] if row else None
+
+    def lookup_many(self, urls):
+        '''
+        Returns a dictionary of badge URL: image hash, for those of the URLs
+        that have an image.
+        '''
+        urls = list(urls)
+        hashes = {}
+        with self._lock:
+            for start in xrange(0, len(urls), LOOKUP_BATCH_SIZE):
+                batch = urls[start:start + LOOKUP_BATCH_SIZE]
+                hashes.update(self._conn.execute(
+                    'SELECT url, hash FROM badge WHERE url IN (%s)'
+                    % ','.join('?' * len(batch)), batch))
+        return hashes
+
+    def add(self, url, content):
+        '''Stores the image for a badge URL, and returns its hash.'''
+        image_hash = hashlib.sha1(content).hexdigest()
+        path = self.image_path(image_hash)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory,
+                                        prefix='.' + image_hash)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        with self._lock:
+            # The image is in the index before its file appears, so prune
+            # never takes it for an unreferenced one
+            self._conn.execute(
+                'INSERT OR REPLACE INTO image (hash, size, downloaded) '
+                'VALUES (?, ?, ?)', (image_hash, len(content), time.time()))
+            self._conn.execute(
+                'INSERT OR REPLACE INTO badge (url, hash) VALUES (?, ?)',
+                (url, image_hash))
+            os.rename(tmp_path, path)
+            self._evict()
+        return image_hash
+
+    def mirror(self, urls):
+        '''
+        Downloads and stores the images for those of the badge URLs that
+        aren't stored yet. Returns the number downloaded.
+        '''
+        with self._lock:
+            missing = [url for url in set(urls) if url and not
+                       self._conn.execute('SELECT 1 FROM badge WHERE url = ?',
+                                          (url,)).fetchone()]
+        if not missing:
+            return 0
+        if self.workers > 1 and len(missing) > 1:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            contents = self._pool.map(_download, missing)
+        else:
+            contents = [_download(url) for url in missing]
+        downloaded = 0
+        for url, content in zip(missing, contents):
+            if content is not None:
+                self.add(url, content)
+                downloaded += 1
+        return downloaded
+
+    def prune(self, badge_urls):
+        '''
+        Forgets the badge URLs that aren't among those given, i.e. those of
+        the certificates now stored, and removes the images they leave
+        unreferenced, along with any image files not in the index. Returns
+        the numbers of URLs and images removed.
+        '''
+        badge_urls = set(badge_urls)
+        # Files are listed before the index is read: add indexes an image
+        # before its file appears, so any file listed that is being added
+        # is found in the index
+        filenames = os.listdir(self.directory)
+        with self._lock:
+            stale = [url for url, in self._conn.execute(
+                'SELECT url FROM badge') if url not in badge_urls]
+            self._conn.executemany('DELETE FROM badge WHERE url = ?',
+                                   ((url,) for url in stale))
+            self._conn.execute(
+                'DELETE FROM image WHERE hash NOT IN '
+                '(SELECT hash FROM badge)')
+            images = set(image_hash for image_hash, in self._conn.execute(
+                'SELECT hash FROM image'))
+        removed = 0
+        for filename in filenames:
+            image_hash, ext = os.path.splitext(filename)
+            if ext == '.png' and image_hash not in images:
+                _remove(os.path.join(self.directory, filename))
+                removed += 1
+        log.info('Pruned %s badge URLs and %s images', len(stale), removed)
+        return len(stale), removed
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        with self._lock:
+            self._conn.close()
+
+    def _evict(self):
+        total = self._conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM image').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Evict down to 90% so that we don't evict on every download
+        target = int(self.max_bytes * 0.9)
+        evicted = []
+        for image_hash, size in self._conn.execute(
+                'SELECT hash, size FROM image ORDER BY downloaded, rowid') \
+                .fetchall():
+            if total <= target:
+                break
+            evicted.append(image_hash)
+            total -= size
+        for image_hash in evicted:
+            self._conn.execute('DELETE FROM image WHERE hash = ?',
+                               (image_hash,))
+            self._conn.execute('DELETE FROM badge WHERE hash = ?',
+                               (image_hash,))
+            _remove(self.image_path(image_hash))
+        log.debug('Evicted %s badge images', len(evicted))
+
+
+def _download(url):
+    '''Returns the PNG at the url, or None if it can't be downloaded.'''
+    from ckanext.certificates.client import http_get
+    try:
+        response = http_get(url)
+    except Exception, e:
+        log.warning('Unable to download badge image %s: %s', url, e)
+        return None
+    content_type = response.headers.get('Content-Type', '')
+    if response.status_code != 200 or \
+            not content_type.startswith('image/png'):
+        log.warning('Unable to download badge image %s: %s %s', url,
+                    response.status_code, content_type)
+        return None
+    if len(response.content) > MAX_IMAGE_BYTES:
+        log.warning('Badge image too large: %s', url)
+        return None
+    return response.content
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def open_badge_image_store(config, workers=1):
+    '''
+    Returns a BadgeImageStore for the directory configured by
+    ckanext.certificates.badge_image_dir, or None if there isn't one.
+    '''
+    directory = config.get('ckanext.certificates.badge_image_dir')
+    if not directory:
+        return None
+    return BadgeImageStore(directory, int(config.get(
+        'ckanext.certificates.badge_image_max_bytes', DEFAULT_MAX_BYTES)),
+        workers)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_badge_image_store(config=None):
+    '''
+    Returns this process's BadgeImageStore, as open_badge_image_store.
+    '''
+    global _store
+    if _store is None:
+        if config is None:
+            from pylons import config
+        if not config.get('ckanext.certificates.badge_image_dir'):
+            return None
+        with _store_lock:
+            if _store is None:
+                _store = open_badge_image_store(config)
+    return _store
+
+
+def local_badge_url(badge_url, config=None):
+    '''
+    Returns the URL of the local copy of the badge image, or badge_url if
+    there isn't one, or its file is missing.
+    '''
+    return local_badge_urls([badge_url], config).get(badge_url, badge_url)
+
+
+def local_badge_urls(badge_urls, config=None):
+    '''
+    Returns a dictionary of badge URL: URL of the local copy of its image,
+    for those of the badge URLs that have one, looked up in one query.
+    '''
+    store = get_badge_image_store(config)
+    badge_urls = set(url for url in badge_urls if url)
+    if store is None or not badge_urls:
+        return {}
+    if config is None:
+        from pylons import config
+    prefix = config.get('ckanext.certificates.badge_image_url',
+                        DEFAULT_URL_PREFIX)
+    hashes = store.lookup_many(badge_urls)
+    # The files may have been evicted or removed since. There are few
+    # distinct images, so each is only checked once.
+    present = dict((image_hash,
+                    os.path.exists(store.image_path(image_hash)))
+                   for image_hash in set(hashes.itervalues()))
+    return dict((url, '%s%s.png' % (prefix, image_hash))
+                for url, image_hash in hashes.iteritems()
+                if present[image_hash])
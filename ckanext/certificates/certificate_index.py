@@ -0,0 +1,212 @@
+'''A process-wide index of package id to a summary of its certificate.
+
+The summaries hold just what is needed to show a badge, in __slots__
+records, with the few distinct level, type and source strings shared
+between them. This keeps the index small enough to hold every certificate,
+so that helpers can answer without loading packages or parsing JSON.
+
+The index is built lazily, on first use, from the odi-certificate extras,
+or the certificate table if that is where they are stored (see model.py).
+It is kept up to date by CertificatesPlugin.notify, when packages change in
+this process, and by the CertificateWriter when fetch_certs writes
+certificates. Changes made by other processes are picked up when the index
+is rebuilt, every ckanext.certificates.index_ttl seconds (default 600).
+Only the first build holds up the request that asks for it. Rebuilds run
+in a background thread, while requests carry on with the old summaries
+until the new ones replace them, and changes recorded meanwhile are
+applied to the new ones too.
+'''
+
+import json
+import threading
+import time
+
+log = __import__('logging').getLogger(__name__)
+
+DEFAULT_TTL = 600
+
+
+class CertificateSummary(object):
+    __slots__ = ('level', 'certification_type', 'source', 'badge_url',
+                 'certificate_url')
+
+    def __init__(self, level, certification_type, source, badge_url,
+                 certificate_url):
+        self.level = level
+        self.certification_type = certification_type
+        self.source = source
+        self.badge_url = badge_url
+        self.certificate_url = certificate_url
+
+    def as_dict(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__)
+
+
+class CertificateIndex(object):
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self._summaries = None
+        self._built_at = None
+        # shared copies of the small set of repeated strings
+        self._strings = {}
+        self._lock = threading.Lock()
+        # held while the index is built
+        self._build_lock = threading.Lock()
+        # [(package id, summary or None)] of the updates made while the
+        # index is built, or None when it isn't being built
+        self._updates = None
+        self._rebuild_thread = None
+
+    def get(self, package_id):
+        '''Returns the CertificateSummary for the package, or None.'''
+        summaries = self._summaries
+        if summaries is None:
+            with self._build_lock:
+                summaries = self._summaries
+                if summaries is None:
+                    summaries = self._build()
+        elif self._expired() and self._build_lock.acquire(False):
+            # otherwise another thread is rebuilding it already
+            if self._expired():
+                self._rebuild_thread = threading.Thread(
+                    target=self._rebuild, name='certificate-index')
+                self._rebuild_thread.daemon = True
+                self._rebuild_thread.start()
+            else:
+                self._build_lock.release()
+        return summaries.get(package_id)
+
+    def _expired(self):
+        return bool(self.ttl) and time.time() - self._built_at > self.ttl
+
+    def _build(self):
+        with self._lock:
+            self._updates = []
+        try:
+            return self.build()
+        finally:
+            with self._lock:
+                self._updates = None
+
+    def _rebuild(self):
+        import ckan.model as model
+        try:
+            self._build()
+        except Exception, e:
+            log.exception(e)
+            # try again after another ttl
+            self._built_at = time.time()
+        finally:
+            model.Session.remove()
+            self._build_lock.release()
+
+    def build(self):
+        '''(Re)builds the index from the database.'''
+        import ckan.model as model
+        from ckanext.certificates.model import iter_certificates, uses_table
+        if uses_table():
+            return self.load(iter_certificates())
+        extra = model.PackageExtra
+        query = model.Session.query(extra.package_id, extra.value) \
+            .join(model.Package, model.Package.id == extra.package_id) \
+            .filter(extra.key == 'odi-certificate') \
+            .filter(extra.state == 'active') \
+            .filter(model.Package.state == 'active')
+        return self.load(query.yield_per(1000))
+
+    def load(self, certificates):
+        '''
+        Replaces the contents of the index with the certificates, an
+        iterable of (package id, odi-certificate JSON or a certificate
+        dictionary).
+        '''
+        summaries = {}
+        for package_id, certificate_json in certificates:
+            summary = self._summarize(certificate_json)
+            if summary is not None:
+                summaries[package_id] = summary
+        with self._lock:
+            # the changes since the build started may not have been read
+            for package_id, summary in self._updates or ():
+                _apply(summaries, package_id, summary)
+            self._summaries = summaries
+            self._built_at = time.time()
+        log.debug('Certificate index built with %s certificates',
+                  len(summaries))
+        return summaries
+
+    def update(self, package_id, certificate_json):
+        '''
+        Records a package's new certificate, or its removal if
+        certificate_json is None. Does nothing if the index hasn't been
+        built and isn't being built, since it will be read from the
+        database when it is.
+        '''
+        if self._summaries is None and self._updates is None:
+            return
+        summary = self._summarize(certificate_json)
+        with self._lock:
+            if self._updates is not None:
+                self._updates.append((package_id, summary))
+            if self._summaries is not None:
+                _apply(self._summaries, package_id, summary)
+
+    def __len__(self):
+        return len(self._summaries or ())
+
+    def _summarize(self, certificate):
+        if not certificate:
+            return None
+        if not isinstance(certificate, dict):
+            try:
+                certificate = json.loads(certificate)
+            except ValueError:
+                return None
+        if not isinstance(certificate, dict):
+            return None
+        share = self._share
+        return CertificateSummary(
+            share(certificate.get('level')),
+            share(certificate.get('certification_type')),
+            share(certificate.get('source')),
+            _narrow(certificate.get('badge_url')),
+            _narrow(certificate.get('certificate_url')))
+
+    def _share(self, value):
+        value = _narrow(value)
+        return self._strings.setdefault(value, value)
+
+
+def _apply(summaries, package_id, summary):
+    if summary is None:
+        summaries.pop(package_id, None)
+    else:
+        summaries[package_id] = summary
+
+
+def _narrow(value):
+    # json gives unicode, which takes up to 4 bytes per character, but the
+    # values are nearly always ASCII, which fits in a str
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            pass
+    return value
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    '''Returns this process's CertificateIndex (which may not be built).'''
+    global _index
+    if _index is None:
+        from pylons import config
+        with _index_lock:
+            if _index is None:
+                _index = CertificateIndex(ttl=float(config.get(
+                    'ckanext.certificates.index_ttl', DEFAULT_TTL)))
+    return _index
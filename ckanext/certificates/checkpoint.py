@@ -0,0 +1,113 @@
+'''State kept between runs of fetch_certs, so that a run can carry on from
+where the last one got to.
+
+The checkpoint records the newest 'updated' timestamp of the feed entries
+that have been processed, and the last page of the feed whose changes were
+all committed, along with the URL of the page after it. If a run stops
+part way through the feed, the next one can resume from that page. If it
+finished, the next one only needs the entries updated since.
+'''
+
+import json
+import os
+import tempfile
+
+from ckanext.certificates.client import parse_timestamp
+
+log = __import__('logging').getLogger(__name__)
+
+CHECKPOINT_FILENAME = 'certificates_checkpoint.json'
+
+
+def get_checkpoint_path(config):
+    return config.get('ckanext.certificates.checkpoint_path') or \
+        os.path.join(config.get('cache_dir') or tempfile.gettempdir(),
+                     CHECKPOINT_FILENAME)
+
+
+class Checkpoint(object):
+
+    def __init__(self, path, updated=None, page_url=None, next_url=None):
+        self.path = path
+        # newest entry 'updated' timestamp processed (string, as in the feed)
+        self.updated = updated
+        # last page completely processed and committed, and the one after it
+        self.page_url = page_url
+        self.next_url = next_url
+        self._newest = parse_timestamp(updated)
+        # newest entry read, but not yet known to be committed
+        self._observed = None
+        self._observed_updated = None
+
+    @classmethod
+    def load(cls, path):
+        '''Returns the checkpoint stored at path, or an empty one.'''
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except IOError:
+            return cls(path)
+        except ValueError, e:
+            log.error('Ignoring corrupt checkpoint %s: %s', path, e)
+            return cls(path)
+        return cls(path, state.get('updated'), state.get('page_url'),
+                   state.get('next_url'))
+
+    @property
+    def complete(self):
+        '''Whether the last run got to the end of the feed.'''
+        return self.next_url is None
+
+    def resume_args(self):
+        '''
+        Returns the url and since keyword arguments for generate_entries that
+        carry on from this checkpoint, or None if there is nothing to resume.
+        '''
+        if self.next_url:
+            return {'url': self.next_url, 'since': None}
+        if self._newest:
+            return {'url': None, 'since': self._newest}
+        return None
+
+    def observe(self, entry):
+        '''
+        Notes the entry's 'updated' timestamp, if it is the newest. It only
+        counts once page_completed says the entries read so far are stored.
+        '''
+        updated = entry.get('updated')
+        timestamp = parse_timestamp(updated)
+        if timestamp and (self._observed is None or
+                          timestamp > self._observed):
+            self._observed = timestamp
+            self._observed_updated = updated
+
+    def page_completed(self, page_url, next_url):
+        '''
+        Records that every entry observed so far, up to the end of the page,
+        has been stored.
+        '''
+        self.page_url = page_url
+        self.next_url = next_url
+        if self._observed and (self._newest is None or
+                               self._observed > self._newest):
+            self._newest = self._observed
+            self.updated = self._observed_updated
+
+    def save(self):
+        '''Writes the checkpoint atomically, so it is never half written.'''
+        write_json(self.path, {'updated': self.updated,
+                               'page_url': self.page_url,
+                               'next_url': self.next_url})
+
+
+def write_json(path, data):
+    '''Writes data to a JSON file atomically, by writing a temporary file
+    and renaming it over the old one.'''
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory,
+                                    prefix='.' + os.path.basename(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp_path, path)
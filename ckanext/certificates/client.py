@@ -1,34 +1,275 @@
+import datetime
+import itertools
 import json
+import Queue
 import re
+import sys
+import threading
 from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 import urlparse
 import urllib
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from lxml import etree
+from paste.deploy.converters import asbool
 from pylons import config
 
+from ckanext.certificates import instrumentation
+
 log = __import__('logging').getLogger(__name__)
 
 NS_MAP = {'ns': 'http://www.w3.org/2005/Atom'}
-Q_NAME = re.compile("{(?P<ns>.*)}(?P<element>.*)")
+ENTRY_TAG = '{http://www.w3.org/2005/Atom}entry'
+LINK_TAG = '{http://www.w3.org/2005/Atom}link'
+TIMESTAMP = re.compile(r'(?P<datetime>\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)'
+                       r'(\.\d+)?(?P<offset>Z|[+-]\d\d:?\d\d)?$')
 
 DEFAULT_CERTIFICATES_FEED_URL = 'https://certificates.theodi.org/datasets.feed'
 
+# HTTP session defaults, overridden with ckanext.certificates.http_* options
+HTTP_DEFAULTS = {
+    'pool_size': 10,
+    'connect_timeout': 10,
+    'read_timeout': 30,
+    'retries': 3,
+    'backoff_factor': 0.5,
+}
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+STREAMING_CHUNK_SIZE = 64 * 1024
+
+_session = None
+_session_lock = threading.Lock()
+_badge_cache = None
+_badge_cache_lock = threading.Lock()
+
+
+def _http_option(name):
+    value = config.get('ckanext.certificates.http_%s' % name)
+    default = HTTP_DEFAULTS[name]
+    return type(default)(value) if value is not None else default
 
-def entry_to_dict(entry):
+
+def get_session(pool_size=None):
     """
-    Converts an XML element (which is an Atom /feed/entry) into a dictionary
-    for consumption elsewhere.  It contains a pretty ugly way of stripping out
-    the default namespace so that the dictionary keys are a little cleaner, and
-    has some special logic for handling /feed/entry/link elements.
+    Returns the requests session shared by everything in this module, so
+    that connections to the feed and badge hosts are pooled and kept alive
+    between requests. Failed connections and 429/5xx responses are retried
+    with exponential backoff, honouring any Retry-After header.
+
+    pool_size - the minimum number of connections to keep per host. If the
+    current session's pool is smaller then a larger one is mounted for new
+    requests. The session itself is kept, so requests already using the
+    old pool, e.g. on other threads, carry on undisturbed.
+    """
+    global _session
+    with _session_lock:
+        pool_size = max(pool_size or 0, _http_option('pool_size'))
+        if _session is None:
+            _session = requests.Session()
+            # adapters replaced by larger ones, still counted in the stats
+            _session.retired_adapters = []
+            _mount_adapter(_session, pool_size)
+        elif _session.pool_size < pool_size:
+            _session.retired_adapters.append(_session.adapters['https://'])
+            _mount_adapter(_session, pool_size)
+        return _session
+
+
+def _mount_adapter(session, pool_size):
+    retry = Retry(total=_http_option('retries'),
+                  backoff_factor=_http_option('backoff_factor'),
+                  status_forcelist=RETRY_STATUSES,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.pool_size = pool_size
+
+
+def reset_session():
+    """
+    Closes the shared session, e.g. after a fork, so that the next request
+    opens fresh connections.
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            for adapter in _session.retired_adapters:
+                adapter.close()
+            _session.close()
+        _session = None
+
+
+def connection_stats():
+    """
+    Returns a dictionary with the number of connections the shared session
+    has 'opened' and the number of requests that 'reused' one.
+    """
+    stats = {'opened': 0, 'reused': 0}
+    session = _session
+    if session is None:
+        return stats
+    for adapter in set(session.adapters.values()) | \
+            set(session.retired_adapters):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats['opened'] += pool.num_connections
+            stats['reused'] += max(pool.num_requests - pool.num_connections,
+                                   0)
+    return stats
+
+
+def http_get(url, **kwargs):
+    """
+    GETs the url with the shared session and the configured timeouts.
     """
-    d = {}
-    for node in entry.xpath('*'):
+    kwargs.setdefault('timeout', (_http_option('connect_timeout'),
+                                  _http_option('read_timeout')))
+    return get_session().get(url, **kwargs)
+
+
+class CertificateEntry(object):
+    """
+    A compact, dictionary-like record of a feed entry. The keys that the
+    ODI feed normally has are stored in slots, and anything else in a small
+    dictionary, which saves a lot of memory over a dict per entry.
+    """
+    FIELDS = ('id', 'title', 'updated', 'content', 'about', 'alternate',
+              'badge_html', 'badge_json', 'link')
+    __slots__ = FIELDS + ('_extra',)
+    _FIELD_SET = frozenset(FIELDS)
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        if key in CertificateEntry._FIELD_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in CertificateEntry._FIELD_SET:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in CertificateEntry._FIELD_SET:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [key for key in CertificateEntry.FIELDS if hasattr(self, key)]
+        if self._extra:
+            keys.extend(self._extra)
+        return keys
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
 
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (dict, CertificateEntry)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return 'CertificateEntry(%r)' % dict(self.items())
+
+    def __getstate__(self):
+        return dict(self.items())
+
+    def __setstate__(self, state):
+        self._extra = None
+        self.update(state)
+
+
+# Cache of element tag (with namespace) to dictionary key
+_TAG_KEYS = {}
+
+BADGE_LINK_REL = 'http://schema.theodi.org/certificate#badge'
+BADGE_LINK_TYPES = {
+    'text/html': 'badge_html',
+    'application/javascript': 'badge_json',
+}
+
+
+def _tag_key(tag):
+    try:
+        return _TAG_KEYS[tag]
+    except KeyError:
         # Strip out the namespace from the tag name
-        match = Q_NAME.search(node.tag)
-        name = match.groupdict().get("element") if match else node.tag
+        key = _TAG_KEYS[tag] = tag.rpartition('}')[2]
+        return key
+
+
+def entry_to_dict(entry, factory=dict):
+    """
+    Converts an XML element (which is an Atom /feed/entry) into a dictionary
+    for consumption elsewhere.  The default namespace is stripped from the
+    tag names so that the dictionary keys are a little cleaner, and there is
+    some special logic for handling /feed/entry/link elements.
+
+    factory - the type of dictionary to return, e.g. CertificateEntry
+    """
+    d = factory()
+    for node in entry:
+        tag = node.tag
+        if not isinstance(tag, basestring):
+            # Comments and processing instructions
+            continue
+        name = _tag_key(tag)
 
         if name == 'link':
             # Special handling for links, either uses a specific string
@@ -37,12 +278,8 @@ def entry_to_dict(entry):
             rel = node.get('rel')
             href = node.get('href')
 
-            if rel == 'http://schema.theodi.org/certificate#badge':
-                types = {
-                    'text/html': 'badge_html',
-                    'application/javascript': 'badge_json',
-                }
-                d[types[node.get('type')]] = href
+            if rel == BADGE_LINK_REL:
+                d[BADGE_LINK_TYPES[node.get('type')]] = href
             elif rel:
                 d[rel] = href
             else:
@@ -53,14 +290,45 @@ def entry_to_dict(entry):
     return d
 
 
-def generate_entries(url=None, since=None):
+def generate_entries(url=None, since=None, streaming=None, compact=False,
+                     on_page=None, prefetch=None, max_pages=None):
     """
     Yields dictionaries representing the entries found in the ODI Atom feed.
 
     since - filter to only changes after this datetime (datetime type)
+    streaming - parse each page incrementally (see fetch_entries)
+    compact - yield CertificateEntry records rather than dicts
+    on_page - called at the end of each page (see fetch_entries)
+    prefetch - pages to fetch in the background (see fetch_entries)
+    max_pages - stop after this many pages
     """
-    for entry in fetch_entries(url=url, since=since):
-        yield entry_to_dict(entry)
+    factory = CertificateEntry if compact else dict
+    for entry in fetch_entries(url=url, since=since, streaming=streaming,
+                               on_page=on_page, prefetch=prefetch,
+                               max_pages=max_pages):
+        yield entry_to_dict(entry, factory)
+
+
+def parse_timestamp(value):
+    """
+    Parses an ISO 8601 timestamp from the feed, e.g. an entry's 'updated',
+    into a naive UTC datetime. Returns None if it isn't one.
+    """
+    match = TIMESTAMP.match(value or '')
+    if not match:
+        return None
+    try:
+        timestamp = datetime.datetime.strptime(match.group('datetime'),
+                                               '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        # e.g. the 30th of February
+        return None
+    offset = match.group('offset')
+    if offset and offset != 'Z':
+        sign = -1 if offset[0] == '-' else 1
+        timestamp -= sign * datetime.timedelta(hours=int(offset[1:3]),
+                                               minutes=int(offset[-2:]))
+    return timestamp
 
 
 def set_url_parameter(url, key, value):
@@ -72,89 +340,328 @@ def set_url_parameter(url, key, value):
     return urlparse.urlunparse(url_parts)
 
 
-def fetch_entries(url=None, since=None):
+def fetch_entries(url=None, since=None, streaming=None, on_page=None,
+                  prefetch=None, max_pages=None):
     """
     Process the Atom feed at the specified URL, and yields all of the entries
     it can find.  If the url that the feed was fetched from is NOT the last
     URL, then the next page is retrieved and processed in the same way.
 
     since - filter to only changes after this datetime (datetime type)
+    streaming - if True, each page is parsed as it is downloaded, and each
+                entry is cleared once the consumer has moved on to the next
+                one, so memory use doesn't grow with the page size. The
+                consumer must not hold on to the yielded elements. Defaults
+                to the ckanext.certificates.streaming_parse option.
+    on_page - called with (page_url, next_page_url) once all of the entries
+              of a page have been yielded. next_page_url is None for the
+              last page.
+    prefetch - the number of pages to fetch and parse in a background
+               thread ahead of the page being consumed, so that network
+               latency overlaps with processing the entries. Prefetched
+               pages are parsed whole, so this overrides streaming.
+               Defaults to the ckanext.certificates.feed_prefetch option.
+    max_pages - stop after this many pages, e.g. to process a range of
+                pages, starting from the url of the first
     """
 
+    url = feed_url(url, since)
+    if streaming is None:
+        streaming = asbool(
+            config.get('ckanext.certificates.streaming_parse', False))
+    if prefetch is None:
+        prefetch = int(config.get('ckanext.certificates.feed_prefetch', 0))
+
+    if prefetch > 0:
+        pages = prefetch_pages(_iter_pages(url, streaming=False,
+                                           max_pages=max_pages), prefetch)
+    else:
+        pages = _iter_pages(url, streaming=streaming, max_pages=max_pages)
+
+    try:
+        for page_url, entries, links in pages:
+            for entry in entries:
+                yield entry
+            if on_page:
+                on_page(page_url, _next_page_url(links))
+    except Exception, e:
+        # If we get this far either the options are:
+        # 1. The request failed, even after retrying
+        # 2. We've been given HTML of some form
+        # 3. It is otherwise not valid XML.
+        log.exception(e)
+
+
+def feed_url(url=None, since=None):
+    """
+    Returns the URL of the first page of the feed: the url given, or the
+    configured one, filtered to changes after the since datetime.
+    """
     url = url or config.get('ckanext.certificates.feed_url') or \
         DEFAULT_CERTIFICATES_FEED_URL
 
     # Add the 'since' parameter to the url
     if since:
         url = set_url_parameter(url, 'since', since.isoformat() + 'Z')
+    return url
 
-    out_of_pages = False
 
-    while not out_of_pages:
+def feed_page_count(url):
+    """
+    Fetches the page of the feed at url and returns the number of pages in
+    the feed, from the 'page' parameter of its 'last' link. Pages are
+    numbered from 1, and set_url_parameter(url, 'page', n) gives page n.
+    """
+    req = http_get(url)
+    links = {}
+    try:
+        parse_feed_page(req.content, links)
+    finally:
+        req.close()
+    last_url = links.get('last')
+    if not last_url or last_url == links.get('self'):
+        return 1
+    query = urlparse.parse_qs(urlparse.urlparse(last_url).query)
+    return int(query['page'][0])
+
+
+def _iter_pages(url, streaming=False, max_pages=None):
+    """
+    Yields (page_url, entries, links) for each page of the feed, starting at
+    url, up to max_pages of them. links is a dictionary of the page's links,
+    by rel, and is complete once entries has been consumed. Errors are
+    raised.
+    """
+    pages = 0
+    while url and (max_pages is None or pages < max_pages):
+        pages += 1
+        instrumentation.count('feed_requests')
+        if streaming:
+            # The page is parsed as it downloads, so the time taken to
+            # parse it can't be told apart from the time taken to read it
+            with instrumentation.timer('feed_http'):
+                req = http_get(url, stream=True)
+            links = {}
+            try:
+                yield url, iterparse_feed_page(
+                    _counted(req.iter_content(STREAMING_CHUNK_SIZE),
+                             'feed_bytes'), links), links
+            finally:
+                req.close()
+        else:
+            with instrumentation.timer('feed_http'):
+                req = http_get(url)
+                content = req.content
+            instrumentation.count('feed_bytes', len(content))
+            links = {}
+            try:
+                with instrumentation.timer('feed_parse'):
+                    entries = parse_feed_page(content, links)
+            except etree.XMLSyntaxError:
+                log.error(content)
+                raise
+            finally:
+                req.close()
+            yield url, entries, links
+
+        log.debug("Page URLs self: {0} last: {1}".format(
+            links.get('self'), links.get('last')))
+        url = _next_page_url(links)
+        if url:
+            log.debug("Feed has another page of data, fetching...")
+        else:
+            log.debug("Feed has run out of pages, all done.")
 
-        try:
-            req = requests.get(url)
-        except Exception, request_err:
-            log.exception(request_err)
-            return
 
-        # We wrap the response in a StringIO to work around problems with
-        # various versions of LXML processing, or not processing, utf8
-        # properly.
-        data = StringIO(req.content)
+def _counted(chunks, counter):
+    for chunk in chunks:
+        instrumentation.count(counter, len(chunk))
+        yield chunk
 
+
+def prefetch_pages(pages, depth):
+    """
+    Consumes the pages iterator of (page_url, entries, links) in a
+    background thread, keeping up to depth pages ready ahead of the one
+    being processed. Pages are yielded in their original order, and an
+    error in the background thread is raised here.
+    """
+    queue = Queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
         try:
-            doc = etree.parse(data)
-        except Exception, e:
-            # If we get this far either the options are:
-            # 1. We've been given HTML of some form
-            # 2. It is otherwise not valid XML.
-            log.exception(e)
-            log.error(req.content)
-            return
+            for page_url, entries, links in pages:
+                if not put(((page_url, list(entries), links), None)):
+                    return
+        except Exception:
+            put((None, sys.exc_info()))
+        else:
+            put((None, None))
 
-        for entry in doc.xpath("/ns:feed/ns:entry", namespaces=NS_MAP):
-            yield entry
+    producer = threading.Thread(target=produce, name='feed-prefetch')
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            page, exc_info = queue.get()
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if page is None:
+                return
+            yield page
+    finally:
+        # Let the producer finish if the consumer has stopped early
+        stop.set()
+
+
+def parse_feed_page(content, links):
+    """
+    Parses a whole page of the Atom feed, returning its entry elements and
+    filling the links dictionary with the href of each of the feed's links,
+    keyed by rel.
+    """
+    # We wrap the response in a StringIO to work around problems with
+    # various versions of LXML processing, or not processing, utf8
+    # properly.
+    doc = etree.parse(StringIO(content))
+    for link in doc.xpath("/ns:feed/ns:link", namespaces=NS_MAP):
+        links[link.get('rel')] = link.get('href')
+    return doc.xpath("/ns:feed/ns:entry", namespaces=NS_MAP)
 
-        self_url = doc.xpath("/ns:feed/ns:link[@rel='self']", namespaces=NS_MAP)[0].get('href')
-        last_url = doc.xpath("/ns:feed/ns:link[@rel='last']", namespaces=NS_MAP)[0].get('href')
 
-        log.debug("Page URLs self: {0} last: {1}".format(self_url, last_url))
+def iterparse_feed_page(chunks, links):
+    """
+    Incrementally parses a page of the Atom feed from an iterable of byte
+    strings, yielding each entry element as soon as it is complete. Once the
+    consumer asks for the next entry the previous one is cleared and removed
+    from the tree.
 
-        if self_url == last_url:
-            log.debug("Feed has run out of pages, all done.")
-            out_of_pages = True
+    The links dictionary is filled in with the feed's links as they are
+    found, and is complete once the generator is exhausted.
+    """
+    parser = etree.XMLPullParser(events=('end',),
+                                 tag=(ENTRY_TAG, LINK_TAG))
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is None:
+            parser.close()
         else:
-            next_link = doc.xpath("/ns:feed/ns:link[@rel='next']", namespaces=NS_MAP)
-            if next_link:
-                url = next_link[0].get('href')
+            parser.feed(chunk)
+        for _event, element in parser.read_events():
+            parent = element.getparent()
+            # Only interested in the feed's children, not an entry's links
+            if parent is None or parent.getparent() is not None:
+                continue
+            if element.tag == LINK_TAG:
+                links[element.get('rel')] = element.get('href')
             else:
-                # There is no next link, this must be the last page.
-                out_of_pages = True
+                yield element
+            element.clear()
+            while element.getprevious() is not None:
+                del parent[0]
 
-        if not out_of_pages:
-            log.debug("Feed has another page of data, fetching...")
 
-        del doc
-        data.close()
+def _next_page_url(links):
+    """
+    Returns the URL of the next page of the feed, given the links of the
+    current one, or None if this is the last page.
+    """
+    if links.get('self') == links.get('last'):
+        return None
+
+    # If there is no next link, this must be the last page.
+    return links.get('next')
+
 
+# Requests a badge afresh, when a 304 has nothing cached to answer it from
+REFETCH_HEADERS = {'Cache-Control': 'no-cache'}
 
-def get_badge_data(url):
+
+def get_badge_cache():
+    """
+    Returns the BadgeCache configured by ckanext.certificates.badge_cache_path
+    or None if there isn't one.
+    """
+    global _badge_cache
+    if _badge_cache is None:
+        path = config.get('ckanext.certificates.badge_cache_path')
+        if not path:
+            return None
+        from ckanext.certificates.badge_cache import BadgeCache, \
+            DEFAULT_MAX_ENTRIES
+        with _badge_cache_lock:
+            if _badge_cache is None:
+                _badge_cache = BadgeCache(path, int(config.get(
+                    'ckanext.certificates.badge_cache_size',
+                    DEFAULT_MAX_ENTRIES)))
+    return _badge_cache
+
+
+def get_badge_data(url, cache=None):
     """
     Fetches the JSON representing a specific certificate
+
+    cache - a BadgeCache to make the request conditional on. It defaults to
+            the configured cache (see get_badge_cache). If the certificate
+            is unchanged then the cached badge is returned.
     """
-    try:
-        req = requests.get(url)
-    except Exception, request_err:
-        log.exception(request_err)
-        log.exception("There was a problem with the request at {0}: {1}".format(url, request_err))
+    cache = cache if cache is not None else get_badge_cache()
+    cached = cache.get(url) if cache is not None else None
+    instrumentation.count('badge_requests')
+    headers = cached.validators() if cached else None
+    while True:
+        try:
+            with instrumentation.timer('badge_http'):
+                req = http_get(url, headers=headers)
+                content = req.content
+        except Exception, request_err:
+            log.exception(request_err)
+            log.exception("There was a problem with the request at {0}: {1}".format(url, request_err))
+            return None
+
+        badge = badge_from_response(url, req.status_code, req.headers,
+                                    content, cached, cache)
+        if badge is not None or headers == REFETCH_HEADERS:
+            return badge or {}
+        cached, headers = None, REFETCH_HEADERS
+
+
+def badge_from_response(url, status_code, headers, content, cached=None,
+                        cache=None):
+    """
+    Returns the badge dictionary for the response to a request for a
+    certificate's JSON, or {} if the request failed. headers must be looked
+    up case insensitively, or have lower case keys. A 304 with no cached
+    badge to answer it from gives None, and the badge should be requested
+    again with REFETCH_HEADERS.
+
+    cached - the CachedBadge the request was made conditional on, if any
+    cache - the BadgeCache to store the badge in
+    """
+    instrumentation.count('badge_bytes', len(content))
+    if status_code == 304:
+        if cached:
+            instrumentation.count('badge_not_modified')
+            return cached.badge
+        # e.g. the cached badge was lost, or a proxy answered for us
+        log.warning('Not modified, but no cached certificate for %s - '
+                    'requesting it again', url)
         return None
 
-    if req.status_code >= 400:
-        log.exception("There was a problem with the request at {0}: status {1}".format(url, req.status_code))
+    if status_code >= 400:
+        log.exception("There was a problem with the request at {0}: status {1}".format(url, status_code))
         return {}
 
-    data = json.loads(req.content)['certificate']
+    data = json.loads(content)['certificate']
     badge = {
         'level': data['level'],
         'created_at': data['created_at'],
@@ -179,6 +686,51 @@ def get_badge_data(url):
         log.warning('certification_type not recognized: %s', cert_type)
         badge['source'] = 'Certification: %s' % cert_type.capitalize()
 
+    if cache is not None:
+        cache.set(url, headers.get('etag'), headers.get('last-modified'),
+                  badge)
     return badge
 
 
+class BadgeFetcher(object):
+    """
+    Fetches the badge JSON for a batch of certificate URLs, using a pool of
+    worker threads when more than one worker is configured. No more than
+    host_concurrency requests are in flight to any one host at a time.
+    Results are returned in the same order as the URLs, so the caller can
+    carry on doing its database work from a single thread.
+    """
+
+    def __init__(self, workers=1, host_concurrency=None):
+        self.workers = max(int(workers or 1), 1)
+        self.host_concurrency = int(host_concurrency or self.workers)
+        self._pool = ThreadPool(self.workers) if self.workers > 1 else None
+        get_session(pool_size=self.workers)
+        self._host_locks = {}
+        self._host_locks_lock = threading.Lock()
+
+    def fetch(self, urls):
+        """
+        Returns a list of the results of get_badge_data for each url.
+        """
+        if self._pool is None or len(urls) < 2:
+            return [get_badge_data(url) for url in urls]
+        return self._pool.map(self._fetch_one, urls)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _fetch_one(self, url):
+        with self._host_semaphore(url):
+            return get_badge_data(url)
+
+    def _host_semaphore(self, url):
+        host = urlparse.urlparse(url).netloc
+        with self._host_locks_lock:
+            if host not in self._host_locks:
+                self._host_locks[host] = \
+                    threading.BoundedSemaphore(self.host_concurrency)
+            return self._host_locks[host]
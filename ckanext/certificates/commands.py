@@ -1,10 +1,12 @@
-import json
-import re
 import logging
 import datetime
+import time
 
 from ckan.lib.cli import CkanCommand
 
+from ckanext.certificates.fetcher import CertificateFetcher, \
+    CertificateWriter, DEFAULT_BATCH_SIZE, DEFAULT_COMMIT_INTERVAL
+
 
 class CertificateCommand(CkanCommand):
     """
@@ -26,6 +28,55 @@ class CertificateCommand(CkanCommand):
             help='Filter to the most recent X hours of changes')
         self.parser.add_option('--days', dest='days',
             help='Filter to the most recent X days of changes')
+        self.parser.add_option('--badge-workers', dest='badge_workers',
+            help='Number of threads fetching certificate badge JSON '
+                 'concurrently (default 1)')
+        self.parser.add_option('--host-concurrency', dest='host_concurrency',
+            help='Maximum concurrent badge requests to any one host '
+                 '(defaults to the number of badge workers)')
+        self.parser.add_option('--batch-size', dest='batch_size',
+            help='Number of feed entries to look up packages for in one '
+                 'query (default %d)' % DEFAULT_BATCH_SIZE)
+        self.parser.add_option('--commit-batch', dest='commit_batch_size',
+            help='Number of changed certificates to write in one revision '
+                 'and commit (default 1)')
+        self.parser.add_option('--workers', dest='workers',
+            help='Split the feed\'s pages between this number of processes '
+                 '(default 1)')
+        self.parser.add_option('--resume', '--since-last-run', dest='resume',
+            action='store_true', default=False,
+            help='Carry on from where the last run got to, rather than '
+                 'using --hours/--days')
+        self.parser.add_option('--refetch', dest='refetch',
+            action='store_true', default=False,
+            help='Fetch the badge of every certificate, including those '
+                 'not updated in the feed since they were stored')
+        self.parser.add_option('--async', dest='async_http',
+            action='store_true', default=False,
+            help='Make the feed and badge requests on gevent greenlets, '
+                 'with --badge-workers of them in flight at once')
+        self.parser.add_option('--record-snapshot', dest='record_snapshot',
+            help='Append the feed entries and badges of this run to a '
+                 'snapshot file, to replay later with --from-snapshot. Every '
+                 'badge is fetched, as with --refetch')
+        self.parser.add_option('--from-snapshot', dest='from_snapshot',
+            help='Replay the feed entries and badges recorded in a snapshot '
+                 'file, rather than fetching them')
+        self.parser.add_option('--daemon', dest='daemon',
+            action='store_true', default=False,
+            help='Keep running, fetching the changes since the last fetch '
+                 'every few minutes, more or less often depending on how '
+                 'many there are')
+        self.parser.add_option('--profile', dest='profile',
+            action='store_true', default=False,
+            help='Time each phase of the run and add the timings to the '
+                 'summary')
+        self.parser.add_option('--profile-output', dest='profile_output',
+            help='With --profile, also write the timings to this file, as '
+                 'JSON if it ends in .json or otherwise as StatsD-style '
+                 'lines')
+        self.parser.add_option('--cprofile', dest='cprofile',
+            help='Run under cProfile and dump its stats to this file')
 
     def command(self):
         # Load configuration
@@ -45,9 +96,9 @@ class CertificateCommand(CkanCommand):
 
         # 'site_url_filter' decides whether a certificate is from this site or
         # not from its 'about' field
-        site_url_filter, site_url_filter_regex = \
-            CertificateFetcher._get_site_url_filter(config)
-        log.debug('Site url filter (regex): %s', site_url_filter_regex)
+        from ckanext.certificates.site_url import get_site_url_matcher
+        site_url_filter = get_site_url_matcher(config)
+        log.debug('Site url filter: %r', site_url_filter)
 
         # Time filter
         time_filter_h = int(self.options.hours or 0)
@@ -55,104 +106,283 @@ class CertificateCommand(CkanCommand):
         since_datetime = datetime.datetime.utcnow() - \
             datetime.timedelta(days=time_filter_d, hours=time_filter_h)
 
-        CertificateFetcher.fetch(site_url_filter, since_datetime)
+        from ckanext.certificates import instrumentation
+        if self.options.profile or self.options.profile_output:
+            instrumentation.enable()
+        profiler = None
+        if self.options.cprofile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
 
+        try:
+            if self.options.daemon:
+                self._run_daemon(config, site_url_filter, since_datetime)
+            else:
+                self._run(config, site_url_filter, since_datetime,
+                          self.options.resume)
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(self.options.cprofile)
+                log.info('cProfile stats written to %s',
+                         self.options.cprofile)
+            if self.options.profile_output and instrumentation.enabled():
+                instrumentation.active().write(self.options.profile_output)
+                log.info('Timings written to %s',
+                         self.options.profile_output)
 
-class CertificateFetcher(object):
+    def _run(self, config, site_url_filter, since_datetime, resume):
+        """
+        Fetches the certificates once, unless another fetch holds the lock.
+        Returns the stats and the checkpoint, or None if it didn't run.
+        """
+        from ckanext.certificates.daemon import RunLock, get_lock_path
+        log = logging.getLogger(__name__)
+        with RunLock(get_lock_path(config)) as locked:
+            if not locked:
+                log.info('Another fetch of the certificates is running - '
+                         'not starting this one')
+                return None
+            return self._fetch(config, site_url_filter, since_datetime,
+                               resume)
 
-    @classmethod
-    def fetch(cls, site_url_filter, since_datetime):
-        import ckan.model as model
-        from running_stats import StatsList
+    def _fetch(self, config, site_url_filter, since_datetime, resume):
         log = logging.getLogger(__name__)
-        stats = StatsList()
-
-        # Use the generate_entries generator to get all of
-        # the entries from the ODI Atom feed.  This should
-        # correctly handle all of the pages within the feed.
-        import ckanext.certificates.client as client
-        for entry in client.generate_entries(since=since_datetime):
-
-            # We have to handle the case where the rel='about' might be
-            # missing, if so we'll ignore it and catch it next time
-            about = entry.get('about', '')
-            if not about:
-                log.debug(stats.add('Ignore - no rel="about" specifying the dataset',
-                                    '%s "%s" %s' % (about, entry['title'], entry['id'])))
-                continue
-
-            if not site_url_filter.search(about):
-                log.debug(stats.add('Ignore - "about" field does not reference this site',
-                                    '%s "%s" %s' % (about, entry['title'], entry['id'])))
-                continue
-
-            if not '/dataset/' in entry['about']:
-                log.debug(stats.add('Ignore - is "about" DGU but not a dataset',
-                                    '%s "%s" %s' % (about, entry['about'], entry['id'])))
-                continue
-
-            pkg = cls._get_package_from_url(entry.get('about'))
-            if not pkg:
-                log.error(stats.add('Unable to find the package',
-                                    '%s "%s" %s %r' % (about, entry['about'], entry['id'], entry.get('about'))))
-                continue
-
-            # Build the JSON subset we want to describe the certificate
-            badge_data = client.get_badge_data(entry['alternate'])
-            if not badge_data:
-                log.info(stats.add('Error fetching badge data - skipped',
-                                   '%s "%s" %s' % (about, entry['title'], entry['id'])))
-                continue
-            badge_data['cert_title'] = entry.get('content', '')  # e.g. 'Basic Level Certificate'
-
-            badge_json = json.dumps(badge_data)
-            if pkg.extras.get('odi-certificate') == badge_json:
-                log.debug(stats.add('Certificate unchanged',
-                                         badge_data['certificate_url']))
+        feed_url = None
+
+        from ckanext.certificates.checkpoint import Checkpoint, \
+            get_checkpoint_path
+        checkpoint = Checkpoint.load(get_checkpoint_path(config))
+        if resume:
+            resume_args = checkpoint.resume_args()
+            if resume_args:
+                feed_url = resume_args['url']
+                since_datetime = resume_args['since']
+                log.info('Resuming from checkpoint: %s',
+                         feed_url or 'updated since %s' % checkpoint.updated)
+            else:
+                log.info('No checkpoint to resume from - using the time '
+                         'filter')
+
+        badge_workers = int(self.options.badge_workers or
+                            config.get('ckanext.certificates.badge_workers')
+                            or 1)
+        host_concurrency = int(
+            self.options.host_concurrency or
+            config.get('ckanext.certificates.host_concurrency') or 0) or None
+        batch_size = int(self.options.batch_size or
+                         config.get('ckanext.certificates.batch_size') or
+                         DEFAULT_BATCH_SIZE)
+
+        from ckanext.certificates.model import get_storage
+        storage = get_storage(config)
+        writer = CertificateWriter(
+            batch_size=int(self.options.commit_batch_size or
+                           config.get('ckanext.certificates.commit_batch_size')
+                           or 1),
+            interval=float(config.get('ckanext.certificates.commit_interval',
+                                      DEFAULT_COMMIT_INTERVAL)),
+            storage=storage)
+
+        from paste.deploy.converters import asbool
+        async_http = self.options.async_http or \
+            asbool(config.get('ckanext.certificates.async_http', False))
+
+        fetch_options = dict(badge_workers=badge_workers,
+                             host_concurrency=host_concurrency,
+                             batch_size=batch_size, writer=writer,
+                             async_http=async_http,
+                             skip_unchanged=not (self.options.refetch or
+                                                 self.options.record_snapshot))
+        workers = int(self.options.workers or 1)
+        if self.options.from_snapshot or self.options.record_snapshot:
+            if workers > 1:
+                log.warning('Snapshots are read and written by one process '
+                            '- ignoring --workers')
+                workers = 1
+            from ckanext.certificates.snapshot import SnapshotReader, \
+                SnapshotWriter
+            if self.options.record_snapshot:
+                fetch_options['snapshot'] = \
+                    SnapshotWriter(self.options.record_snapshot)
+            if self.options.from_snapshot:
+                reader = SnapshotReader(self.options.from_snapshot)
+                fetch_options.update(entries=reader.entries(),
+                                     badge_fetcher=reader)
+                # The snapshot's entries say nothing about the feed's pages
+                checkpoint = None
+        if not self.options.from_snapshot:
+            from ckanext.certificates.badge_images import \
+                open_badge_image_store
+            fetch_options['badge_images'] = \
+                open_badge_image_store(config, badge_workers)
+
+        try:
+            if workers > 1:
+                stats = CertificateFetcher.fetch_sharded(
+                    workers, site_url_filter, since_datetime,
+                    feed_url=feed_url, **fetch_options)
             else:
-                operation = 'updated' if 'odi-certificate' in pkg.extras \
-                    else 'added'
-                model.repo.new_revision()
-                pkg.extras['odi-certificate'] = json.dumps(badge_data)
-                log.debug(stats.add('Certificate %s' % operation,
-                               '"%s" %s' % (badge_data['title'],
-                                            badge_data['certificate_url'])))
-                model.Session.commit()
-
-        log.info('Summary:\n' + stats.report())
-
-    @classmethod
-    def _get_package_from_url(cls, url):
+                stats = CertificateFetcher.fetch(
+                    site_url_filter, since_datetime, feed_url=feed_url,
+                    checkpoint=checkpoint, **fetch_options)
+        finally:
+            if fetch_options.get('snapshot'):
+                fetch_options['snapshot'].close()
+            if fetch_options.get('badge_images'):
+                fetch_options['badge_images'].close()
+        return stats, checkpoint
+
+    def _run_daemon(self, config, site_url_filter, since_datetime):
         """
-        Pulls data from the entry in an attempt to find a local package,
-        which, if successful is returned.  None is returned if the package
-        has been deleted, or is not a package for this site.
+        Fetches the certificates over and over, each time carrying on from
+        the checkpoint, with a pause between fetches that adapts to how
+        often the certificates change. Each fetch takes the lock, so a cron
+        job can run alongside, and the outcome of each is written to the
+        status file.
         """
         import ckan.model as model
+        import signal
+        from ckanext.certificates.daemon import PollInterval, \
+            get_status_path, write_status
+        log = logging.getLogger(__name__)
+
+        interval = PollInterval(
+            float(config.get('ckanext.certificates.daemon_min_interval',
+                             PollInterval().min_interval)),
+            float(config.get('ckanext.certificates.daemon_max_interval',
+                             PollInterval().max_interval)))
+        status_path = get_status_path(config)
+        self.stopping = False
+
+        def stop(signum, frame):
+            log.info('Stopping after signal %s', signum)
+            self.stopping = True
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        log.info('Fetching certificates every %s-%s seconds',
+                 interval.min_interval, interval.max_interval)
+        status = {}
+        runs = 0
+        while not self.stopping:
+            started = datetime.datetime.utcnow()
+            start_time = time.time()
+            status.update(state='running', last_run_started=started)
+            write_status(status_path, **status)
+            try:
+                result = self._run(config, site_url_filter, since_datetime,
+                                   resume=True)
+            except Exception, e:
+                log.exception(e)
+                result = None
+                status['last_error'] = '%s: %s' % (type(e).__name__, e)
+            else:
+                status['last_error'] = None
+            finally:
+                model.Session.remove()
+            runs += 1
+            status.update(runs=runs,
+                          last_run_seconds=round(time.time() - start_time, 3))
+            if result is None:
+                # locked out or failed - back off as if nothing changed
+                seconds = interval.update(0)
+                status.update(last_run_skipped=True)
+            else:
+                stats, checkpoint = result
+                changes = stats.count('Certificate added') + \
+                    stats.count('Certificate updated')
+                caught_up = checkpoint is None or checkpoint.complete
+                seconds = interval.update(changes, caught_up)
+                status.update(
+                    last_run_skipped=False,
+                    last_run_finished=datetime.datetime.utcnow(),
+                    last_run_entries=sum(stats.count(category)
+                                         for category in stats),
+                    last_run_changes=changes,
+                    caught_up=caught_up,
+                    newest_certificate=checkpoint and checkpoint.updated,
+                    resume_from=checkpoint and checkpoint.next_url)
+            status.update(state='waiting', interval=seconds,
+                          next_run=datetime.datetime.utcnow() +
+                          datetime.timedelta(seconds=seconds))
+            write_status(status_path, **status)
+            wake = time.time() + seconds
+            while not self.stopping and time.time() < wake:
+                time.sleep(min(1, wake - time.time()))
+        status.update(state='stopped', next_run=None)
+        write_status(status_path, **status)
+
+
+class CertificateAdminCommand(CkanCommand):
+    """
+    Administer ODI certificates
+
+    Usage:
+
+      certificates reindex
+        - Update the search index for those packages whose certificate has
+          changed since they were last indexed
+
+      certificates initdb
+        - Create the certificate table, for ckanext.certificates.storage =
+          table or both
+
+      certificates migrate
+        - Copy the certificates in the package extras to the certificate
+          table
+
+      certificates mirror_badges
+        - Download the badge images of the stored certificates which are
+          missing from ckanext.certificates.badge_image_dir, and remove
+          those no certificate refers to any more
+    """
+    summary = __doc__.strip().split('\n')[0]
+    usage = '\n' + __doc__
+    max_args = 1
+    min_args = 1
+
+    def command(self):
+        self._load_config()
+        log = logging.getLogger(__name__)
 
-        name = cls._get_package_name_from_url(url)
-        return model.Package.get(name)
-
-    @staticmethod
-    def _get_package_name_from_url(url):
-        from urlparse import urlparse
-
-        # Package name is the last part of the URL
-        obj = urlparse(url)
-        name = obj.path.rstrip('/').split('/')[-1]
-        return name
-
-    @staticmethod
-    def _get_site_url_filter(config):
-        site_url_regex = config.get('ckanext.certificates.site_url_regex')
-        if not site_url_regex:
-            site_url = config.get('ckanext.certificates.site_url') or \
-                config.get('ckan.site_url')
-            site_url_regex = '^' + re.escape(site_url) + '.*'
-            # allow https variation
-            site_url_regex = re.sub(r'https?\\:', r'https?\:', site_url_regex)
-            # allow www. variation
-            site_url_regex = re.sub(r'\\/\\/(www\\\.)?', r'\/\/(www.)?',
-                                    site_url_regex)
-        site_url_filter = re.compile(site_url_regex)
-        return site_url_filter, site_url_regex
+        cmd = self.args[0]
+        if cmd == 'reindex':
+            from ckanext.certificates.search import \
+                reindex_changed_certificates
+            count = reindex_changed_certificates()
+            log.info('Reindexed %s packages', count)
+        elif cmd == 'initdb':
+            from ckanext.certificates.model import init_tables
+            init_tables()
+        elif cmd == 'migrate':
+            from ckanext.certificates.model import init_tables, \
+                migrate_extras
+            init_tables()
+            copied, invalid = migrate_extras()
+            log.info('Copied %s certificates to the certificate table, '
+                     '%s invalid ones skipped', copied, invalid)
+        elif cmd == 'mirror_badges':
+            from pylons import config
+            from ckanext.certificates.badge_images import \
+                open_badge_image_store
+            from ckanext.certificates.certificate_index import \
+                CertificateIndex
+            store = open_badge_image_store(config, int(
+                config.get('ckanext.certificates.badge_workers') or 1))
+            if store is None:
+                print 'ckanext.certificates.badge_image_dir is not set'
+                return
+            badge_urls = set(summary.badge_url for summary in
+                             CertificateIndex(ttl=None).build().itervalues()
+                             if summary.badge_url)
+            downloaded = store.mirror(badge_urls)
+            urls_removed, images_removed = store.prune(badge_urls)
+            log.info('Downloaded %s badge images, removed %s. %s images '
+                     'stored, %s bytes', downloaded, images_removed,
+                     len(store), store.total_bytes())
+            store.close()
+        else:
+            print 'Command %s not recognized' % cmd
+            print self.usage
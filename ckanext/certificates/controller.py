@@ -0,0 +1,31 @@
+from pylons import request, response
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.certificates.badge_images import IMAGE_HASH, \
+    get_badge_image_store
+
+# The image at a URL never changes, since the URL is the hash of the image
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class BadgeImageController(toolkit.BaseController):
+    '''Serves the local copies of the certificate badge images.'''
+
+    def image(self, image_hash):
+        store = get_badge_image_store()
+        if store is None or not IMAGE_HASH.match(image_hash):
+            toolkit.abort(404)
+        etag = '"%s"' % image_hash
+        response.headers['Cache-Control'] = CACHE_CONTROL
+        response.headers['ETag'] = etag
+        if request.headers.get('If-None-Match') == etag:
+            response.status_int = 304
+            return ''
+        try:
+            with open(store.image_path(image_hash), 'rb') as f:
+                content = f.read()
+        except IOError:
+            toolkit.abort(404)
+        response.headers['Content-Type'] = 'image/png'
+        return content
@@ -0,0 +1,129 @@
+'''Support for running fetch_certs repeatedly from one process.
+
+RunLock - makes sure only one fetch runs at a time, whether from cron or a
+          daemon
+PollInterval - how long to wait between fetches, adapting to how often the
+               certificates change
+write_status - reports on the last run, for monitoring
+'''
+
+import datetime
+import errno
+import fcntl
+import os
+
+from ckanext.certificates.checkpoint import write_json
+
+log = __import__('logging').getLogger(__name__)
+
+LOCK_FILENAME = 'certificates_fetch.lock'
+STATUS_FILENAME = 'certificates_status.json'
+DEFAULT_MIN_INTERVAL = 60
+DEFAULT_MAX_INTERVAL = 3600
+
+
+def get_lock_path(config):
+    return config.get('ckanext.certificates.lock_path') or \
+        os.path.join(os.path.dirname(_checkpoint_path(config)),
+                     LOCK_FILENAME)
+
+
+def get_status_path(config):
+    return config.get('ckanext.certificates.status_path') or \
+        os.path.join(os.path.dirname(_checkpoint_path(config)),
+                     STATUS_FILENAME)
+
+
+def _checkpoint_path(config):
+    from ckanext.certificates.checkpoint import get_checkpoint_path
+    return os.path.abspath(get_checkpoint_path(config))
+
+
+class RunLock(object):
+    '''
+    An exclusive lock on a file, held while a fetch runs. It is released by
+    the operating system if the process dies, so it is never left stale.
+
+    with RunLock(path) as locked:
+        if locked:
+            ...
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        '''Returns whether the lock was acquired, without waiting for it.'''
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                # another process may just have made it
+                if e.errno != errno.EEXIST:
+                    raise
+        f = open(self.path, 'a')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            f.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class PollInterval(object):
+    '''
+    The time to wait before the next fetch. It halves, down to
+    min_interval, after a fetch that found changes (or didn't get to the
+    end of the feed), and grows by half, up to max_interval, after one that
+    found none, so the feed is polled often while certificates are being
+    issued and rarely while they aren't.
+    '''
+
+    def __init__(self, min_interval=DEFAULT_MIN_INTERVAL,
+                 max_interval=DEFAULT_MAX_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.seconds = min_interval
+
+    def update(self, changes, caught_up=True):
+        '''Adjusts the interval after a fetch with the number of changes it
+        made, and returns it.'''
+        if changes or not caught_up:
+            self.seconds = max(self.seconds / 2.0, self.min_interval)
+        else:
+            self.seconds = min(self.seconds * 1.5, self.max_interval)
+        return self.seconds
+
+
+def write_status(path, **status):
+    '''
+    Writes the status of the fetcher to a JSON file, with the time it was
+    written. Datetimes are written in ISO 8601 format.
+    '''
+    status['pid'] = os.getpid()
+    status['written'] = datetime.datetime.utcnow()
+    for key, value in status.items():
+        if isinstance(value, datetime.datetime):
+            status[key] = value.isoformat() + 'Z'
+    try:
+        write_json(path, status)
+    except (IOError, OSError), e:
+        log.error('Unable to write the status to %s: %s', path, e)
+
@@ -0,0 +1,548 @@
+'''Fetching the certificates from the ODI feed and storing them, for the
+fetch_certs command (see commands.py).
+
+Nothing here imports CKAN until it is used, so CertificateFetcher can be
+run, e.g. by benchmarks/fetch_pipeline.py, against a stand-in for the
+model.
+'''
+
+import json
+import logging
+import time
+from collections import OrderedDict
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_COMMIT_INTERVAL = 60
+# The number of examples of each outcome kept for the summary
+STATS_EXAMPLES = 100
+
+
+class CertificateFetcher(object):
+
+    @classmethod
+    def fetch(cls, site_url_filter, since_datetime, badge_workers=1,
+              host_concurrency=None, batch_size=DEFAULT_BATCH_SIZE,
+              writer=None, feed_url=None, checkpoint=None, entries=None,
+              report=True, async_http=False, skip_unchanged=True,
+              badge_fetcher=None, snapshot=None, badge_images=None):
+        """
+        Walks the ODI feed and stores the certificate of each entry that
+        belongs to a package on this site, as decided by site_url_filter (a
+        site_url.SiteUrlMatcher or RegexSiteUrlMatcher).
+
+        Entries are filtered and their packages looked up in batches of
+        batch_size, then the badge JSON for the batch is fetched,
+        concurrently if badge_workers > 1. All database work stays on this
+        thread. Changed certificates are written by the CertificateWriter,
+        which by default commits each one as it comes.
+
+        If a checkpoint is given, it is saved each time all of the changes
+        from a page of the feed have been committed.
+
+        entries - process these feed entries (dicts, as given by
+                  client.generate_entries) rather than walking the feed
+        report - log the summary at the end
+        async_http - fetch the feed and the badges with an
+                     async_client.AsyncClient, with badge_workers requests
+                     in flight at once, rather than with threads
+        skip_unchanged - don't fetch the badge of a certificate which was
+                         stored from a feed entry at least as new as the
+                         current one
+        badge_fetcher - fetch the badges with this, e.g. a
+                        snapshot.SnapshotReader, which is closed at the end
+        snapshot - a snapshot.SnapshotWriter to record the entries and the
+                   badges fetched to. Only the badges of entries that
+                   are fetched are recorded, so turn off skip_unchanged
+                   for a complete snapshot.
+        badge_images - a badge_images.BadgeImageStore to download the
+                       badge image of each certificate fetched to, unless
+                       it has it already. It is closed at the end.
+
+        Returns the StatsList of what happened to each entry, which counts
+        every entry but keeps only the first STATS_EXAMPLES of each outcome.
+        """
+        from running_stats import StatsList
+        log = logging.getLogger(__name__)
+        stats = StatsList(max_values=STATS_EXAMPLES)
+        writer = writer or CertificateWriter()
+        writer.stats = stats
+
+        # Use the generate_entries generator to get all of
+        # the entries from the ODI Atom feed.  This should
+        # correctly handle all of the pages within the feed.
+        import ckanext.certificates.client as client
+        from ckanext.certificates import instrumentation
+        completed_pages = []
+        # whether a certificate failed to be fetched or stored in a way
+        # that may not happen again, after which the checkpoint isn't
+        # advanced, so the next run tries it again
+        failed = False
+        if badge_fetcher is not None:
+            generate_entries = client.generate_entries
+        elif async_http:
+            from ckanext.certificates.async_client import AsyncClient
+            badge_fetcher = AsyncClient(badge_workers, host_concurrency)
+            generate_entries = badge_fetcher.iter_entries
+        else:
+            badge_fetcher = client.BadgeFetcher(badge_workers,
+                                                host_concurrency)
+            generate_entries = client.generate_entries
+        if entries is None:
+            entries = generate_entries(
+                url=feed_url, since=since_datetime,
+                on_page=lambda *page: completed_pages.append(page))
+        if snapshot:
+            entries = snapshot.record_entries(entries)
+        if checkpoint:
+            entries = cls._observe_entries(entries, checkpoint)
+        entries = cls._filter_entries(entries, site_url_filter, stats)
+        try:
+            for batch in cls._batches(entries, batch_size):
+                with instrumentation.timer('package_lookup'):
+                    packages = cls._get_packages_from_urls(
+                        [entry['about'] for entry, name in batch],
+                        dict((entry['about'], name) for entry, name in batch),
+                        storage=writer.storage)
+                candidates = []
+                for entry, name in batch:
+                    about = entry['about']
+                    pkg, existing = packages.get(about, (None, None))
+                    if not pkg:
+                        log.error(stats.add('Unable to find the package',
+                                            '%s "%s" %s %r', about, entry['about'], entry['id'], entry.get('about')))
+                        continue
+                    if skip_unchanged and \
+                            cls._is_stored(entry, existing):
+                        log.debug(stats.add(
+                            'Certificate not updated since it was stored',
+                            '%s %s', about, entry['id']))
+                        continue
+                    candidates.append((entry, pkg, existing))
+
+                # Build the JSON subset we want to describe the certificate
+                badge_urls = [entry['alternate']
+                              for entry, pkg, existing in candidates]
+                badges = badge_fetcher.fetch(badge_urls)
+                if snapshot:
+                    snapshot.record_badges(badge_urls, badges)
+                if badge_images:
+                    badge_images.mirror([badge.get('badge_url')
+                                         for badge in badges if badge])
+                for (entry, pkg, existing), badge_data in \
+                        zip(candidates, badges):
+                    if not cls._store_certificate(entry, pkg, existing,
+                                                  badge_data, stats, writer):
+                        failed = True
+                writer.flush_if_due()
+                if checkpoint and completed_pages:
+                    # Every entry of these pages is in this batch or an
+                    # earlier one, so once committed the pages are done
+                    writer.flush()
+                    failed = failed or writer.failed_batches > 0
+                    cls._complete_pages(checkpoint, completed_pages, failed)
+            writer.flush()
+            failed = failed or writer.failed_batches > 0
+            if checkpoint and completed_pages:
+                cls._complete_pages(checkpoint, completed_pages, failed)
+            if checkpoint and failed:
+                log.warning('Not all certificates were stored - the '
+                            'checkpoint is left before the first failure, '
+                            'so that they are tried again next run')
+        finally:
+            badge_fetcher.close()
+            if badge_images:
+                badge_images.close()
+
+        if report:
+            log.info('Summary:\n' + stats.report())
+            log.info('HTTP connections: %(opened)s opened, %(reused)s reused',
+                     getattr(badge_fetcher, 'stats', None) or
+                     client.connection_stats())
+            if instrumentation.enabled():
+                log.info('Timings:\n' + instrumentation.active().report())
+        return stats
+
+    @classmethod
+    def fetch_sharded(cls, workers, site_url_filter, since_datetime,
+                      feed_url=None, **fetch_options):
+        """
+        Splits the pages of the feed into ranges, one for each of a number
+        of worker processes, which each fetch their pages with their own
+        database session, and merges the stats that they return into one
+        summary.
+
+        The feed may shift while it is being paged through, so an entry can
+        turn up at the end of one range and the start of the next. Storing a
+        certificate is idempotent, so the second worker finds it unchanged
+        (or writes the same value), and the duplicates are counted.
+        """
+        import multiprocessing
+        import ckan.model as model
+        import ckanext.certificates.client as client
+        from ckanext.certificates import instrumentation
+        from running_stats import StatsList
+        log = logging.getLogger(__name__)
+
+        first_url = client.feed_url(feed_url, since_datetime)
+        try:
+            page_count = client.feed_page_count(first_url)
+        except Exception, e:
+            log.exception(e)
+            return StatsList(max_values=STATS_EXAMPLES)
+        shards = [(site_url_filter, url, pages, fetch_options)
+                  for url, pages in page_ranges(first_url, page_count,
+                                                workers)]
+        log.info('Fetching %s pages with %s workers', page_count,
+                 len(shards))
+
+        # Don't share database or HTTP connections with the workers
+        model.Session.remove()
+        model.meta.engine.dispose()
+        client.reset_session()
+
+        pool = multiprocessing.Pool(len(shards))
+        try:
+            results = pool.map(_fetch_shard, shards)
+        finally:
+            pool.close()
+            pool.join()
+
+        stats, duplicates = merge_shard_results(results)
+        log.info('Summary:\n' + stats.report())
+        log.info('Entries seen by more than one worker: %s', duplicates)
+        if instrumentation.enabled():
+            # Each phase's total is summed over the workers
+            log.info('Timings:\n' + instrumentation.active().report())
+        return stats
+
+    @staticmethod
+    def _complete_pages(checkpoint, completed_pages, failed):
+        """
+        Saves the checkpoint with the last of the completed pages, unless
+        a certificate has failed in this run.
+        """
+        if not failed:
+            checkpoint.page_completed(*completed_pages[-1])
+            checkpoint.save()
+        del completed_pages[:]
+
+    @staticmethod
+    def _observe_entries(entries, checkpoint):
+        for entry in entries:
+            checkpoint.observe(entry)
+            yield entry
+
+    @staticmethod
+    def _filter_entries(entries, site_url_filter, stats):
+        """
+        Yields (entry, package name) for only the feed entries whose 'about'
+        URL is a dataset on this site, recording the reason for skipping the
+        others in stats.
+        """
+        log = logging.getLogger(__name__)
+        for entry in entries:
+
+            # We have to handle the case where the rel='about' might be
+            # missing, if so we'll ignore it and catch it next time
+            about = entry.get('about', '')
+            if not about:
+                log.debug(stats.add('Ignore - no rel="about" specifying the dataset',
+                                    '%s "%s" %s', about, entry['title'], entry['id']))
+                continue
+
+            name = site_url_filter.match(about)
+            if name is None:
+                log.debug(stats.add('Ignore - "about" field does not reference this site',
+                                    '%s "%s" %s', about, entry['title'], entry['id']))
+                continue
+
+            if not name:
+                log.debug(stats.add('Ignore - is "about" DGU but not a dataset',
+                                    '%s "%s" %s', about, entry['about'], entry['id']))
+                continue
+
+            yield entry, name
+
+    @staticmethod
+    def _batches(iterable, size):
+        batch = []
+        for item in iterable:
+            batch.append(item)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _store_certificate(entry, pkg, existing, badge_data, stats, writer):
+        """
+        Passes the certificate to the writer to store, unless it is the
+        same as the existing one. Returns False if the badge data couldn't
+        be fetched because the request failed (badge_data is None), which
+        is worth trying again next run. A badge the server refused, e.g. a
+        revoked certificate's 404 (badge_data is {}), is skipped for good,
+        and returns True.
+        """
+        from running_stats import LazyMessage
+        log = logging.getLogger(__name__)
+
+        about = entry['about']
+        if not badge_data:
+            log.info(stats.add('Error fetching badge data - skipped',
+                               '%s "%s" %s', about, entry['title'], entry['id']))
+            return badge_data is not None
+        badge_data['cert_title'] = entry.get('content', '')  # e.g. 'Basic Level Certificate'
+        # so that it needn't be fetched again until the entry is updated
+        badge_data['feed_updated'] = entry.get('updated')
+
+        badge_json = json.dumps(badge_data)
+        if existing == badge_json or existing == badge_data:
+            log.debug(stats.add('Certificate unchanged',
+                                     badge_data['certificate_url']))
+        else:
+            operation = 'updated' if existing is not None else 'added'
+            writer.add(pkg, badge_json, operation,
+                       LazyMessage('"%s" %s', (badge_data['title'],
+                                               badge_data['certificate_url'])))
+        return True
+
+    @staticmethod
+    def _is_stored(entry, existing):
+        """
+        Returns whether the existing certificate (JSON, or a dictionary
+        from the certificate table) was stored from a feed entry updated no
+        earlier than this one.
+        """
+        from ckanext.certificates.client import parse_timestamp
+        if isinstance(existing, dict):
+            stored = existing.get('feed_updated')
+        elif not existing or '"feed_updated"' not in existing:
+            return False
+        else:
+            try:
+                stored = json.loads(existing).get('feed_updated')
+            except ValueError:
+                return False
+        updated = parse_timestamp(entry.get('updated'))
+        stored = parse_timestamp(stored)
+        return bool(updated and stored and updated <= stored)
+
+    @classmethod
+    def _get_packages_from_urls(cls, urls, names=None, storage='extras'):
+        """
+        Finds the local packages for a batch of dataset URLs in a single
+        query, which also fetches each package's existing certificate.
+        Returns a dictionary of url: (package, certificate or None), where
+        the certificate is JSON from the extras, or a dictionary if storage
+        is in the certificate table. URLs that don't match a package name,
+        e.g. because they use the package id, are looked up individually.
+
+        names - the package name in each url, if already known
+        """
+        import ckan.model as model
+        from sqlalchemy import and_
+
+        from ckanext.certificates.site_url import package_name_from_url
+
+        names = dict((url, (names or {}).get(url) or
+                      package_name_from_url(url))
+                     for url in urls)
+        if storage == 'extras':
+            extra = model.PackageExtra
+            query = model.Session.query(model.Package, extra.value) \
+                .outerjoin(extra, and_(extra.package_id == model.Package.id,
+                                       extra.key == 'odi-certificate',
+                                       extra.state == 'active')) \
+                .filter(model.Package.name.in_(set(names.values())))
+            by_name = dict((pkg.name, (pkg, value)) for pkg, value in query)
+        else:
+            from ckanext.certificates.model import get_certificates
+            pkgs = model.Session.query(model.Package) \
+                .filter(model.Package.name.in_(set(names.values()))).all()
+            certificates = get_certificates(pkg.id for pkg in pkgs)
+            by_name = dict((pkg.name, (pkg, certificates.get(pkg.id)))
+                           for pkg in pkgs)
+
+        packages = {}
+        for url, name in names.iteritems():
+            if name in by_name:
+                packages[url] = by_name[name]
+                continue
+            pkg = cls._get_package_from_url(url)
+            if not pkg:
+                continue
+            if storage == 'extras':
+                packages[url] = (pkg, pkg.extras.get('odi-certificate'))
+            else:
+                from ckanext.certificates.model import get_certificate
+                packages[url] = (pkg, get_certificate(pkg.id))
+        return packages
+
+    @classmethod
+    def _get_package_from_url(cls, url):
+        """
+        Pulls data from the entry in an attempt to find a local package,
+        which, if successful is returned.  None is returned if the package
+        has been deleted, or is not a package for this site.
+        """
+        import ckan.model as model
+
+        from ckanext.certificates.site_url import package_name_from_url
+
+        name = package_name_from_url(url)
+        return model.Package.get(name)
+
+
+def page_ranges(first_url, page_count, workers):
+    """
+    Splits the page_count pages of the feed starting at first_url into
+    ranges of consecutive pages, as even as they can be, one for each
+    worker but no more than there are pages. Returns a list of (URL of the
+    first page, number of pages).
+    """
+    import ckanext.certificates.client as client
+    workers = max(min(workers, page_count), 1)
+    ranges = []
+    for worker in range(workers):
+        start = 1 + page_count * worker / workers
+        end = 1 + page_count * (worker + 1) / workers
+        ranges.append((client.set_url_parameter(first_url, 'page', start),
+                       end - start))
+    return ranges
+
+
+def merge_shard_results(results):
+    """
+    Merges the (stats, entry ids, timings) returned by the _fetch_shard of
+    each worker. The timings are added to the active instrumentation.
+    Returns the merged stats, and the number of entries that more than one
+    worker processed.
+    """
+    from ckanext.certificates import instrumentation
+    from running_stats import StatsList
+    stats = StatsList(max_values=STATS_EXAMPLES)
+    seen = set()
+    duplicates = 0
+    for shard_stats, entry_ids, timings in results:
+        stats.merge(shard_stats)
+        duplicates += len(seen.intersection(entry_ids))
+        seen.update(entry_ids)
+        if timings is not None and instrumentation.enabled():
+            instrumentation.active().merge(timings)
+    return stats, duplicates
+
+
+def _fetch_shard(shard):
+    """
+    Runs CertificateFetcher.fetch over a range of pages of the feed, in a
+    worker process of CertificateFetcher.fetch_sharded. Returns the stats
+    and the ids of the entries processed, and the timings if
+    instrumentation is enabled.
+    """
+    import ckanext.certificates.client as client
+    from ckanext.certificates import instrumentation
+    site_url_filter, url, pages, fetch_options = shard
+    entry_ids = []
+    if instrumentation.enabled():
+        # Start afresh rather than with the parent's timings
+        instrumentation.enable()
+
+    def entries():
+        for entry in client.generate_entries(url=url, max_pages=pages):
+            entry_ids.append(entry['id'])
+            yield entry
+    stats = CertificateFetcher.fetch(site_url_filter, None,
+                                     entries=entries(), report=False,
+                                     **fetch_options)
+    return stats, entry_ids, instrumentation.active()
+
+
+class CertificateWriter(object):
+    """
+    Writes changed certificates to the package extras and/or the
+    certificate table, depending on storage (see model.py). Changes are
+    held until batch_size of them have built up, or the first has been
+    waiting for interval seconds, and then written with a single commit -
+    under one revision for the extras, and as a bulk upsert for the table.
+    If the commit fails, just that batch is rolled back.
+
+    Stats are only recorded for a certificate once its batch has been
+    committed (or rolled back), or when a later one for the same package
+    replaces it in the batch. failed_batches counts the batches rolled
+    back.
+    """
+
+    def __init__(self, batch_size=1, interval=DEFAULT_COMMIT_INTERVAL,
+                 stats=None, storage='extras'):
+        self.batch_size = max(batch_size, 1)
+        self.interval = interval
+        self.stats = stats
+        self.storage = storage
+        self.failed_batches = 0
+        # {package id: (package, certificate JSON, operation, description)}
+        self._pending = OrderedDict()
+        self._pending_since = None
+
+    def add(self, pkg, badge_json, operation, description):
+        if not self._pending:
+            self._pending_since = time.time()
+        if pkg.id in self._pending:
+            # Seen twice in one batch - the latest certificate wins, but it
+            # is still the same change to the package
+            superseded = self._pending[pkg.id]
+            operation = superseded[2]
+            log = logging.getLogger(__name__)
+            log.debug(self.stats.add('Certificate superseded in batch',
+                                     superseded[3]))
+        self._pending[pkg.id] = (pkg, badge_json, operation, description)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        if self._pending and self.interval is not None and \
+                time.time() - self._pending_since >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the pending changes. Returns False if they were rolled back.
+        """
+        import ckan.model as model
+        log = logging.getLogger(__name__)
+        if not self._pending:
+            return True
+        pending = self._pending.values()
+        self._pending = OrderedDict()
+        from ckanext.certificates import instrumentation
+        try:
+            with instrumentation.timer('db_commit'):
+                if self.storage != 'table':
+                    model.repo.new_revision()
+                    for pkg, badge_json, operation, description in pending:
+                        pkg.extras['odi-certificate'] = badge_json
+                if self.storage != 'extras':
+                    from ckanext.certificates.model import \
+                        upsert_certificates
+                    upsert_certificates(dict(
+                        (pkg.id, json.loads(badge_json))
+                        for pkg, badge_json, operation, description
+                        in pending))
+                model.Session.commit()
+        except Exception, e:
+            log.exception(e)
+            model.Session.rollback()
+            self.failed_batches += 1
+            for pkg, badge_json, operation, description in pending:
+                log.error(self.stats.add(
+                    'Error writing certificate - rolled back', description))
+            return False
+        from ckanext.certificates.certificate_index import get_index
+        index = get_index()
+        for pkg, badge_json, operation, description in pending:
+            index.update(pkg.id, badge_json)
+            log.debug(self.stats.add('Certificate %s' % operation,
+                                     description))
+        return True
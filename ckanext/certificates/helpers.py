@@ -1,18 +1,199 @@
 import json
+import threading
+from collections import OrderedDict
+
+from paste.deploy.converters import asbool
+from pylons import config
+
+DEFAULT_CACHE_SIZE = 1000
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    """
+    A thread-safe dictionary of a bounded size, which discards the least
+    recently used items when it is full. It counts hits and misses.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+
+_certificate_cache = None
+
+
+def _use_index():
+    return asbool(config.get('ckanext.certificates.use_index', False))
+
+
+def get_certificate_cache():
+    """
+    Returns the cache of parsed certificates, which is sized by the
+    ckanext.certificates.helper_cache_size option.
+    """
+    global _certificate_cache
+    if _certificate_cache is None:
+        _certificate_cache = LRUCache(int(config.get(
+            'ckanext.certificates.helper_cache_size', DEFAULT_CACHE_SIZE)))
+    return _certificate_cache
+
+
+def parse_certificate(package_id, certificate_json):
+    """
+    Returns the dictionary parsed from a package's odi-certificate extra,
+    or None if it is missing or invalid. Results are cached by package id
+    and the JSON itself, so a changed certificate is parsed afresh. The
+    cached dictionary is returned, so don't change it.
+    """
+    if certificate_json is None:
+        return None
+    cache = get_certificate_cache()
+    key = (package_id, certificate_json)
+    data = cache.get(key, _MISSING)
+    if data is _MISSING:
+        try:
+            data = json.loads(certificate_json)
+        except ValueError:
+            data = None
+        cache.set(key, data)
+    return data
+
+
+def _use_table():
+    from ckanext.certificates.model import uses_table
+    return uses_table(config)
+
 
 def has_certificate(pkg):
     """
     Can be used in the template to determine if the package has a
     certificate. Returns a boolean.
     """
-    return 'odi-certificate' in pkg.extras and get_certificate_data(pkg) is not None
+    if _use_index() and getattr(pkg, 'id', None):
+        from ckanext.certificates.certificate_index import get_index
+        return get_index().get(pkg.id) is not None
+    if _use_table():
+        from ckanext.certificates.model import get_certificate
+        return get_certificate(pkg.id) is not None
+    return parse_certificate(getattr(pkg, 'id', None),
+                             pkg.extras.get('odi-certificate')) is not None
+
+def _with_local_badge(data):
+    """
+    Points the badge_url of certificate data at the local copy of the
+    image, if there is one (see badge_images.py).
+    """
+    if data:
+        _with_local_badges([data])
+    return data
+
+
+def _with_local_badges(certificates):
+    """
+    As _with_local_badge, for a list of certificate data, with a single
+    lookup.
+    """
+    from ckanext.certificates.badge_images import local_badge_urls
+    local_urls = local_badge_urls(data.get('badge_url')
+                                  for data in certificates)
+    if local_urls:
+        for data in certificates:
+            data['badge_url'] = local_urls.get(data.get('badge_url'),
+                                               data.get('badge_url'))
+
 
 def get_certificate_data(pkg):
     """
     Returns the dictionary containing information about the certificate for the
     given package
     """
-    try:
-        return json.loads(pkg.extras.get('odi-certificate'))
-    except ValueError:
-        return None
+    if _use_table():
+        from ckanext.certificates.model import get_certificate
+        return _with_local_badge(get_certificate(pkg.id))
+    data = parse_certificate(getattr(pkg, 'id', None),
+                             pkg.extras.get('odi-certificate'))
+    return _with_local_badge(dict(data)) if data is not None else None
+
+
+def get_certificate_summary(pkg):
+    """
+    Returns a dictionary with the level, certification_type, source,
+    badge_url and certificate_url of the package's certificate, or None.
+    It comes from the in-process certificate index, so it doesn't need the
+    package's extras. pkg is a package object, package dict or id.
+    """
+    from ckanext.certificates.certificate_index import get_index
+    if isinstance(pkg, dict):
+        package_id = pkg['id']
+    else:
+        package_id = getattr(pkg, 'id', pkg)
+    summary = get_index().get(package_id)
+    return _with_local_badge(summary.as_dict()) if summary else None
+
+
+def get_certificates_for_packages(packages):
+    """
+    Returns a dictionary of package id: certificate data for those of the
+    given packages that have a certificate, using a single query. This is
+    for listing and search pages, which would otherwise load the extras of
+    every package. packages is a list of package ids or package dicts.
+    Certificates are read from the certificate table if that is where they
+    are stored (see model.py), and otherwise from the extras.
+
+    Like the other helpers, it trusts that the packages are ones the user
+    may see, as those of a listing are.
+    """
+    import ckan.model as model
+
+    ids = set(pkg['id'] if isinstance(pkg, dict) else pkg
+              for pkg in packages)
+    if not ids:
+        return {}
+    if _use_table():
+        from ckanext.certificates.model import get_certificates
+        certificates = get_certificates(ids)
+        _with_local_badges(certificates.values())
+        return certificates
+    extra = model.PackageExtra
+    query = model.Session.query(extra.package_id, extra.value) \
+        .filter(extra.package_id.in_(ids)) \
+        .filter(extra.key == 'odi-certificate') \
+        .filter(extra.state == 'active')
+    certificates = {}
+    for package_id, certificate_json in query:
+        data = parse_certificate(package_id, certificate_json)
+        if data is not None:
+            certificates[package_id] = dict(data)
+    _with_local_badges(certificates.values())
+    return certificates
@@ -0,0 +1,248 @@
+'''Timings and counts for the phases of fetching certificates.
+
+Instrumentation is off unless enabled, e.g. by fetch_certs --profile. The
+hot paths call the module-level timer() and count(), which do next to
+nothing until then.
+
+Example:
+
+from ckanext.certificates import instrumentation
+instrumentation.enable()
+with instrumentation.timer('badge_http'):
+    response = http_get(url)
+instrumentation.count('badge_bytes', len(response.content))
+print instrumentation.active().report()
+> badge_http: 1 calls, total 0.120s, p50 120.0ms, p95 120.0ms, max 120.0ms
+> badge_bytes: 1234
+'''
+
+import json
+import math
+import random
+import threading
+import time
+
+# The phases timed, in the order they happen
+PHASES = ('feed_http', 'feed_parse', 'package_lookup', 'badge_http',
+          'db_commit')
+# Durations kept per phase for the percentiles. Beyond this many calls they
+# are a reservoir sample, so a long-running daemon's memory stays bounded.
+MAX_SAMPLES = 1000
+
+
+class PhaseTimings(object):
+    '''The count, total and max of the durations of the calls in a phase,
+    and a sample of no more than max_samples of them.'''
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.max_samples = max_samples
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+        self.samples = []
+
+    def __len__(self):
+        return self.count
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        if len(self.samples) < self.max_samples:
+            self.samples.append(seconds)
+        else:
+            i = random.randrange(self.count)
+            if i < self.max_samples:
+                self.samples[i] = seconds
+
+    def merge(self, other):
+        '''Adds in another PhaseTimings. The merged sample is drawn from
+        the two samples, in proportion to the calls each stands for.'''
+        count = self.count + other.count
+        if len(self.samples) + len(other.samples) <= self.max_samples:
+            self.samples = self.samples + other.samples
+        elif count:
+            mine = int(round(self.max_samples * self.count / float(count)))
+            mine = min(max(mine, self.max_samples - len(other.samples)),
+                       len(self.samples))
+            self.samples = random.sample(self.samples, mine) + \
+                random.sample(other.samples,
+                              min(self.max_samples - mine,
+                                  len(other.samples)))
+        self.count = count
+        self.total += other.total
+        if other.max is not None:
+            self.max = other.max if self.max is None \
+                else max(self.max, other.max)
+
+    def summary(self):
+        samples = sorted(self.samples)
+        return {
+            'count': self.count,
+            'total': self.total,
+            'p50': percentile(samples, 50),
+            'p95': percentile(samples, 95),
+            'max': self.max,
+        }
+
+
+class Instrumentation(object):
+    '''Collects the durations of the calls in each phase, and counters,
+    from any number of threads.'''
+
+    def __init__(self):
+        self.timings = {}   # {phase: PhaseTimings}
+        self.counters = {}  # {name: value}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return self.timings, self.counters
+
+    def __setstate__(self, state):
+        self.timings, self.counters = state
+        self._lock = threading.Lock()
+
+    def timer(self, phase):
+        return _Timer(self, phase)
+
+    def record(self, phase, seconds):
+        with self._lock:
+            if phase not in self.timings:
+                self.timings[phase] = PhaseTimings()
+            self.timings[phase].add(seconds)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other):
+        '''Adds in the timings and counters of another Instrumentation, e.g.
+        one from another process.'''
+        with self._lock:
+            for phase, timings in other.timings.iteritems():
+                if phase not in self.timings:
+                    self.timings[phase] = PhaseTimings()
+                self.timings[phase].merge(timings)
+            for name, value in other.counters.iteritems():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        '''Returns a dictionary of the count, total, p50, p95 and max
+        seconds of each phase, and of the counters. The percentiles are of
+        a sample of the calls, once there are more than MAX_SAMPLES.'''
+        phases = dict((phase, timings.summary())
+                      for phase, timings in self.timings.iteritems())
+        return {'phases': phases, 'counters': dict(self.counters)}
+
+    def report(self, indent=1):
+        summary = self.summary()
+        indent_str = '\t' * indent
+        lines = []
+        for phase in _ordered(summary['phases']):
+            timing = summary['phases'][phase]
+            lines.append(indent_str + '%s: %i calls, total %.3fs, '
+                         'p50 %.1fms, p95 %.1fms, max %.1fms' % (
+                             phase, timing['count'], timing['total'],
+                             timing['p50'] * 1000, timing['p95'] * 1000,
+                             timing['max'] * 1000))
+        for name, value in sorted(summary['counters'].iteritems()):
+            lines.append(indent_str + '%s: %s' % (name, value))
+        if not lines:
+            lines = [indent_str + 'None']
+        return '\n'.join(lines)
+
+    def statsd_lines(self, prefix='ckanext.certificates'):
+        '''Returns the summary as StatsD-style lines: timings in
+        milliseconds as gauges, e.g. "prefix.badge_http.p95:12.5|g", and
+        counters as counts.'''
+        summary = self.summary()
+        lines = []
+        for phase in _ordered(summary['phases']):
+            for stat, value in sorted(summary['phases'][phase].iteritems()):
+                if stat != 'count':
+                    value = round(value * 1000, 3)
+                lines.append('%s.%s.%s:%s|g' % (prefix, phase, stat, value))
+        for name, value in sorted(summary['counters'].iteritems()):
+            lines.append('%s.%s:%s|c' % (prefix, name, value))
+        return lines
+
+    def write(self, path):
+        '''Writes the summary to a file: as JSON if its name ends in .json,
+        or otherwise as StatsD-style lines.'''
+        with open(path, 'w') as f:
+            if path.endswith('.json'):
+                json.dump(self.summary(), f, indent=2, sort_keys=True)
+            else:
+                f.write('\n'.join(self.statsd_lines()) + '\n')
+
+
+class _Timer(object):
+    __slots__ = ('instrumentation', 'phase', 'start')
+
+    def __init__(self, instrumentation, phase):
+        self.instrumentation = instrumentation
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.record(self.phase, time.time() - self.start)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NULL_TIMER = _NullTimer()
+_active = None
+
+
+def percentile(sorted_values, percent):
+    '''Returns the nearest-rank percentile of a sorted list.'''
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def _ordered(phases):
+    return sorted(phases, key=lambda phase: (
+        PHASES.index(phase) if phase in PHASES else len(PHASES), phase))
+
+
+def enable():
+    '''Starts collecting, into a new Instrumentation, which is returned.'''
+    global _active
+    _active = Instrumentation()
+    return _active
+
+
+def disable():
+    global _active
+    _active = None
+
+
+def enabled():
+    return _active is not None
+
+
+def active():
+    '''Returns the Instrumentation being collected into, or None.'''
+    return _active
+
+
+def timer(phase):
+    '''Returns a context manager that times a call in the phase.'''
+    if _active is None:
+        return _NULL_TIMER
+    return _active.timer(phase)
+
+
+def count(name, value=1):
+    if _active is not None:
+        _active.count(name, value)
@@ -0,0 +1,63 @@
+import ckan.plugins.toolkit as toolkit
+
+import ckanext.certificates.helpers as helpers
+
+MAX_PACKAGES = 1000
+
+
+@toolkit.side_effect_free
+def certificates_for_packages(context, data_dict):
+    '''
+    Returns the ODI certificates of a list of datasets, e.g. all those on a
+    page of search results, in a single query.
+
+    :param ids: the ids of the datasets (a list, or comma separated string)
+    :type ids: list of strings
+
+    :returns: a dictionary of dataset id to certificate, for those datasets
+        that have one and that the user can see - deleted datasets, and
+        private ones the user can't read, are left out. Each certificate is
+        a dictionary with keys including level, badge_url, certificate_url
+        and source.
+    :rtype: dictionary
+    '''
+    toolkit.check_access('certificates_for_packages', context, data_dict)
+
+    ids = data_dict.get('ids')
+    if isinstance(ids, basestring):
+        ids = [id_.strip() for id_ in ids.split(',') if id_.strip()]
+    if not ids or not isinstance(ids, list):
+        raise toolkit.ValidationError({'ids': ['Missing value']})
+    if len(ids) > MAX_PACKAGES:
+        raise toolkit.ValidationError(
+            {'ids': ['No more than %d ids are allowed' % MAX_PACKAGES]})
+
+    return helpers.get_certificates_for_packages(_readable_ids(context, ids))
+
+
+def _readable_ids(context, ids):
+    '''
+    Returns those of the package ids of active packages that the user can
+    read. Only private packages need their access checking, one by one.
+    '''
+    import ckan.model as model
+    packages = model.Session.query(model.Package.id, model.Package.private) \
+        .filter(model.Package.id.in_(set(ids))) \
+        .filter(model.Package.state == 'active')
+    readable = []
+    for package_id, private in packages:
+        if private:
+            try:
+                toolkit.check_access('package_show', dict(context),
+                                     {'id': package_id})
+            except toolkit.NotAuthorized:
+                continue
+        readable.append(package_id)
+    return readable
+
+
+@toolkit.auth_allow_anonymous_access
+def certificates_for_packages_auth(context, data_dict):
+    # Certificates are published openly by the ODI. The action itself
+    # leaves out those of datasets the user can't see.
+    return {'success': True}
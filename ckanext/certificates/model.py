@@ -0,0 +1,257 @@
+'''The certificate table, an alternative to storing each certificate as JSON
+in its package's odi-certificate extra.
+
+ckanext.certificates.storage chooses where certificates are stored:
+
+  extras  in the odi-certificate extra of each package (the default)
+  table   in the certificate table
+  both    in the certificate table, with the extras kept up to date too,
+          for anything else that still reads them
+
+The table has a row for each package with a certificate, and a column for
+each field of the certificate, so reading one needs no JSON parsing, and
+writing one doesn't make a package revision. Create it with
+"paster certificates initdb" and copy the certificates already in the
+extras into it with "paster certificates migrate".
+'''
+
+import json
+
+log = __import__('logging').getLogger(__name__)
+
+STORAGE_OPTIONS = ('extras', 'table', 'both')
+DEFAULT_STORAGE = 'extras'
+
+# The fields of a certificate, as given by client.get_badge_data and
+# CertificateFetcher._store_certificate, each a column of the table
+FIELDS = ('level', 'certification_type', 'status', 'created_at',
+          'jurisdiction', 'title', 'source', 'cert_title', 'badge_url',
+          'certificate_url', 'feed_updated')
+# Columns used to filter or sort certificates
+INDEXED_FIELDS = ('level', 'certification_type', 'status', 'created_at')
+
+certificate_table = None
+
+
+def get_storage(config=None):
+    '''Returns the ckanext.certificates.storage option.'''
+    if config is None:
+        from pylons import config
+    storage = config.get('ckanext.certificates.storage') or DEFAULT_STORAGE
+    if storage not in STORAGE_OPTIONS:
+        raise ValueError('ckanext.certificates.storage must be one of %s, '
+                         'not %r' % (', '.join(STORAGE_OPTIONS), storage))
+    return storage
+
+
+def uses_table(config=None):
+    '''Whether certificates are read from the certificate table.'''
+    return get_storage(config) != 'extras'
+
+
+def define_tables(metadata=None):
+    '''Defines the certificate table, on CKAN's metadata by default.'''
+    global certificate_table
+    if certificate_table is not None:
+        return certificate_table
+    from sqlalchemy import Column, ForeignKey, Index, Table, types
+    if metadata is None:
+        from ckan.model.meta import metadata
+    certificate_table = Table(
+        'certificate', metadata,
+        # the row goes when its package is purged
+        Column('package_id', types.UnicodeText,
+               ForeignKey('package.id', ondelete='CASCADE'),
+               primary_key=True),
+        *[Column(field, types.UnicodeText) for field in FIELDS])
+    for field in INDEXED_FIELDS:
+        Index('idx_certificate_%s' % field, certificate_table.c[field])
+    return certificate_table
+
+
+def init_tables(engine=None):
+    '''Creates the certificate table, unless it exists already.'''
+    if engine is None:
+        import ckan.model as model
+        engine = model.meta.engine
+    table = define_tables()
+    table.create(bind=engine, checkfirst=True)
+    log.info('Certificate table is set up')
+
+
+def _session(session):
+    if session is None:
+        import ckan.model as model
+        session = model.Session
+    return session
+
+
+def certificate_row(package_id, certificate):
+    '''Returns the table row for a certificate dictionary.'''
+    row = dict((field, certificate.get(field)) for field in FIELDS)
+    row['package_id'] = package_id
+    return row
+
+
+def row_certificate(row):
+    '''Returns the certificate dictionary for a table row.'''
+    return dict((field, row[field]) for field in FIELDS)
+
+
+def certificate_json(certificate):
+    '''
+    Returns a certificate dictionary as JSON, with its keys sorted, so that
+    the same certificate always gives the same JSON.
+    '''
+    return json.dumps(certificate, sort_keys=True)
+
+
+def get_certificates(package_ids, session=None):
+    '''
+    Returns a dictionary of package id: certificate dictionary for those of
+    the packages that have a certificate, in one query.
+    '''
+    from sqlalchemy import select
+    table = define_tables()
+    package_ids = set(package_ids)
+    if not package_ids:
+        return {}
+    rows = _session(session).execute(
+        select([table], table.c.package_id.in_(package_ids)))
+    return dict((row['package_id'], row_certificate(row)) for row in rows)
+
+
+def get_certificate(package_id, session=None):
+    '''Returns the certificate dictionary of a package, or None.'''
+    return get_certificates([package_id], session=session).get(package_id)
+
+
+def iter_certificates(active_only=True, batch_size=1000, session=None):
+    '''
+    Yields (package id, certificate dictionary) for every certificate in
+    the table, of active packages only by default.
+    '''
+    from sqlalchemy import select
+    import ckan.model as model
+    table = define_tables()
+    query = select([table])
+    if active_only:
+        package = model.package_table
+        query = query.select_from(
+            table.join(package, package.c.id == table.c.package_id)) \
+            .where(package.c.state == 'active')
+    result = _session(session).execute(query)
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            return
+        for row in rows:
+            yield row['package_id'], row_certificate(row)
+
+
+def upsert_certificates(certificates, session=None):
+    '''
+    Writes certificates, a dictionary of package id: certificate
+    dictionary, to the table, updating the rows of those packages that
+    have one already and inserting the rest. However many there are, this
+    is one query to find the existing rows, one executemany of updates and
+    one of inserts. If another process inserts some of the same rows in
+    between, e.g. another worker of fetch_sharded, the inserts are retried
+    one by one, as updates where they now exist. It doesn't commit.
+    '''
+    from sqlalchemy import select
+    if not certificates:
+        return
+    table = define_tables()
+    session = _session(session)
+    existing = set(row[0] for row in session.execute(
+        select([table.c.package_id],
+               table.c.package_id.in_(set(certificates)))))
+    updates = []
+    inserts = []
+    for package_id, certificate in certificates.iteritems():
+        row = certificate_row(package_id, certificate)
+        if package_id in existing:
+            updates.append(_update_params(row))
+        else:
+            inserts.append(row)
+    if updates:
+        session.execute(_update_statement(table), updates)
+    if inserts and not _insert(session, table, inserts):
+        for row in inserts:
+            if not _insert(session, table, row):
+                session.execute(_update_statement(table),
+                                _update_params(row))
+
+
+def _insert(session, table, rows):
+    '''
+    Inserts the rows, within a savepoint so that if one exists already
+    the rest of the transaction carries on. Returns whether they were
+    inserted.
+    '''
+    from sqlalchemy.exc import IntegrityError
+    savepoint = session.begin_nested()
+    try:
+        session.execute(table.insert(), rows)
+    except IntegrityError:
+        savepoint.rollback()
+        return False
+    savepoint.commit()
+    return True
+
+
+def _update_statement(table):
+    from sqlalchemy import bindparam
+    return table.update() \
+        .where(table.c.package_id == bindparam('_package_id'))
+
+
+def _update_params(row):
+    params = dict(row)
+    params['_package_id'] = params.pop('package_id')
+    return params
+
+
+def migrate_extras(batch_size=1000):
+    '''
+    Copies the certificates in the odi-certificate extras of the packages
+    into the table, committing every batch_size of them. Certificates in
+    the table already are replaced. Returns the number copied and the
+    number that couldn't be read.
+    '''
+    import ckan.model as model
+    extra = model.PackageExtra
+    extras = model.Session.query(extra.package_id, extra.value) \
+        .filter(extra.key == 'odi-certificate') \
+        .filter(extra.state == 'active') \
+        .order_by(extra.package_id)
+    # Read the extras a batch at a time, keyed on package id, so that the
+    # commits don't interrupt the reading
+    copied = invalid = 0
+    last_id = None
+    while True:
+        query = extras
+        if last_id is not None:
+            query = query.filter(extra.package_id > last_id)
+        batch = query.limit(batch_size).all()
+        if not batch:
+            break
+        certificates = {}
+        for package_id, value in batch:
+            try:
+                certificate = json.loads(value)
+            except ValueError:
+                certificate = None
+            if not isinstance(certificate, dict):
+                log.warning('Invalid certificate for package %s - not '
+                            'migrated', package_id)
+                invalid += 1
+                continue
+            certificates[package_id] = certificate
+        upsert_certificates(certificates)
+        model.Session.commit()
+        copied += len(certificates)
+        last_id = batch[-1][0]
+        log.info('Migrated %s certificates', copied)
+    return copied, invalid
@@ -14,6 +14,11 @@ class CertificatesPlugin(p.SingletonPlugin):
     available.
     '''
     p.implements(p.ITemplateHelpers, inherit=True)
+    p.implements(p.IActions)
+    p.implements(p.IAuthFunctions)
+    p.implements(p.IPackageController, inherit=True)
+    p.implements(p.IDomainObjectModification, inherit=True)
+    p.implements(p.IRoutes, inherit=True)
 
     def get_helpers(self):
         """
@@ -26,5 +31,67 @@ class CertificatesPlugin(p.SingletonPlugin):
             'is_certificates_installed': lambda: True,
             'has_certificate': helpers.has_certificate,
             'get_certificate_data': helpers.get_certificate_data,
+            'get_certificates_for_packages':
+                helpers.get_certificates_for_packages,
+            'get_certificate_summary': helpers.get_certificate_summary,
         }
         return helper_dict
+
+    def get_actions(self):
+        import ckanext.certificates.logic as logic
+        return {
+            'certificates_for_packages': logic.certificates_for_packages,
+        }
+
+    def get_auth_functions(self):
+        import ckanext.certificates.logic as logic
+        return {
+            'certificates_for_packages':
+                logic.certificates_for_packages_auth,
+        }
+
+    def before_map(self, map):
+        """
+        Serves the local copies of the badge images (see badge_images.py).
+        """
+        map.connect('certificate_badge_image',
+                    '/certificates/badge/{image_hash}.png',
+                    controller='ckanext.certificates.controller:'
+                               'BadgeImageController',
+                    action='image')
+        return map
+
+    def before_index(self, pkg_dict):
+        """
+        Adds the certificate level, type, status and creation date to the
+        search index, so they can be used as filters and facets.
+        """
+        from ckanext.certificates.model import certificate_json, \
+            get_certificate, uses_table
+        from ckanext.certificates.search import index_fields
+        if uses_table():
+            certificate = get_certificate(pkg_dict['id'])
+            pkg_dict.update(index_fields(certificate and
+                                         certificate_json(certificate)))
+        else:
+            pkg_dict.update(
+                index_fields(pkg_dict.get('extras_odi-certificate')))
+        return pkg_dict
+
+    def notify(self, entity, operation):
+        """
+        Keeps the in-process certificate index up to date as packages
+        change.
+        """
+        import ckan.model as model
+        from ckanext.certificates.certificate_index import get_index
+        from ckanext.certificates.model import get_storage
+        if not isinstance(entity, model.Package):
+            return
+        if entity.state != 'active':
+            get_index().update(entity.id, None)
+        elif get_storage() != 'table':
+            get_index().update(entity.id,
+                               entity.extras.get('odi-certificate'))
+        # else the certificate isn't in the package, and only changes when
+        # the CertificateWriter updates the index
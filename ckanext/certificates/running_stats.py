@@ -3,6 +3,7 @@ of objects.
 
 StatsCount - when you are counting incidences of a small set of outcomes
 StatsList - when you also want to remember an ID associated with each incidence
+            (or, for a large number of them, a sample of the IDs)
 
 Examples:
 
@@ -30,9 +31,16 @@ print package_stats.report()
 > deleted: 30 pollution-uk, flood-regions, river-quality, ...
 > not deleted: 70 spending-bristol, ... 
 
+For a large number of objects, keep exact counts but only a sample of the
+IDs, and leave formatting them until they are reported:
+package_stats = StatsList(max_values=100, sampling='reservoir')
+for package in packages:
+    log.debug(package_stats.add('seen', '%s (%s)', package.name, package.id))
+
 '''
 
 import copy
+import random
 
 class StatsCount(dict):
     # {category:count}
@@ -47,6 +55,13 @@ class StatsCount(dict):
         self._init_category(category)
         self[category] += 1
 
+    def merge(self, other):
+        '''Adds in the stats from another object of the same type, e.g. one
+        from another process.'''
+        for category, value in other.iteritems():
+            self._init_category(category)
+            self[category] += value
+
     def report_value(self, category):
         '''Returns the value for a category and value to sort categories by.'''
         value = repr(self[category])
@@ -78,19 +93,114 @@ class StatsList(StatsCount):
     # {category:[values]}
     _init_value = []
 
-    def add(self, category, value):
-        self._init_category(category)
-        self[category].append(value)
-        return '%s: %s' % (category, value) # so you can log it too
+    def __init__(self, max_values=None, sampling='first'):
+        '''max_values - keep no more than this many values per category,
+                     though all of them are counted
+        sampling - which values to keep, once there are more than
+                   max_values: 'first' keeps the first ones, and 'reservoir'
+                   keeps a random sample of all of them'''
+        super(StatsList, self).__init__()
+        assert sampling in ('first', 'reservoir')
+        self.max_values = max_values
+        self.sampling = sampling
+        self.counts = StatsCount()
+
+    def add(self, category, value, *args):
+        '''Records a value for the category. If args are given, the value
+        is a format string for them, which is only formatted if it is
+        reported or logged. Returns the category and value, as a message
+        that can be logged.'''
+        if category in self.counts:
+            self.counts[category] += 1
+        else:
+            self._init_category(category)
+            self.counts[category] = 1
+        values = self[category]
+        if self.max_values is None or len(values) < self.max_values:
+            values.append(LazyMessage(value, args) if args else value)
+        elif self.sampling == 'reservoir':
+            i = random.randrange(self.counts[category])
+            if i < self.max_values:
+                values[i] = LazyMessage(value, args) if args else value
+        # so you can log it too
+        if args:
+            return LazyMessage('%s: ' + value, (category,) + args)
+        return LazyMessage('%s: %s', (category, value))
+
+    def count(self, category):
+        '''Returns the number of values added to the category, including
+        any that weren't kept.'''
+        return self.counts.get(category, 0)
+
+    def merge(self, other):
+        '''Adds in the stats from another StatsList. If values are being
+        sampled, the merged sample is drawn from the two samples.'''
+        for category, values in other.iteritems():
+            self._init_category(category)
+            self.counts[category] = self.count(category) + \
+                other.count(category)
+            merged = self[category] + values
+            if self.max_values is not None and \
+                    len(merged) > self.max_values:
+                if self.sampling == 'reservoir':
+                    merged = random.sample(merged, self.max_values)
+                else:
+                    merged = merged[:self.max_values]
+            self[category] = merged
 
     def report_value(self, category):
-        value = self[category]
-        number_of_values = len(value)
-        value_str = '%i %r' % (number_of_values, value)
+        number_of_values = self.count(category)
+        # Only format as many values as will be shown
+        values = self[category]
+        value_str = '%i [' % number_of_values
+        for i, value in enumerate(values):
+            if len(value_str) > self.report_value_limit:
+                break
+            value_str += (', ' if i else '') + repr(value)
+        else:
+            if len(values) == number_of_values:
+                value_str += ']'
+            elif len(value_str) <= self.report_value_limit:
+                # Some values weren't kept
+                value_str += '...'
         if len(value_str) > self.report_value_limit:
             value_str = value_str[:self.report_value_limit] + '...'
         return (value_str, number_of_values)
 
+
+class LazyMessage(object):
+    '''A message that is only formatted when it is converted to a string,
+    e.g. when it is logged.'''
+    __slots__ = ('format', 'args')
+
+    def __init__(self, format, args):
+        self.format = format
+        self.args = args
+
+    def __unicode__(self):
+        return unicode(self.format) % self.args
+
+    def __str__(self):
+        message = self.format % self.args
+        if isinstance(message, unicode):
+            message = message.encode('utf8')
+        return message
+
+    def __repr__(self):
+        return repr(self.format % self.args)
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        return self.format, self.args
+
+    def __setstate__(self, state):
+        self.format, self.args = state
+
 if __name__ == '__main__':
     package_stats = StatsList()
     package_stats.add('Success', 'good1')
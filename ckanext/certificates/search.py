@@ -0,0 +1,129 @@
+'''Indexing of certificate data into the search index.
+
+CertificatesPlugin.before_index adds fields extracted from a package's
+odi-certificate extra (or its row of the certificate table - see model.py),
+so that datasets can be filtered and faceted by certificate level etc.
+without loading every package:
+
+  certificate_level       e.g. pilot
+  certificate_type        e.g. self certified
+  certificate_status      e.g. published
+  certificate_created_at  e.g. 2014-01-01T00:00:00Z (sorts as a string)
+  certificate_hash        identifies the certificate JSON that was indexed
+
+e.g. package_search with fq=certificate_level:(pilot OR standard OR expert)
+'''
+
+import hashlib
+import json
+
+log = __import__('logging').getLogger(__name__)
+
+# index field: certificate key
+INDEX_FIELDS = {
+    'certificate_level': 'level',
+    'certificate_type': 'certification_type',
+    'certificate_status': 'status',
+    'certificate_created_at': 'created_at',
+}
+
+
+def certificate_hash(certificate_json):
+    if isinstance(certificate_json, unicode):
+        certificate_json = certificate_json.encode('utf8')
+    return hashlib.md5(certificate_json).hexdigest()
+
+
+def index_fields(certificate_json):
+    '''
+    Returns the search index fields for a package's odi-certificate extra,
+    or an empty dictionary if there is no valid certificate.
+    '''
+    if not certificate_json:
+        return {}
+    try:
+        certificate = json.loads(certificate_json)
+    except ValueError:
+        return {}
+    if not isinstance(certificate, dict):
+        return {}
+    fields = dict((field, certificate[key])
+                  for field, key in INDEX_FIELDS.iteritems()
+                  if certificate.get(key))
+    fields['certificate_hash'] = certificate_hash(certificate_json)
+    return fields
+
+
+def reindex_changed_certificates(batch_size=100):
+    '''
+    Updates the search index for just those packages whose certificate has
+    changed since they were last indexed, by comparing the certificate_hash
+    in the index with that of the certificate in the database. Returns the
+    number of packages reindexed.
+    '''
+    import ckan.model as model
+    from ckan.lib import search
+    from ckanext.certificates.model import certificate_json as to_json, \
+        iter_certificates, uses_table
+
+    if uses_table():
+        certificates = ((package_id, to_json(certificate))
+                        for package_id, certificate
+                        in iter_certificates(batch_size=batch_size))
+    else:
+        extra = model.PackageExtra
+        certificates = model.Session.query(extra.package_id, extra.value) \
+            .join(model.Package, model.Package.id == extra.package_id) \
+            .filter(extra.key == 'odi-certificate') \
+            .filter(extra.state == 'active') \
+            .filter(model.Package.state == 'active') \
+            .yield_per(batch_size)
+
+    to_reindex = []
+    with_certificate = set()
+    batch = {}
+    for package_id, certificate_json in certificates:
+        with_certificate.add(package_id)
+        batch[package_id] = certificate_hash(certificate_json)
+        if len(batch) >= batch_size:
+            to_reindex.extend(_unindexed_hashes(batch))
+            batch = {}
+    if batch:
+        to_reindex.extend(_unindexed_hashes(batch))
+
+    # Packages indexed with a certificate they no longer have
+    to_reindex.extend(package_id
+                      for package_id in _search_ids('certificate_hash:[* TO *]')
+                      if package_id not in with_certificate)
+
+    for package_id in to_reindex:
+        log.debug('Reindexing %s', package_id)
+        search.rebuild(package_id, defer_commit=True)
+    search.commit()
+    return len(to_reindex)
+
+
+def _unindexed_hashes(hashes):
+    '''
+    Given a dictionary of package id: certificate hash, returns the ids of
+    the packages whose hash isn't in the index.
+    '''
+    indexed = set(_search_ids('certificate_hash:(%s)' %
+                              ' OR '.join(hashes.values())))
+    return [package_id for package_id in hashes
+            if package_id not in indexed]
+
+
+def _search_ids(fq, rows=1000):
+    '''Yields the ids of all the packages in the index matching fq.'''
+    from ckan.lib import search
+    start = 0
+    while True:
+        query = search.query_for('package')
+        query.run({'q': '*:*', 'fq': '+%s +capacity:*' % fq, 'fl': 'id',
+                   'rows': rows, 'start': start})
+        for result in query.results:
+            yield result['id'] if isinstance(result, dict) else result
+        start += rows
+        if start >= query.count:
+            return
@@ -0,0 +1,129 @@
+'''
+Decides whether a certificate's 'about' URL is a dataset on this site, and
+if so which one.
+
+A SiteUrlMatcher is configured with a list of site URLs, for when a
+catalogue has several hostnames, e.g. mirrors or old domains:
+
+ckanext.certificates.site_urls = https://data.gov.uk http://old.data.gov.uk/catalogue
+
+Each site URL is a host and an optional path prefix. Both http and https,
+and the host with or without 'www.', are accepted for each of them.
+'''
+import re
+import urlparse
+
+DATASET_PATH = '/dataset/'
+
+
+def get_site_url_matcher(config):
+    '''
+    Returns the matcher for the configuration: a RegexSiteUrlMatcher if
+    ckanext.certificates.site_url_regex is set, otherwise a SiteUrlMatcher
+    for ckanext.certificates.site_urls, or failing that the site_url or
+    ckan.site_url.
+    '''
+    site_url_regex = config.get('ckanext.certificates.site_url_regex')
+    if site_url_regex:
+        return RegexSiteUrlMatcher(site_url_regex)
+    site_urls = config.get('ckanext.certificates.site_urls', '').split() or \
+        [config.get('ckanext.certificates.site_url') or
+         config.get('ckan.site_url')]
+    return SiteUrlMatcher(site_urls)
+
+
+class SiteUrlMatcher(object):
+    '''
+    Matches URLs against a list of site URLs. The scheme and 'www.' of each
+    URL are normalized once, and its host is looked up in a dictionary of
+    the path prefixes of the sites on that host, so the cost doesn't grow
+    with the number of sites.
+    '''
+
+    def __init__(self, site_urls, dataset_path=DATASET_PATH):
+        self.site_urls = list(site_urls)
+        # {host: [site path + dataset path, longest first]}
+        self._prefixes = {}
+        # {host: [site path, longest first]}
+        self._site_prefixes = {}
+        for site_url in self.site_urls:
+            host, path = _split_url(site_url.strip())
+            if host is None:
+                raise ValueError('Site URL must start with http:// or '
+                                 'https://: %r' % site_url)
+            path = path.rstrip('/')
+            _add_prefix(self._prefixes, host, path + dataset_path)
+            _add_prefix(self._site_prefixes, host, path + '/')
+
+    def __repr__(self):
+        return 'SiteUrlMatcher(%r)' % self.site_urls
+
+    def match(self, url):
+        '''
+        Returns the name of the package if the url is of a dataset on one of
+        the sites, '' if it is on one of the sites but isn't a dataset, or
+        None if it isn't on any of them.
+        '''
+        host, path = _split_url(url)
+        prefixes = self._prefixes.get(host)
+        if prefixes is None:
+            return None
+        for prefix in prefixes:
+            if path.startswith(prefix):
+                # Package name is the last part of the URL
+                return path[len(prefix):].rstrip('/').rpartition('/')[2]
+        for site_prefix in self._site_prefixes[host]:
+            if path.startswith(site_prefix):
+                return ''
+        return None
+
+
+class RegexSiteUrlMatcher(object):
+    '''
+    Matches URLs which contain a match for a regular expression, as
+    configured with ckanext.certificates.site_url_regex.
+    '''
+
+    def __init__(self, regex, dataset_path=DATASET_PATH):
+        self.regex = re.compile(regex)
+        self.dataset_path = dataset_path
+
+    def __repr__(self):
+        return 'RegexSiteUrlMatcher(%r)' % self.regex.pattern
+
+    def match(self, url):
+        '''As SiteUrlMatcher.match.'''
+        if not self.regex.search(url):
+            return None
+        if self.dataset_path not in url:
+            return ''
+        return package_name_from_url(url)
+
+
+def _add_prefix(prefixes, host, prefix):
+    host_prefixes = prefixes.setdefault(host, [])
+    if prefix not in host_prefixes:
+        host_prefixes.append(prefix)
+        host_prefixes.sort(key=len, reverse=True)
+
+
+def package_name_from_url(url):
+    # Package name is the last part of the URL
+    return urlparse.urlparse(url).path.rstrip('/').split('/')[-1]
+
+
+# scheme, 'www.', host, path
+URL_PARTS = re.compile(r'(?i)https?://(?:www\.)?([^/?#]*)([^?#]*)')
+
+
+def _split_url(url):
+    '''
+    Returns the normalized host of an http or https URL, lower case and
+    without 'www.', and its path without any query or fragment. The host is
+    None for other URLs.
+    '''
+    match = URL_PARTS.match(url)
+    if match is None:
+        return None, ''
+    host, path = match.groups()
+    return host.lower(), path or '/'
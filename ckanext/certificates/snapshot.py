@@ -0,0 +1,117 @@
+'''Recording of the feed entries and badges of a fetch_certs run, to replay
+later without the network, e.g. to load a staging catalogue, or to repeat a
+run while tuning it.
+
+A snapshot is a gzipped file of JSON records, one per line:
+
+["entry", {...feed entry, as given by client.generate_entries...}]
+["badge", "https://.../certificate.json", {...badge, or null if it failed...}]
+
+Records are appended as the run goes, with each batch's badges following
+its entries, and a new run can append to an existing snapshot.
+'''
+
+import collections
+import gzip
+import io
+import json
+import threading
+
+log = __import__('logging').getLogger(__name__)
+
+# How many records to read ahead for a badge before giving up on it
+DEFAULT_LOOKAHEAD = 10000
+BUFFER_SIZE = 64 * 1024
+
+
+class SnapshotWriter(object):
+    '''Appends the entries and badges of a run to a snapshot file.'''
+
+    def __init__(self, path):
+        self.path = path
+        # Buffered, so that records are compressed in blocks rather than
+        # one at a time
+        self._file = io.BufferedWriter(gzip.open(path, 'ab', 6),
+                                       BUFFER_SIZE)
+        self._lock = threading.Lock()
+
+    def record_entries(self, entries):
+        '''Yields the entries, recording each one as it goes past.'''
+        for entry in entries:
+            self._write(['entry', dict(entry)])
+            yield entry
+
+    def record_badges(self, urls, badges):
+        '''Records the badge fetched from each url.'''
+        for url, badge in zip(urls, badges):
+            self._write(['badge', url, badge])
+
+    def close(self):
+        self._file.close()
+
+    def _write(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(line)
+
+
+class SnapshotReader(object):
+    '''
+    Replays a snapshot, streaming it from disk. It provides the entries to
+    CertificateFetcher.fetch, and stands in for its BadgeFetcher.
+
+    Badges are looked for further on in the file if they haven't been read
+    yet, holding on to the entries read past, up to lookahead records.
+    Badges read but not asked for, e.g. those of entries whose certificate
+    is already stored, are held for up to lookahead records too, so that
+    memory use doesn't grow with the size of the snapshot.
+    '''
+    workers = 1
+
+    def __init__(self, path, lookahead=DEFAULT_LOOKAHEAD):
+        self.path = path
+        self.lookahead = lookahead
+        self._file = io.BufferedReader(gzip.open(path, 'rb'), BUFFER_SIZE)
+        self._entries = collections.deque()
+        # {url: badge}, oldest first
+        self._badges = collections.OrderedDict()
+
+    def entries(self):
+        '''Yields the entries of the snapshot, in order.'''
+        while True:
+            while not self._entries:
+                if not self._read():
+                    return
+            yield self._entries.popleft()
+
+    def fetch(self, urls):
+        '''
+        Returns the recorded badge for each url, or None if it wasn't
+        recorded.
+        '''
+        badges = []
+        for url in urls:
+            read = 0
+            while url not in self._badges and read < self.lookahead and \
+                    self._read():
+                read += 1
+            if url not in self._badges:
+                log.warning('Badge not found in the snapshot: %s', url)
+            badges.append(self._badges.pop(url, None))
+        return badges
+
+    def close(self):
+        self._file.close()
+
+    def _read(self):
+        line = self._file.readline()
+        if not line:
+            return False
+        record = json.loads(line)
+        if record[0] == 'entry':
+            self._entries.append(record[1])
+        elif record[0] == 'badge':
+            self._badges[record[1]] = record[2]
+            if len(self._badges) > self.lookahead:
+                self._badges.popitem(last=False)
+        return True
@@ -0,0 +1,167 @@
+'''A stand-in for the parts of CKAN that the extension uses, for tests.
+
+installed() puts it in place of ckan.model and ckan.plugins.toolkit, with
+the package and package_extra tables on an in-memory SQLite database, and
+takes it away again afterwards, along with any module imported meanwhile.
+
+with fake_ckan.installed() as model:
+    fake_ckan.add_package('id1', 'dataset-1',
+                          extras={'odi-certificate': '{...}'})
+    ...
+
+Package.extras is a dictionary of the active extras, as in CKAN, so
+setting one writes it on commit. toolkit.check_access is a mock, which
+allows everything until given a side_effect.
+'''
+
+import contextlib
+import sys
+import types
+import uuid
+
+import mock
+from sqlalchemy import Boolean, Column, ForeignKey, MetaData, Table, \
+    UnicodeText, create_engine, event
+from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.orm import mapper, relationship, scoped_session, \
+    sessionmaker
+from sqlalchemy.orm.collections import attribute_mapped_collection
+
+metadata = MetaData()
+
+package_table = Table(
+    'package', metadata,
+    Column('id', UnicodeText, primary_key=True),
+    Column('name', UnicodeText, unique=True, nullable=False),
+    Column('state', UnicodeText),
+    Column('private', Boolean, default=False))
+
+package_extra_table = Table(
+    'package_extra', metadata,
+    Column('id', UnicodeText, primary_key=True),
+    Column('package_id', UnicodeText, ForeignKey('package.id')),
+    Column('key', UnicodeText),
+    Column('value', UnicodeText),
+    Column('state', UnicodeText))
+
+Session = scoped_session(sessionmaker())
+
+
+class Package(object):
+    def __init__(self, id, name, state='active', private=False):
+        self.id = id
+        self.name = name
+        self.state = state
+        self.private = private
+
+    @classmethod
+    def get(cls, reference):
+        '''Returns the package with the id or name, or None.'''
+        return Session.query(cls).get(reference) or \
+            Session.query(cls).filter_by(name=reference).first()
+
+
+class PackageExtra(object):
+    def __init__(self, key, value, state='active'):
+        self.key = key
+        self.value = value
+        self.state = state
+
+
+def _new_extra(key, value):
+    extra = PackageExtra(key, value)
+    extra.id = unicode(uuid.uuid4())
+    return extra
+
+mapper(PackageExtra, package_extra_table)
+mapper(Package, package_table, properties={
+    '_extras': relationship(
+        PackageExtra,
+        primaryjoin=(package_extra_table.c.package_id ==
+                     package_table.c.id) &
+        (package_extra_table.c.state == u'active'),
+        collection_class=attribute_mapped_collection('key'),
+        cascade='all, delete-orphan')})
+Package.extras = association_proxy('_extras', 'value', creator=_new_extra)
+
+
+def _engine():
+    engine = create_engine('sqlite://')
+
+    # pysqlite's own transaction handling breaks SAVEPOINT, so leave it to
+    # SQLAlchemy
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.execute('BEGIN')
+    return engine
+
+
+def _modules(engine):
+    ckan = types.ModuleType('ckan')
+    model = ckan.model = types.ModuleType('ckan.model')
+    model.meta = types.ModuleType('ckan.model.meta')
+    model.meta.engine = engine
+    model.meta.metadata = metadata
+    model.Session = Session
+    model.Package = Package
+    model.PackageExtra = PackageExtra
+    model.package_table = package_table
+    model.repo = mock.Mock()
+
+    plugins = ckan.plugins = types.ModuleType('ckan.plugins')
+    toolkit = plugins.toolkit = types.ModuleType('ckan.plugins.toolkit')
+    toolkit.side_effect_free = _flag('side_effect_free')
+    toolkit.auth_allow_anonymous_access = \
+        _flag('auth_allow_anonymous_access')
+    toolkit.check_access = mock.Mock(return_value=True)
+    toolkit.ValidationError = type('ValidationError', (Exception,), {})
+    toolkit.NotAuthorized = type('NotAuthorized', (Exception,), {})
+    return {'ckan': ckan, 'ckan.model': model,
+            'ckan.model.meta': model.meta, 'ckan.plugins': plugins,
+            'ckan.plugins.toolkit': toolkit}
+
+
+def _flag(name):
+    # as CKAN's decorators, which mark the function with an attribute
+    def decorator(function):
+        setattr(function, name, True)
+        return function
+    return decorator
+
+
+@contextlib.contextmanager
+def installed():
+    '''Installs a fresh fake CKAN, with empty tables, and yields its
+    ckan.model.'''
+    from ckanext.certificates import model as certificates_model
+    engine = _engine()
+    metadata.create_all(engine)
+    Session.configure(bind=engine)
+    modules = _modules(engine)
+    with mock.patch.dict(sys.modules, modules):
+        # so that it is imported afresh, with this toolkit
+        sys.modules.pop('ckanext.certificates.logic', None)
+        # the certificate table is defined on this metadata when used
+        certificate_table = certificates_model.certificate_table
+        certificates_model.certificate_table = None
+        try:
+            yield modules['ckan.model']
+        finally:
+            Session.remove()
+            certificates_model.certificate_table = certificate_table
+            if 'certificate' in metadata.tables:
+                metadata.remove(metadata.tables['certificate'])
+            engine.dispose()
+
+
+def add_package(id, name, state='active', private=False, extras=None):
+    pkg = Package(id, name, state, private)
+    for key, value in (extras or {}).iteritems():
+        pkg.extras[key] = value
+    Session.add(pkg)
+    Session.commit()
+    return pkg
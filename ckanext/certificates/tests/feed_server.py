@@ -0,0 +1,90 @@
+'''A local stand-in for certificates.theodi.org, for tests.
+
+Serves a paginated Atom feed at /feed, a certificate's JSON (with an ETag,
+for conditional requests) at /badge, a badge image at /badge.png, and at
+any other path a small JSON document, after failing with 503
+responses_to_fail times. The first stale_304s requests for /badge get a
+304 whether they are conditional or not.
+'''
+
+import BaseHTTPServer
+import SocketServer
+import json
+import threading
+
+BADGE_ETAG = '"abc"'
+BADGE_JSON = {'certificate': {
+    'level': 'pilot', 'created_at': '2014-01-01T00:00:00Z',
+    'jurisdiction': 'GB', 'dataset': {'title': 'A dataset'},
+    'certification_type': 'community certified'}}
+FEED_PAGES = 3
+BADGE_PNG = '\x89PNG\r\n\x1a\n' + 'badge' * 10
+
+
+def feed_page(url, page, pages):
+    links = [('self', page), ('last', pages)]
+    if page < pages:
+        links.append(('next', page + 1))
+    return '<feed xmlns="http://www.w3.org/2005/Atom">%s%s</feed>' % (
+        ''.join('<link rel="%s" href="%s?page=%d"/>' % (rel, url, number)
+                for rel, number in links),
+        ''.join('<entry><id>%d-%d</id></entry>' % (page, i)
+                for i in range(2)))
+
+
+class FeedRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.startswith('/feed'):
+            page = int(self.path.split('page=')[-1]) \
+                if 'page=' in self.path else 1
+            self.respond(200, feed_page(self.server.url + 'feed', page,
+                                        FEED_PAGES))
+        elif self.path == '/badge':
+            if self.server.stale_304s:
+                self.server.stale_304s -= 1
+                self.respond(304, '')
+            elif self.headers.get('If-None-Match') == BADGE_ETAG:
+                self.respond(304, '')
+            else:
+                self.respond(200, json.dumps(BADGE_JSON),
+                             {'ETag': BADGE_ETAG})
+        elif self.path == '/badge.png':
+            self.respond(200, BADGE_PNG, {'Content-Type': 'image/png'})
+        elif self.server.responses_to_fail:
+            self.server.responses_to_fail -= 1
+            self.respond(503, 'busy', {'Retry-After': '0'})
+        else:
+            self.respond(200, '{"ok": true}')
+
+    def respond(self, status, body, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    responses_to_fail = 0
+    stale_304s = 0
+
+    def __init__(self, handler=FeedRequestHandler):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.url = 'http://127.0.0.1:%d/' % self.server_port
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
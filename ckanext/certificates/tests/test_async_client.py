@@ -0,0 +1,100 @@
+import json
+import os
+import shutil
+import tempfile
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equal
+
+from ckanext.certificates.tests.feed_server import FeedServer, BADGE_ETAG, \
+    BADGE_JSON
+from ckanext.certificates.badge_cache import BadgeCache
+
+import ckanext.certificates.client as client
+
+try:
+    from ckanext.certificates.async_client import AsyncClient
+except ImportError:
+    AsyncClient = None
+
+
+class TestAsyncClient(object):
+    @classmethod
+    def setup_class(cls):
+        if AsyncClient is None:
+            raise SkipTest('gevent is not installed')
+        cls.server = FeedServer().start()
+        cls.url = cls.server.url
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.stop()
+
+    def setup(self):
+        self.client = AsyncClient(concurrency=4)
+        self.client.backoff_factor = 0
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        self.client.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_keep_alive(self):
+        for i in range(3):
+            assert_equal(200, self.client.get(self.url).status_code)
+        assert_equal({'opened': 1, 'reused': 2}, self.client.stats)
+
+    def test_retry_on_503(self):
+        self.server.responses_to_fail = 2
+        response = self.client.get(self.url)
+        assert_equal(200, response.status_code)
+        assert_equal('{"ok": true}', response.content)
+        assert_equal(0, self.server.responses_to_fail)
+
+    def test_iter_entries(self):
+        pages = []
+        entries = self.client.iter_entries(
+            self.url + 'feed', on_page=lambda *page: pages.append(page))
+        assert_equal(['1-0', '1-1', '2-0', '2-1', '3-0', '3-1'],
+                     [entry['id'] for entry in entries])
+        feed = self.url + 'feed'
+        assert_equal([(feed, feed + '?page=2'),
+                      (feed + '?page=2', feed + '?page=3'),
+                      (feed + '?page=3', None)], pages)
+
+    def test_iter_entries_matches_client(self):
+        expected = list(client.generate_entries(self.url + 'feed'))
+        client.reset_session()
+        assert_equal(expected,
+                     list(self.client.iter_entries(self.url + 'feed')))
+
+    def test_iter_entries_max_pages(self):
+        entries = self.client.iter_entries(self.url + 'feed', max_pages=2)
+        assert_equal(['1-0', '1-1', '2-0', '2-1'],
+                     [entry['id'] for entry in entries])
+
+    def test_fetch_badges(self):
+        url = self.url + 'badge'
+        badges = self.client.fetch_badges([url] * 5)
+        expected = client.badge_from_response(url, 200, {},
+                                              json.dumps(BADGE_JSON))
+        assert_equal([expected] * 5, badges)
+        assert_equal(4, self.client.stats['opened'])
+
+    def test_fetch_badges_conditional(self):
+        url = self.url + 'badge'
+        cache = BadgeCache(os.path.join(self.tmp_dir, 'badges.db'))
+        first = self.client.fetch_badges([url], cache)
+        assert_equal(BADGE_ETAG, cache.get(url).etag)
+        assert_equal(first, self.client.fetch_badges([url], cache))
+
+    def test_fetch_badges_not_modified_without_cached_badge(self):
+        self.server.stale_304s = 1
+        url = self.url + 'badge'
+        assert_equal('pilot', self.client.fetch_badges([url])[0]['level'])
+        assert_equal(0, self.server.stale_304s)
+
+    def test_fetch_badges_unreachable(self):
+        self.client.retries = 0
+        assert_equal([None],
+                     self.client.fetch_badges(['http://127.0.0.1:1/']))
@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.certificates.badge_cache import BadgeCache
+
+
+class TestBadgeCache(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'badges.db')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_set(self):
+        cache = BadgeCache(self.path)
+        assert_equal(None, cache.get('http://a/1'))
+        cache.set('http://a/1', '"etag"', None, {'level': 'pilot'})
+        cached = cache.get('http://a/1')
+        assert_equal({'level': 'pilot'}, cached.badge)
+        assert_equal({'If-None-Match': '"etag"'}, cached.validators())
+
+    def test_no_validators_not_stored(self):
+        cache = BadgeCache(self.path)
+        cache.set('http://a/1', None, None, {'level': 'pilot'})
+        assert_equal(None, cache.get('http://a/1'))
+
+    def test_persistent(self):
+        cache = BadgeCache(self.path)
+        cache.set('http://a/1', None, 'Wed, 01 Jan 2014 00:00:00 GMT', {})
+        cache.close()
+        cache = BadgeCache(self.path)
+        assert_equal(1, len(cache))
+        assert_equal({'If-Modified-Since': 'Wed, 01 Jan 2014 00:00:00 GMT'},
+                     cache.get('http://a/1').validators())
+
+    def test_eviction(self):
+        cache = BadgeCache(self.path, max_entries=10)
+        for i in range(10):
+            cache.set('http://a/%d' % i, '"%d"' % i, None, {})
+        cache.get('http://a/0')
+        cache.set('http://a/10', '"10"', None, {})
+        assert_equal(9, len(cache))
+        # the least recently used entries went, not the one just read
+        assert cache.get('http://a/0')
+        assert_equal(None, cache.get('http://a/1'))
@@ -0,0 +1,126 @@
+import os
+import pickle
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.certificates import badge_images
+from ckanext.certificates.badge_images import BadgeImageStore, \
+    local_badge_url
+from ckanext.certificates.tests.feed_server import BADGE_PNG, FeedServer
+
+PILOT = '\x89PNG pilot'
+EXPERT = '\x89PNG expert'
+
+
+class TestBadgeImageStore(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = BadgeImageStore(self.tmp_dir)
+
+    def teardown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _images(self):
+        return sorted(name for name in os.listdir(self.tmp_dir)
+                      if name.endswith('.png'))
+
+    def test_deduplicated(self):
+        hash1 = self.store.add('http://theodi/1/badge.png', PILOT)
+        hash2 = self.store.add('http://theodi/2/badge.png', PILOT)
+        hash3 = self.store.add('http://theodi/3/badge.png', EXPERT)
+        assert_equal(hash1, hash2)
+        assert hash1 != hash3
+        assert_equal(self._images(), sorted([hash1 + '.png',
+                                             hash3 + '.png']))
+        assert_equal(self.store.lookup('http://theodi/2/badge.png'), hash1)
+        assert_equal(self.store.lookup('http://theodi/4/badge.png'), None)
+        with open(self.store.image_path(hash3), 'rb') as f:
+            assert_equal(f.read(), EXPERT)
+
+    def test_size_bound(self):
+        store = BadgeImageStore(self.tmp_dir, max_bytes=30)
+        store.add('http://theodi/1/badge.png', PILOT)
+        store.add('http://theodi/2/badge.png', EXPERT)
+        store.add('http://theodi/3/badge.png', '\x89PNG standard')
+        # the oldest image goes, and its badge falls back to the ODI's URL
+        assert_equal(store.lookup('http://theodi/1/badge.png'), None)
+        assert store.lookup('http://theodi/3/badge.png')
+        assert_equal(len(self._images()), 2)
+        assert store.total_bytes() <= 30
+        store.close()
+
+    def test_lookup_many(self):
+        pilot = self.store.add('http://theodi/1/badge.png', PILOT)
+        expert = self.store.add('http://theodi/2/badge.png', EXPERT)
+        assert_equal(self.store.lookup_many(['http://theodi/%d/badge.png' % i
+                                             for i in range(1000)]),
+                     {'http://theodi/1/badge.png': pilot,
+                      'http://theodi/2/badge.png': expert})
+
+    def test_prune(self):
+        self.store.add('http://theodi/1/badge.png', PILOT)
+        self.store.add('http://theodi/2/badge.png', PILOT)
+        expert = self.store.add('http://theodi/3/badge.png', EXPERT)
+        assert_equal(self.store.prune(['http://theodi/1/badge.png']),
+                     (2, 1))
+        assert_equal(self.store.lookup('http://theodi/3/badge.png'), None)
+        assert not os.path.exists(self.store.image_path(expert))
+        assert_equal(len(self.store), 1)
+
+    def test_mirror(self):
+        server = FeedServer().start()
+        try:
+            url = server.url + 'badge.png'
+            assert_equal(self.store.mirror([url, url, server.url + 'x',
+                                            None]), 1)
+            with open(self.store.image_path(self.store.lookup(url)),
+                      'rb') as f:
+                assert_equal(f.read(), BADGE_PNG)
+            # not downloaded again
+            assert_equal(self.store.mirror([url]), 0)
+        finally:
+            server.stop()
+
+    def test_pickle(self):
+        image_hash = self.store.add('http://theodi/1/badge.png', PILOT)
+        store = pickle.loads(pickle.dumps(self.store))
+        assert_equal(store.lookup('http://theodi/1/badge.png'), image_hash)
+        store.close()
+
+
+class TestLocalBadgeUrl(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = {'ckanext.certificates.badge_image_dir': self.tmp_dir}
+        badge_images._store = None
+
+    def teardown(self):
+        if badge_images._store is not None:
+            badge_images._store.close()
+            badge_images._store = None
+        shutil.rmtree(self.tmp_dir)
+
+    def test_local(self):
+        store = badge_images.get_badge_image_store(self.config)
+        image_hash = store.add('http://theodi/1/badge.png', PILOT)
+        assert_equal(local_badge_url('http://theodi/1/badge.png',
+                                     self.config),
+                     '/certificates/badge/%s.png' % image_hash)
+        assert_equal(local_badge_url('http://theodi/2/badge.png',
+                                     self.config),
+                     'http://theodi/2/badge.png')
+
+    def test_missing_file(self):
+        store = badge_images.get_badge_image_store(self.config)
+        os.remove(store.image_path(
+            store.add('http://theodi/1/badge.png', PILOT)))
+        assert_equal(local_badge_url('http://theodi/1/badge.png',
+                                     self.config),
+                     'http://theodi/1/badge.png')
+
+    def test_not_configured(self):
+        assert_equal(local_badge_url('http://theodi/1/badge.png', {}),
+                     'http://theodi/1/badge.png')
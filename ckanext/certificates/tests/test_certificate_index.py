@@ -0,0 +1,127 @@
+import json
+import threading
+
+from nose.tools import assert_equal
+
+from ckanext.certificates.certificate_index import CertificateIndex
+from ckanext.certificates.tests import fake_ckan
+
+cert = {'level': 'pilot', 'certification_type': 'self certified',
+        'source': 'Self-Certified by Cabinet Office (unverified)',
+        'badge_url': 'https://certificates.theodi.org/badge.png',
+        'certificate_url': 'https://certificates.theodi.org/1',
+        'title': 'Planning applications'}
+
+
+class TestCertificateIndex(object):
+    def setup(self):
+        self.index = CertificateIndex(ttl=None)
+        self.index.load([('id1', json.dumps(cert)),
+                         ('id2', json.dumps(dict(cert, certificate_url='2'))),
+                         ('id3', 'INVALID')])
+
+    def test_get(self):
+        summary = self.index.get('id1')
+        assert_equal('pilot', summary.level)
+        assert_equal(dict((key, cert[key]) for key in
+                          ('level', 'certification_type', 'source',
+                           'badge_url', 'certificate_url')),
+                     summary.as_dict())
+        assert_equal(None, self.index.get('id3'))
+        assert_equal(2, len(self.index))
+
+    def test_load_dicts(self):
+        # as read from the certificate table
+        index = CertificateIndex(ttl=None)
+        index.load([('id1', cert)])
+        assert_equal('pilot', index.get('id1').level)
+
+    def test_shared_strings(self):
+        assert self.index.get('id1').level is self.index.get('id2').level
+        assert self.index.get('id1').source is self.index.get('id2').source
+
+    def test_update(self):
+        self.index.update('id3', json.dumps(dict(cert, level='expert')))
+        assert_equal('expert', self.index.get('id3').level)
+        self.index.update('id1', None)
+        assert_equal(None, self.index.get('id1'))
+
+    def test_update_before_build(self):
+        index = CertificateIndex()
+        index.update('id1', json.dumps(cert))
+        assert_equal(0, len(index))
+
+
+class SlowIndex(CertificateIndex):
+    '''Builds from the database only once proceed is set.'''
+    def __init__(self, *args, **kwargs):
+        CertificateIndex.__init__(self, *args, **kwargs)
+        self.builds = 0
+        self.building = threading.Event()
+        self.proceed = threading.Event()
+
+    def build(self):
+        self.builds += 1
+        self.building.set()
+        self.proceed.wait(5)
+        return self.load([('id1', json.dumps(dict(cert, level='expert')))])
+
+
+class TestRebuild(object):
+    def setup(self):
+        # for the database session of the rebuild
+        self.ckan = fake_ckan.installed()
+        self.ckan.__enter__()
+        self.index = SlowIndex(ttl=60)
+
+    def teardown(self):
+        self.index.proceed.set()
+        self.ckan.__exit__(None, None, None)
+
+    def _expire(self):
+        self.index.load([('id1', json.dumps(cert))])
+        self.index._built_at -= 120
+
+    def test_first_build_blocks(self):
+        self.index.proceed.set()
+        assert_equal('expert', self.index.get('id1').level)
+        assert_equal(None, self.index._rebuild_thread)
+
+    def test_rebuilt_in_background(self):
+        self._expire()
+        levels = []
+
+        def get():
+            levels.append(self.index.get('id1').level)
+        threads = [threading.Thread(target=get) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # none of them waited for the rebuild
+        assert_equal(['pilot'] * 5, levels)
+        self.index.proceed.set()
+        self.index._rebuild_thread.join()
+        assert_equal(1, self.index.builds)
+        assert_equal('expert', self.index.get('id1').level)
+
+    def test_updates_during_rebuild_kept(self):
+        self._expire()
+        self.index.get('id1')
+        self.index.building.wait(5)
+        self.index.update('id2', json.dumps(cert))
+        self.index.update('id1', None)
+        self.index.proceed.set()
+        self.index._rebuild_thread.join()
+        assert_equal('pilot', self.index.get('id2').level)
+        assert_equal(None, self.index.get('id1'))
+
+    def test_updates_during_first_build_kept(self):
+        thread = threading.Thread(target=self.index.get, args=('id1',))
+        thread.start()
+        self.index.building.wait(5)
+        self.index.update('id2', json.dumps(cert))
+        self.index.proceed.set()
+        thread.join()
+        assert_equal('pilot', self.index.get('id2').level)
+        assert_equal(2, len(self.index))
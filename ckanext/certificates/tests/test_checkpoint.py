@@ -0,0 +1,80 @@
+import datetime
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.certificates.checkpoint import Checkpoint
+from ckanext.certificates.client import parse_timestamp
+
+
+class TestParseTimestamp(object):
+    def test_utc(self):
+        assert_equal(datetime.datetime(2014, 1, 2, 3, 4, 5),
+                     parse_timestamp('2014-01-02T03:04:05Z'))
+
+    def test_offset(self):
+        assert_equal(datetime.datetime(2014, 1, 2, 2, 4, 5),
+                     parse_timestamp('2014-01-02T03:04:05.123+01:00'))
+
+    def test_invalid(self):
+        assert_equal(None, parse_timestamp('yesterday'))
+        assert_equal(None, parse_timestamp(None))
+        assert_equal(None, parse_timestamp('2014-02-30T00:00:00Z'))
+
+
+class TestCheckpoint(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'state', 'checkpoint.json')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_missing(self):
+        checkpoint = Checkpoint.load(self.path)
+        assert_equal(None, checkpoint.resume_args())
+
+    def test_observe(self):
+        checkpoint = Checkpoint(self.path)
+        for updated in ('2014-01-02T00:00:00Z', '2014-01-03T00:00:00Z',
+                        '2014-01-01T00:00:00Z', None):
+            checkpoint.observe({'updated': updated})
+        # not until the entries are stored
+        assert_equal(None, checkpoint.updated)
+        checkpoint.page_completed('http://feed?page=1', 'http://feed?page=2')
+        assert_equal('2014-01-03T00:00:00Z', checkpoint.updated)
+
+    def test_observe_older(self):
+        checkpoint = Checkpoint(self.path, updated='2014-01-03T00:00:00Z')
+        checkpoint.observe({'updated': '2014-01-02T00:00:00Z'})
+        checkpoint.page_completed('http://feed?page=1', None)
+        assert_equal('2014-01-03T00:00:00Z', checkpoint.updated)
+
+    def test_resume_complete(self):
+        checkpoint = Checkpoint(self.path)
+        checkpoint.observe({'updated': '2014-01-03T00:00:00Z'})
+        checkpoint.page_completed('http://feed?page=2', None)
+        checkpoint.save()
+        checkpoint = Checkpoint.load(self.path)
+        assert checkpoint.complete
+        assert_equal({'url': None,
+                      'since': datetime.datetime(2014, 1, 3)},
+                     checkpoint.resume_args())
+
+    def test_resume_incomplete(self):
+        checkpoint = Checkpoint(self.path)
+        checkpoint.observe({'updated': '2014-01-03T00:00:00Z'})
+        checkpoint.page_completed('http://feed?page=1', 'http://feed?page=2')
+        checkpoint.save()
+        checkpoint = Checkpoint.load(self.path)
+        assert not checkpoint.complete
+        assert_equal({'url': 'http://feed?page=2', 'since': None},
+                     checkpoint.resume_args())
+
+    def test_corrupt(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('{')
+        assert_equal(None, Checkpoint.load(self.path).resume_args())
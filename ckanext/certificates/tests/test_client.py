@@ -0,0 +1,305 @@
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+
+from lxml import etree
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.certificates.badge_cache import BadgeCache
+from ckanext.certificates.tests.feed_server import FeedServer, BADGE_ETAG
+
+import ckanext.certificates.client as client
+from ckanext.certificates import instrumentation
+
+
+class TestBadgeFetcher(object):
+    def setup(self):
+        self._get_badge_data = client.get_badge_data
+
+    def teardown(self):
+        client.get_badge_data = self._get_badge_data
+
+    def test_sequential(self):
+        client.get_badge_data = lambda url: {'url': url}
+        fetcher = client.BadgeFetcher()
+        urls = ['http://a/1', 'http://a/2']
+        assert_equal([{'url': url} for url in urls], fetcher.fetch(urls))
+        fetcher.close()
+
+    def test_concurrent_preserves_order(self):
+        def get_badge_data(url):
+            time.sleep(0.01 * (10 - int(url.split('/')[-1])))
+            return {'url': url}
+        client.get_badge_data = get_badge_data
+        fetcher = client.BadgeFetcher(workers=4)
+        urls = ['http://a/%d' % i for i in range(10)]
+        assert_equal([{'url': url} for url in urls], fetcher.fetch(urls))
+        fetcher.close()
+
+    def test_host_concurrency(self):
+        lock = threading.Lock()
+        in_flight = {'a': 0, 'b': 0}
+        peak = {'a': 0, 'b': 0}
+
+        def get_badge_data(url):
+            host = url.split('/')[2]
+            with lock:
+                in_flight[host] += 1
+                peak[host] = max(peak[host], in_flight[host])
+            time.sleep(0.01)
+            with lock:
+                in_flight[host] -= 1
+            return {}
+        client.get_badge_data = get_badge_data
+        fetcher = client.BadgeFetcher(workers=6, host_concurrency=2)
+        fetcher.fetch(['http://%s/%d' % (host, i)
+                       for i in range(10) for host in ('a', 'b')])
+        fetcher.close()
+        assert_equal({'a': 2, 'b': 2}, peak)
+
+
+class TestSession(object):
+    @classmethod
+    def setup_class(cls):
+        cls.server = FeedServer().start()
+        cls.url = cls.server.url
+
+    @classmethod
+    def teardown_class(cls):
+        client.reset_session()
+        cls.server.stop()
+
+    def setup(self):
+        client.reset_session()
+
+    def test_connections_reused(self):
+        for i in range(3):
+            assert_equal(200, client.http_get(self.url).status_code)
+        assert_equal({'opened': 1, 'reused': 2}, client.connection_stats())
+
+    def test_pool_grown_in_place(self):
+        session = client.get_session()
+        assert_equal(200, client.http_get(self.url).status_code)
+        assert client.get_session(pool_size=session.pool_size + 10) \
+            is session
+        assert_equal(200, client.http_get(self.url).status_code)
+        # the first connection is still counted
+        assert_equal({'opened': 2, 'reused': 0}, client.connection_stats())
+
+    def test_retry_on_503(self):
+        self.server.responses_to_fail = 2
+        response = client.http_get(self.url)
+        assert_equal(200, response.status_code)
+        assert_equal(0, self.server.responses_to_fail)
+
+    def test_fetch_entries(self):
+        expected = ['1-0', '1-1', '2-0', '2-1', '3-0', '3-1']
+        for streaming, prefetch in ((False, 0), (True, 0), (False, 1),
+                                    (False, 5)):
+            entries = client.generate_entries(url=self.url + 'feed',
+                                              streaming=streaming,
+                                              prefetch=prefetch)
+            assert_equal(expected, [entry['id'] for entry in entries])
+
+    def test_fetch_entries_instrumented(self):
+        timings = instrumentation.enable()
+        try:
+            list(client.generate_entries(url=self.url + 'feed'))
+            client.get_badge_data(self.url + 'badge', cache=None)
+        finally:
+            instrumentation.disable()
+        summary = timings.summary()
+        assert_equal(3, summary['phases']['feed_http']['count'])
+        assert_equal(3, summary['phases']['feed_parse']['count'])
+        assert_equal(1, summary['phases']['badge_http']['count'])
+        assert_equal(3, summary['counters']['feed_requests'])
+        assert_equal(1, summary['counters']['badge_requests'])
+        assert summary['counters']['feed_bytes'] > 0
+
+    def test_fetch_page_range(self):
+        url = client.set_url_parameter(self.url + 'feed', 'page', 2)
+        entries = client.generate_entries(url=url, max_pages=1)
+        assert_equal(['2-0', '2-1'], [entry['id'] for entry in entries])
+
+    def test_feed_page_count(self):
+        assert_equal(3, client.feed_page_count(self.url + 'feed'))
+
+    def test_fetch_entries_on_page(self):
+        url = self.url + 'feed'
+        for prefetch in (0, 2):
+            pages = []
+            list(client.generate_entries(url=url, prefetch=prefetch,
+                                         on_page=lambda *page:
+                                         pages.append(page)))
+            assert_equal([(url, url + '?page=2'),
+                          (url + '?page=2', url + '?page=3'),
+                          (url + '?page=3', None)], pages)
+
+    def test_fetch_entries_error(self):
+        # the feed ends at the error, without the page being completed
+        for prefetch in (0, 1):
+            pages = []
+            entries = list(client.generate_entries(
+                url=self.url + 'badge', prefetch=prefetch,
+                on_page=lambda *page: pages.append(page)))
+            assert_equal([], entries)
+            assert_equal([], pages)
+
+    def test_conditional_badge_fetch(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            cache = BadgeCache(os.path.join(tmp_dir, 'badges.db'))
+            url = self.url + 'badge'
+            badge = client.get_badge_data(url, cache=cache)
+            assert_equal('pilot', badge['level'])
+            assert_equal(BADGE_ETAG, cache.get(url).etag)
+            # the second request gets a 304, answered from the cache
+            assert_equal(badge, client.get_badge_data(url, cache=cache))
+            cache.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_not_modified_without_cached_badge(self):
+        self.server.stale_304s = 1
+        badge = client.get_badge_data(self.url + 'badge')
+        assert_equal('pilot', badge['level'])
+        assert_equal(0, self.server.stale_304s)
+
+    def test_not_modified_again(self):
+        self.server.stale_304s = 2
+        assert_equal({}, client.get_badge_data(self.url + 'badge'))
+        self.server.stale_304s = 0
+
+
+FEED = '''<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Open Data Certificates</title>
+  <link rel="self" href="https://certificates.theodi.org/datasets.feed?page=1"/>
+  <link rel="next" href="https://certificates.theodi.org/datasets.feed?page=2"/>
+  <link rel="last" href="https://certificates.theodi.org/datasets.feed?page=9"/>
+  <entry>
+    <title>Planning applications</title>
+    <id>https://certificates.theodi.org/datasets/1</id>
+    <updated>2014-01-01T00:00:00Z</updated>
+    <content>Pilot Level Certificate</content>
+    <link rel="about" href="http://data.gov.uk/dataset/planning"/>
+    <link rel="alternate" href="https://certificates.theodi.org/datasets/1/certificates/1.json"/>
+    <link rel="http://schema.theodi.org/certificate#badge" type="text/html" href="https://certificates.theodi.org/datasets/1/certificates/1/badge.html"/>
+  </entry>
+  <entry>
+    <title>Spending over \xc2\xa325,000</title>
+    <id>https://certificates.theodi.org/datasets/2</id>
+    <updated>2014-01-02T00:00:00Z</updated>
+    <link rel="about" href="http://data.gov.uk/dataset/spending"/>
+    <link href="https://certificates.theodi.org/datasets/2"/>
+  </entry>
+</feed>
+'''
+
+FEED_LINKS = {
+    'self': 'https://certificates.theodi.org/datasets.feed?page=1',
+    'next': 'https://certificates.theodi.org/datasets.feed?page=2',
+    'last': 'https://certificates.theodi.org/datasets.feed?page=9',
+}
+
+FEED_ENTRIES = [
+    {'title': 'Planning applications',
+     'id': 'https://certificates.theodi.org/datasets/1',
+     'updated': '2014-01-01T00:00:00Z',
+     'content': 'Pilot Level Certificate',
+     'about': 'http://data.gov.uk/dataset/planning',
+     'alternate': 'https://certificates.theodi.org/datasets/1/certificates/1.json',
+     'badge_html': 'https://certificates.theodi.org/datasets/1/certificates/1/badge.html'},
+    {'title': u'Spending over \xa325,000',
+     'id': 'https://certificates.theodi.org/datasets/2',
+     'updated': '2014-01-02T00:00:00Z',
+     'about': 'http://data.gov.uk/dataset/spending',
+     'link': 'https://certificates.theodi.org/datasets/2'},
+]
+
+
+class TestParseFeedPage(object):
+    def test_parse(self):
+        links = {}
+        entries = client.parse_feed_page(FEED, links)
+        assert_equal(FEED_ENTRIES, [client.entry_to_dict(e) for e in entries])
+        assert_equal(FEED_LINKS, links)
+
+    def test_iterparse(self):
+        # feed it in small chunks, to split elements across chunks
+        chunks = (FEED[i:i + 7] for i in range(0, len(FEED), 7))
+        links = {}
+        entries = [client.entry_to_dict(e)
+                   for e in client.iterparse_feed_page(chunks, links)]
+        assert_equal(FEED_ENTRIES, entries)
+        assert_equal(FEED_LINKS, links)
+
+    def test_iterparse_clears_entries(self):
+        entries = []
+        for entry in client.iterparse_feed_page([FEED], {}):
+            entries.append(entry)
+        assert_equal([0, 0], [len(entry) for entry in entries])
+
+    def test_compact_entries(self):
+        links = {}
+        entries = [client.entry_to_dict(e, client.CertificateEntry)
+                   for e in client.parse_feed_page(FEED, links)]
+        assert_equal(FEED_ENTRIES, entries)
+
+    def test_comments_ignored(self):
+        entry = etree.fromstring('<entry xmlns="http://www.w3.org/2005/Atom">'
+                                 '<!-- comment --><title>A</title></entry>')
+        assert_equal({'title': 'A'}, client.entry_to_dict(entry))
+
+
+class TestCertificateEntry(object):
+    def test_dict_like(self):
+        entry = client.CertificateEntry(id='1', other='x')
+        assert_equal('1', entry['id'])
+        assert_equal('x', entry['other'])
+        assert_equal('', entry.get('content', ''))
+        assert 'id' in entry
+        assert 'content' not in entry
+        assert_equal(['id', 'other'], entry.keys())
+        assert_equal({'id': '1', 'other': 'x'}, entry)
+        assert_raises(KeyError, entry.__getitem__, 'title')
+        del entry['other']
+        assert_equal({'id': '1'}, dict(entry.items()))
+
+    def test_none_value(self):
+        entry = client.CertificateEntry(content=None)
+        assert 'content' in entry
+        assert_equal(None, entry['content'])
+
+    def test_pickle(self):
+        entry = client.CertificateEntry(id='1', other='x')
+        assert_equal(entry, pickle.loads(pickle.dumps(entry, 2)))
+
+
+class TestPrefetchPages(object):
+    def test_order_and_read_ahead(self):
+        produced = []
+
+        def pages():
+            for i in range(5):
+                produced.append(i)
+                yield i, [i], {}
+        consumed = []
+        for page_url, entries, links in client.prefetch_pages(pages(), 2):
+            if page_url == 0:
+                time.sleep(0.1)
+                # the producer has got ahead, but no more than allowed
+                assert_equal([0, 1, 2, 3], produced)
+            consumed.append(page_url)
+        assert_equal(range(5), consumed)
+
+    def test_error_raised(self):
+        def pages():
+            yield 0, [], {}
+            raise ValueError('bad page')
+        pages = client.prefetch_pages(pages(), 1)
+        assert_equal(0, pages.next()[0])
+        assert_raises(ValueError, pages.next)
@@ -0,0 +1,77 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.certificates.daemon import PollInterval, RunLock, write_status
+
+
+class TestRunLock(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'fetch.lock')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_held_until_released(self):
+        lock = RunLock(self.path)
+        assert lock.acquire()
+        assert not RunLock(self.path).acquire()
+        lock.release()
+        assert RunLock(self.path).acquire()
+
+    def test_creates_directory(self):
+        path = os.path.join(self.tmp_dir, 'new', 'fetch.lock')
+        with RunLock(path) as locked:
+            assert locked
+        assert os.path.exists(path)
+
+    def test_context_manager(self):
+        with RunLock(self.path) as locked:
+            assert locked
+            with RunLock(self.path) as locked_again:
+                assert not locked_again
+        with RunLock(self.path) as locked:
+            assert locked
+
+
+class TestPollInterval(object):
+    def test_backs_off_without_changes(self):
+        interval = PollInterval(60, 200)
+        assert_equal([interval.update(0) for i in range(4)],
+                     [90, 135, 200, 200])
+
+    def test_speeds_up_with_changes(self):
+        interval = PollInterval(60, 3600)
+        interval.seconds = 400
+        assert_equal([interval.update(5) for i in range(4)],
+                     [200, 100, 60, 60])
+
+    def test_speeds_up_until_caught_up(self):
+        interval = PollInterval(60, 3600)
+        interval.seconds = 400
+        assert_equal(interval.update(0, caught_up=False), 200)
+
+
+class TestWriteStatus(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write_status(self):
+        path = os.path.join(self.tmp_dir, 'status.json')
+        write_status(path, state='waiting', runs=2,
+                     next_run=datetime.datetime(2014, 1, 1, 12, 30))
+        with open(path) as f:
+            status = json.load(f)
+        assert_equal(status['state'], 'waiting')
+        assert_equal(status['runs'], 2)
+        assert_equal(status['next_run'], '2014-01-01T12:30:00Z')
+        assert_equal(status['pid'], os.getpid())
+        assert_equal(os.listdir(self.tmp_dir), ['status.json'])
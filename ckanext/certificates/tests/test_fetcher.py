@@ -0,0 +1,366 @@
+import json
+import os
+import shutil
+import tempfile
+import urlparse
+
+import mock
+from nose.tools import assert_equal
+
+import ckanext.certificates.client as client
+from ckanext.certificates import instrumentation
+from ckanext.certificates.checkpoint import Checkpoint
+from ckanext.certificates.fetcher import CertificateFetcher, \
+    CertificateWriter, merge_shard_results, page_ranges
+from ckanext.certificates.instrumentation import Instrumentation
+from ckanext.certificates.running_stats import StatsList
+from ckanext.certificates.site_url import SiteUrlMatcher
+from ckanext.certificates.tests import fake_ckan
+
+SITE_URL = 'http://data.gov.uk'
+FEED_URL = 'https://certificates.theodi.org/datasets.feed'
+
+
+class _Package(object):
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+def feed_entry(name, updated):
+    return {'id': 'https://certificates.theodi.org/datasets/%s' % name,
+            'title': name, 'updated': updated,
+            'about': '%s/dataset/%s' % (SITE_URL, name),
+            'alternate': 'https://certificates.theodi.org/%s.json' % name}
+
+
+def badge(name):
+    return {'level': 'pilot', 'title': name,
+            'certificate_url': 'https://certificates.theodi.org/%s' % name}
+
+
+class StubFetcher(CertificateFetcher):
+    '''Finds a package, without a certificate, for every URL.'''
+    @classmethod
+    def _get_packages_from_urls(cls, urls, names=None, storage='extras'):
+        return dict((url, (_Package('id-' + names[url], names[url]), None))
+                    for url in urls)
+
+
+class RecordingWriter(CertificateWriter):
+    '''Commits by recording the certificates, rather than to CKAN.'''
+    def __init__(self, *args, **kwargs):
+        super(RecordingWriter, self).__init__(*args, **kwargs)
+        self.written = {}
+
+    def flush(self):
+        for pkg, badge_json, operation, description in \
+                self._pending.values():
+            self.written[pkg.name] = json.loads(badge_json)
+            self.stats.add('Certificate %s' % operation, description)
+        self._pending.clear()
+        return True
+
+
+class StubBadgeFetcher(object):
+    def __init__(self, badges):
+        self.badges = badges
+
+    def fetch(self, urls):
+        return [self.badges[url] for url in urls]
+
+    def close(self):
+        pass
+
+
+class TestIsStored:
+    entry = {'updated': '2014-03-01T10:00:00Z'}
+
+    def _existing(self, feed_updated):
+        return json.dumps({'level': 'pilot', 'feed_updated': feed_updated})
+
+    def test_not_updated(self):
+        assert CertificateFetcher._is_stored(
+            self.entry, self._existing('2014-03-01T10:00:00Z'))
+        assert CertificateFetcher._is_stored(
+            self.entry, self._existing('2014-03-01T11:00:00+01:00'))
+
+    def test_updated(self):
+        assert not CertificateFetcher._is_stored(
+            self.entry, self._existing('2014-02-28T10:00:00Z'))
+
+    def test_from_table(self):
+        assert CertificateFetcher._is_stored(
+            self.entry, {'level': 'pilot',
+                         'feed_updated': '2014-03-01T10:00:00Z'})
+        assert not CertificateFetcher._is_stored(
+            self.entry, {'level': 'pilot', 'feed_updated': None})
+
+    def test_not_known(self):
+        assert not CertificateFetcher._is_stored(self.entry, None)
+        assert not CertificateFetcher._is_stored(
+            self.entry, json.dumps({'level': 'pilot'}))
+        assert not CertificateFetcher._is_stored(
+            self.entry, self._existing(None))
+        assert not CertificateFetcher._is_stored(
+            {}, self._existing('2014-03-01T10:00:00Z'))
+        assert not CertificateFetcher._is_stored(
+            {'updated': '2014-02-30T10:00:00Z'},
+            self._existing('2014-03-01T10:00:00Z'))
+
+
+class TestFetchCheckpoint(object):
+    '''fetch, over a feed of two pages, of which the second entry's badge
+    can't be fetched.'''
+    pages = [[feed_entry('a', '2014-03-01T10:00:00Z')],
+             [feed_entry('b', '2014-03-02T10:00:00Z')]]
+
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'checkpoint.json')
+        self.generate_entries = client.generate_entries
+        client.generate_entries = self._generate_entries
+
+    def teardown(self):
+        client.generate_entries = self.generate_entries
+        shutil.rmtree(self.tmp_dir)
+
+    def _generate_entries(self, url=None, since=None, on_page=None):
+        for number, entries in enumerate(self.pages, 1):
+            for entry in entries:
+                yield entry
+            on_page('%s?page=%d' % (FEED_URL, number),
+                    '%s?page=%d' % (FEED_URL, number + 1)
+                    if number < len(self.pages) else None)
+
+    def _fetch(self, b_badge):
+        badges = {self.pages[0][0]['alternate']: badge('a'),
+                  self.pages[1][0]['alternate']: b_badge}
+        writer = RecordingWriter()
+        stats = StubFetcher.fetch(
+            SiteUrlMatcher([SITE_URL]), None, batch_size=1, writer=writer,
+            checkpoint=Checkpoint.load(self.path), report=False,
+            badge_fetcher=StubBadgeFetcher(badges))
+        return stats, writer.written, Checkpoint.load(self.path)
+
+    def test_refused_badge_skipped(self):
+        # e.g. a 404 for a revoked certificate, which won't come back
+        stats, written, checkpoint = self._fetch({})
+        assert_equal(['a'], written.keys())
+        assert_equal(1, stats.count('Error fetching badge data - skipped'))
+        assert_equal('2014-03-02T10:00:00Z', checkpoint.updated)
+        assert checkpoint.complete
+
+    def test_failed_request_holds_checkpoint(self):
+        stats, written, checkpoint = self._fetch(None)
+        assert_equal(['a'], written.keys())
+        assert_equal(1, stats.count('Error fetching badge data - skipped'))
+        # page 1 is only known to be done in b's batch, so the checkpoint
+        # isn't saved at all, and b is fetched again next run
+        assert not os.path.exists(self.path)
+
+
+class TestCertificateWriter(object):
+    def setup(self):
+        self.ckan = fake_ckan.installed()
+        self.model = self.ckan.__enter__()
+        self.packages = [fake_ckan.add_package('id%d' % i, 'dataset-%d' % i)
+                         for i in range(3)]
+        self.stats = StatsList()
+
+    def teardown(self):
+        self.ckan.__exit__(None, None, None)
+
+    def _writer(self, **kwargs):
+        return CertificateWriter(stats=self.stats, **kwargs)
+
+    def _stored(self):
+        self.model.Session.expire_all()
+        return dict((pkg.id, pkg.extras.get('odi-certificate'))
+                    for pkg in self.packages)
+
+    def test_flushed_when_full(self):
+        writer = self._writer(batch_size=2)
+        writer.add(self.packages[0], '"a"', 'added', 'a')
+        # nothing is recorded until the batch is committed
+        assert_equal(0, self.stats.count('Certificate added'))
+        assert_equal({'id0': None, 'id1': None, 'id2': None}, self._stored())
+        writer.add(self.packages[1], '"b"', 'updated', 'b')
+        assert_equal({'id0': '"a"', 'id1': '"b"', 'id2': None},
+                     self._stored())
+        assert_equal(1, self.stats.count('Certificate added'))
+        assert_equal(1, self.stats.count('Certificate updated'))
+        # one revision for the batch
+        assert_equal(1, self.model.repo.new_revision.call_count)
+
+    def test_flushed_when_due(self):
+        writer = self._writer(batch_size=10, interval=60)
+        writer.add(self.packages[0], '"a"', 'added', 'a')
+        writer.flush_if_due()
+        assert_equal(None, self._stored()['id0'])
+        writer._pending_since -= 61
+        writer.flush_if_due()
+        assert_equal('"a"', self._stored()['id0'])
+
+    def test_failed_batch_rolled_back(self):
+        writer = self._writer(batch_size=2)
+        writer.add(self.packages[0], '"a"', 'added', 'a')
+        writer.add(self.packages[1], '"b"', 'added', 'b')
+        with mock.patch.object(self.model.Session, 'commit',
+                               side_effect=Exception('deadlock')):
+            writer.add(self.packages[2], '"c"', 'added', 'c')
+            assert not writer.flush()
+        assert_equal({'id0': '"a"', 'id1': '"b"', 'id2': None},
+                     self._stored())
+        assert_equal(1, writer.failed_batches)
+        assert_equal(2, self.stats.count('Certificate added'))
+        assert_equal(1, self.stats.count(
+            'Error writing certificate - rolled back'))
+        # the writer carries on with the next batch
+        writer.add(self.packages[2], '"c"', 'added', 'c')
+        assert writer.flush()
+        assert_equal('"c"', self._stored()['id2'])
+
+    def test_superseded(self):
+        writer = self._writer(batch_size=10)
+        writer.add(self.packages[0], '"a"', 'updated', 'a')
+        writer.add(self.packages[0], '"a2"', 'added', 'a2')
+        writer.flush()
+        assert_equal('"a2"', self._stored()['id0'])
+        assert_equal(['a'], self.stats['Certificate superseded in batch'])
+        # the change to the package is still the first one's
+        assert_equal(['a2'], self.stats['Certificate updated'])
+        assert_equal(2, sum(self.stats.count(category)
+                            for category in self.stats))
+
+    def test_table(self):
+        from ckanext.certificates.model import get_certificates, init_tables
+        init_tables()
+        writer = self._writer(batch_size=2, storage='table')
+        writer.add(self.packages[0], json.dumps({'level': 'pilot'}),
+                   'added', 'a')
+        writer.add(self.packages[1], json.dumps({'level': 'expert'}),
+                   'added', 'b')
+        assert_equal({'id0': 'pilot', 'id1': 'expert'},
+                     dict((package_id, certificate['level'])
+                          for package_id, certificate in
+                          get_certificates(['id0', 'id1', 'id2']).items()))
+        # the extras are left alone, without a revision
+        assert_equal({'id0': None, 'id1': None, 'id2': None}, self._stored())
+        assert_equal(0, self.model.repo.new_revision.call_count)
+
+
+class TestGetPackagesFromUrls(object):
+    def setup(self):
+        self.ckan = fake_ckan.installed()
+        self.model = self.ckan.__enter__()
+        fake_ckan.add_package('id-a', 'a', extras={
+            'odi-certificate': json.dumps({'level': 'pilot'})})
+        fake_ckan.add_package('id-b', 'b')
+        self.urls = ['%s/dataset/%s' % (SITE_URL, ref)
+                     for ref in ('a', 'b', 'id-a', 'unknown')]
+
+    def teardown(self):
+        self.ckan.__exit__(None, None, None)
+
+    def _packages(self, storage='extras'):
+        packages = CertificateFetcher._get_packages_from_urls(
+            self.urls, storage=storage)
+        return dict((url[len(SITE_URL):], (pkg.id, certificate))
+                    for url, (pkg, certificate) in packages.items())
+
+    def test_extras(self):
+        with mock.patch.object(self.model.Package, 'get',
+                               wraps=self.model.Package.get) as get:
+            packages = self._packages()
+        assert_equal({'/dataset/a': ('id-a', json.dumps({'level': 'pilot'})),
+                      # no certificate
+                      '/dataset/b': ('id-b', None),
+                      # by id, which isn't a name
+                      '/dataset/id-a': ('id-a',
+                                        json.dumps({'level': 'pilot'}))},
+                     packages)
+        # the names are found in one query, and only the others one by one
+        assert_equal(['id-a', 'unknown'],
+                     sorted(call[0][0] for call in get.call_args_list))
+
+    def test_one_query(self):
+        from sqlalchemy import event
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if statement.startswith('SELECT'):
+                statements.append(statement)
+        event.listen(self.model.meta.engine, 'before_cursor_execute', count)
+        self.model.Session.expire_all()
+        packages = CertificateFetcher._get_packages_from_urls(self.urls[:2])
+        assert_equal(2, len(packages))
+        assert_equal(1, len(statements))
+
+    def test_table(self):
+        from ckanext.certificates.model import init_tables, \
+            upsert_certificates
+        init_tables()
+        upsert_certificates({'id-a': {'level': 'expert'}})
+        packages = self._packages('table')
+        assert_equal(('id-a', 'expert'), (packages['/dataset/a'][0],
+                                          packages['/dataset/a'][1]['level']))
+        assert_equal(('id-b', None), packages['/dataset/b'])
+        assert_equal('expert', packages['/dataset/id-a'][1]['level'])
+        assert '/dataset/unknown' not in packages
+
+    def test_names_given(self):
+        packages = CertificateFetcher._get_packages_from_urls(
+            ['http://example.com/a-dataset'],
+            {'http://example.com/a-dataset': 'b'})
+        assert_equal('id-b', packages['http://example.com/a-dataset'][0].id)
+
+
+class TestPageRanges(object):
+    def test_split(self):
+        assert_equal([(FEED_URL + '?page=1', 3), (FEED_URL + '?page=4', 3),
+                      (FEED_URL + '?page=7', 4)],
+                     page_ranges(FEED_URL, 10, 3))
+
+    def test_more_workers_than_pages(self):
+        assert_equal([(FEED_URL + '?page=1', 1), (FEED_URL + '?page=2', 1)],
+                     page_ranges(FEED_URL, 2, 4))
+
+    def test_query_kept(self):
+        url = FEED_URL + '?from=2014-01-01T00%3A00%3A00Z&page=5'
+        [(first_url, pages)] = page_ranges(url, 1, 1)
+        assert_equal({'from': ['2014-01-01T00:00:00Z'], 'page': ['1']},
+                     urlparse.parse_qs(urlparse.urlparse(first_url).query))
+
+
+class TestMergeShardResults(object):
+    def teardown(self):
+        instrumentation.disable()
+
+    def _shard(self, entry_ids, seconds=None):
+        stats = StatsList()
+        for entry_id in entry_ids:
+            stats.add('Certificate added', entry_id)
+        timings = None
+        if seconds is not None:
+            timings = Instrumentation()
+            timings.record('badge_http', seconds)
+        return stats, entry_ids, timings
+
+    def test_merge(self):
+        timings = instrumentation.enable()
+        # the feed shifted, so 3 was at the end of one range and the start
+        # of the next
+        stats, duplicates = merge_shard_results(
+            [self._shard(['1', '2', '3'], 0.1),
+             self._shard(['3', '4'], 0.2),
+             self._shard(['5'], 0.3)])
+        assert_equal(6, stats.count('Certificate added'))
+        assert_equal(1, duplicates)
+        assert_equal(3, timings.summary()['phases']['badge_http']['count'])
+
+    def test_without_instrumentation(self):
+        stats, duplicates = merge_shard_results(
+            [self._shard(['1', '2']), self._shard(['2', '1'])])
+        assert_equal(4, stats.count('Certificate added'))
+        assert_equal(2, duplicates)
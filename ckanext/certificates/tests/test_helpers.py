@@ -1,9 +1,14 @@
 from ckanext.certificates.helpers import has_certificate, get_certificate_data
+from ckanext.certificates.helpers import get_certificate_cache, LRUCache
+from ckanext.certificates.helpers import get_certificates_for_packages
+from ckanext.certificates.tests import fake_ckan
 from nose.tools import assert_equal
 from collections import namedtuple
 import json
+import mock
 
 Package = namedtuple('Package', ['extras'])
+PackageWithId = namedtuple('PackageWithId', ['id', 'extras'])
 
 cert = {u'1': 2, u'3': u'4'}
 
@@ -28,3 +33,75 @@ class TestGetCertificateData(object):
     def test_valid_json(self):
         pkg = Package({'odi-certificate': json.dumps(cert)})
         assert_equal(cert, get_certificate_data(pkg))
+
+    def test_no_certificate(self):
+        pkg = Package({})
+        assert_equal(None, get_certificate_data(pkg))
+
+class TestCertificateCache(object):
+    def setup(self):
+        get_certificate_cache().clear()
+
+    def test_parsed_once(self):
+        pkg = PackageWithId('id1', {'odi-certificate': json.dumps(cert)})
+        has_certificate(pkg)
+        assert_equal(cert, get_certificate_data(pkg))
+        cache = get_certificate_cache()
+        assert_equal((1, 1), (cache.hits, cache.misses))
+
+    def test_changed_certificate(self):
+        pkg = PackageWithId('id1', {'odi-certificate': json.dumps(cert)})
+        get_certificate_data(pkg)
+        pkg.extras['odi-certificate'] = json.dumps({u'1': 3})
+        assert_equal({u'1': 3}, get_certificate_data(pkg))
+
+    def test_result_is_a_copy(self):
+        pkg = PackageWithId('id1', {'odi-certificate': json.dumps(cert)})
+        get_certificate_data(pkg)['1'] = 'changed'
+        assert_equal(cert, get_certificate_data(pkg))
+
+class TestLRUCache(object):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert_equal(2, len(cache))
+        assert_equal(1, cache.get('a'))
+        assert_equal(None, cache.get('b'))
+        assert_equal((2, 1), (cache.hits, cache.misses))
+
+class TestGetCertificatesForPackages(object):
+    def setup(self):
+        self.ckan = fake_ckan.installed()
+        self.ckan.__enter__()
+        for id_, private in (('id1', False), ('id2', True)):
+            fake_ckan.add_package(id_, 'dataset-' + id_, private=private,
+                                  extras={'odi-certificate': json.dumps(
+                                      dict(cert, package=id_))})
+        fake_ckan.add_package('id3', 'dataset-id3')
+
+    def teardown(self):
+        self.ckan.__exit__(None, None, None)
+
+    def test_extras(self):
+        # the private dataset is shown, as it is on its own page
+        assert_equal({'id1': dict(cert, package='id1'),
+                      'id2': dict(cert, package='id2')},
+                     get_certificates_for_packages(
+                         ['id1', {'id': 'id2'}, 'id3', 'unknown']))
+
+    def test_table(self):
+        from ckanext.certificates.model import init_tables, \
+            upsert_certificates
+        init_tables()
+        upsert_certificates({'id1': {'level': 'pilot'}})
+        with mock.patch('ckanext.certificates.helpers._use_table',
+                        return_value=True):
+            certificates = get_certificates_for_packages(['id1', 'id3'])
+        assert_equal(['id1'], certificates.keys())
+        assert_equal('pilot', certificates['id1']['level'])
+
+    def test_none(self):
+        assert_equal({}, get_certificates_for_packages([]))
@@ -0,0 +1,108 @@
+import json
+import os
+import pickle
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.certificates import instrumentation
+from ckanext.certificates.instrumentation import Instrumentation, \
+    PhaseTimings, percentile
+
+
+class TestInstrumentation(object):
+    def teardown(self):
+        instrumentation.disable()
+
+    def _instrumentation(self):
+        timings = Instrumentation()
+        for ms in range(1, 101):
+            timings.record('badge_http', ms / 1000.0)
+        timings.record('feed_http', 0.5)
+        timings.count('badge_bytes', 300)
+        timings.count('badge_bytes', 200)
+        return timings
+
+    def test_percentile(self):
+        values = range(1, 101)
+        assert_equal(50, percentile(values, 50))
+        assert_equal(95, percentile(values, 95))
+        assert_equal(100, percentile(values, 100))
+        assert_equal(7, percentile([7], 95))
+        assert_equal(None, percentile([], 50))
+
+    def test_summary(self):
+        summary = self._instrumentation().summary()
+        badge = summary['phases']['badge_http']
+        assert_equal(100, badge['count'])
+        assert_equal((0.05, 0.095, 0.1),
+                     (badge['p50'], badge['p95'], badge['max']))
+        assert_equal({'badge_bytes': 500}, summary['counters'])
+
+    def test_report_orders_phases(self):
+        lines = self._instrumentation().report().split('\n')
+        assert_equal(['feed_http', 'badge_http', 'badge_bytes'],
+                     [line.strip().split(':')[0] for line in lines])
+        assert_equal('\tbadge_http: 100 calls, total 5.050s, p50 50.0ms, '
+                     'p95 95.0ms, max 100.0ms', lines[1])
+
+    def test_report_empty(self):
+        assert_equal('\tNone', Instrumentation().report())
+
+    def test_merge_pickled(self):
+        timings = self._instrumentation()
+        timings.merge(pickle.loads(pickle.dumps(self._instrumentation())))
+        summary = timings.summary()
+        assert_equal(200, summary['phases']['badge_http']['count'])
+        assert_equal({'badge_bytes': 1000}, summary['counters'])
+
+    def test_samples_bounded(self):
+        timings = PhaseTimings(max_samples=10)
+        for ms in range(1, 1001):
+            timings.add(ms / 1000.0)
+        assert_equal(10, len(timings.samples))
+        summary = timings.summary()
+        assert_equal(1000, summary['count'])
+        assert_equal(1.0, summary['max'])
+        assert_equal(500.5, round(summary['total'], 6))
+
+    def test_merge_bounded(self):
+        timings = PhaseTimings(max_samples=10)
+        other = PhaseTimings(max_samples=10)
+        for i in range(30):
+            timings.add(1.0)
+            other.add(2.0)
+        timings.merge(other)
+        assert_equal(60, timings.count)
+        assert_equal(10, len(timings.samples))
+        assert_equal([1.0] * 5 + [2.0] * 5, sorted(timings.samples))
+
+    def test_write(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            json_path = os.path.join(tmp_dir, 'timings.json')
+            self._instrumentation().write(json_path)
+            with open(json_path) as f:
+                assert_equal(500, json.load(f)['counters']['badge_bytes'])
+
+            statsd_path = os.path.join(tmp_dir, 'timings.txt')
+            self._instrumentation().write(statsd_path)
+            with open(statsd_path) as f:
+                lines = f.read().splitlines()
+            assert 'ckanext.certificates.badge_http.p95:95.0|g' in lines
+            assert 'ckanext.certificates.badge_bytes:500|c' in lines
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_disabled_by_default(self):
+        with instrumentation.timer('feed_http'):
+            instrumentation.count('feed_requests')
+        assert_equal(None, instrumentation.active())
+
+    def test_enabled(self):
+        timings = instrumentation.enable()
+        with instrumentation.timer('feed_http'):
+            instrumentation.count('feed_requests')
+        assert_equal(1, len(timings.timings['feed_http']))
+        assert_equal({'feed_requests': 1}, timings.counters)
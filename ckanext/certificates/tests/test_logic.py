@@ -0,0 +1,60 @@
+import json
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.certificates.tests import fake_ckan
+
+cert = {'level': 'pilot', 'certificate_url': 'https://certificates.theodi.org/1'}
+
+
+class TestCertificatesForPackages(object):
+    def setup(self):
+        self.ckan = fake_ckan.installed()
+        self.ckan.__enter__()
+        import ckan.plugins.toolkit as toolkit
+        import ckanext.certificates.logic as logic
+        self.toolkit = toolkit
+        self.logic = logic
+        for id_, state, private in (('public', 'active', False),
+                                    ('private', 'active', True),
+                                    ('unreadable', 'active', True),
+                                    ('deleted', 'deleted', False)):
+            fake_ckan.add_package(id_, 'dataset-' + id_, state, private,
+                                  {'odi-certificate': json.dumps(cert)})
+
+        def check_access(action, context, data_dict):
+            if action == 'package_show' and data_dict['id'] == 'unreadable':
+                raise toolkit.NotAuthorized()
+        toolkit.check_access.side_effect = check_access
+
+    def teardown(self):
+        self.ckan.__exit__(None, None, None)
+
+    def test_readable_only(self):
+        certificates = self.logic.certificates_for_packages(
+            {}, {'ids': 'public, private,unreadable,deleted,unknown'})
+        assert_equal(['private', 'public'], sorted(certificates))
+        assert_equal(cert, certificates['public'])
+
+    def test_list_of_ids(self):
+        assert_equal(['public'], self.logic.certificates_for_packages(
+            {}, {'ids': ['public', 'deleted']}).keys())
+
+    def test_access_checked_for_private_only(self):
+        self.logic.certificates_for_packages(
+            {}, {'ids': ['public', 'private']})
+        assert_equal(['certificates_for_packages', 'package_show'],
+                     [call[0][0] for call in
+                      self.toolkit.check_access.call_args_list])
+
+    def test_invalid_ids(self):
+        for data_dict in ({}, {'ids': ''}, {'ids': {'a': 1}},
+                          {'ids': ['id'] * (self.logic.MAX_PACKAGES + 1)}):
+            assert_raises(self.toolkit.ValidationError,
+                          self.logic.certificates_for_packages, {},
+                          data_dict)
+
+    def test_anonymous_access(self):
+        auth = self.logic.certificates_for_packages_auth
+        assert auth.auth_allow_anonymous_access
+        assert_equal({'success': True}, auth({}, {}))
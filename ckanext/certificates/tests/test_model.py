@@ -0,0 +1,133 @@
+import json
+
+import mock
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.certificates.model import FIELDS, certificate_json, \
+    certificate_row, get_certificates, get_storage, init_tables, \
+    migrate_extras, row_certificate, upsert_certificates, uses_table
+from ckanext.certificates import model
+from ckanext.certificates.tests import fake_ckan
+
+cert = {'level': 'pilot', 'certification_type': 'self certified',
+        'status': 'published', 'created_at': '2014-01-01T00:00:00Z',
+        'jurisdiction': 'GB', 'title': u'Planning applications \xe9',
+        'source': 'Self-Certified by Cabinet Office (unverified)',
+        'cert_title': 'Pilot Level Certificate',
+        'badge_url': 'https://certificates.theodi.org/badge.png',
+        'certificate_url': 'https://certificates.theodi.org/1',
+        'feed_updated': '2014-01-02T00:00:00Z'}
+
+
+class TestStorage(object):
+    def test_default(self):
+        assert_equal('extras', get_storage({}))
+        assert not uses_table({})
+
+    def test_table(self):
+        config = {'ckanext.certificates.storage': 'table'}
+        assert uses_table(config)
+
+    def test_both(self):
+        config = {'ckanext.certificates.storage': 'both'}
+        assert uses_table(config)
+
+    def test_invalid(self):
+        assert_raises(ValueError, get_storage,
+                      {'ckanext.certificates.storage': 'revisions'})
+
+
+class TestRows(object):
+    def test_round_trip(self):
+        row = certificate_row('id1', cert)
+        assert_equal('id1', row['package_id'])
+        assert_equal(cert, row_certificate(row))
+
+    def test_missing_fields(self):
+        # e.g. a certificate stored before feed_updated was added
+        row = certificate_row('id1', {'level': 'pilot'})
+        assert_equal(set(FIELDS) | set(['package_id']), set(row))
+        assert_equal(None, row['feed_updated'])
+
+    def test_certificate_json(self):
+        assert_equal(json.loads(certificate_json(cert)), cert)
+        assert_equal(certificate_json(cert), certificate_json(dict(cert)))
+
+
+class RacingSession(object):
+    '''A session whose first query, for the rows that exist already,
+    doesn't see the ones given, as if another process inserted them just
+    after it.'''
+    def __init__(self, session, hidden):
+        self._session = session
+        self._hidden = hidden
+
+    def execute(self, statement, *args, **kwargs):
+        result = self._session.execute(statement, *args, **kwargs)
+        if self._hidden is not None:
+            rows = [row for row in result if row[0] not in self._hidden]
+            self._hidden = None
+            return rows
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+class TestTable(object):
+    def setup(self):
+        self.ckan = fake_ckan.installed()
+        self.model = self.ckan.__enter__()
+        for i in range(1, 4):
+            fake_ckan.add_package('id%d' % i, 'dataset-%d' % i)
+        init_tables()
+
+    def teardown(self):
+        self.ckan.__exit__(None, None, None)
+
+    def _levels(self):
+        return dict((package_id, certificate['level']) for
+                    package_id, certificate in
+                    get_certificates(['id1', 'id2', 'id3']).items())
+
+    def test_upsert(self):
+        upsert_certificates({'id1': dict(cert, level='pilot')})
+        self.model.Session.commit()
+        # one update and one insert
+        upsert_certificates({'id1': dict(cert, level='expert'),
+                             'id2': dict(cert, level='standard')})
+        self.model.Session.commit()
+        assert_equal({'id1': 'expert', 'id2': 'standard'}, self._levels())
+        assert_equal(cert['title'], get_certificates(['id1'])['id1']['title'])
+
+    def test_upsert_racing_insert(self):
+        upsert_certificates({'id3': dict(cert, level='pilot')})
+        upsert_certificates({'id1': dict(cert, level='pilot')})
+        self.model.Session.commit()
+        session = RacingSession(self.model.Session, set(['id1']))
+        # the insert of both fails, so each is retried, id1 as an update
+        with mock.patch('ckanext.certificates.model._insert',
+                        wraps=model._insert) as insert:
+            upsert_certificates({'id1': dict(cert, level='expert'),
+                                 'id2': dict(cert, level='standard')},
+                                session)
+        assert_equal([2, 1, 1], [len(call[0][2]) if isinstance(
+            call[0][2], list) else 1 for call in insert.call_args_list])
+        # the rest of the transaction carries on
+        upsert_certificates({'id3': dict(cert, level='expert')})
+        self.model.Session.commit()
+        assert_equal({'id1': 'expert', 'id2': 'standard', 'id3': 'expert'},
+                     self._levels())
+
+    def test_migrate_extras(self):
+        for pkg, value in zip(self.model.Session.query(self.model.Package)
+                              .order_by(self.model.Package.id),
+                              (json.dumps(dict(cert, level='expert')),
+                               'INVALID', json.dumps(cert))):
+            pkg.extras['odi-certificate'] = value
+        self.model.Session.commit()
+        # replaced by the one in the extras
+        upsert_certificates({'id1': dict(cert, level='standard')})
+        self.model.Session.commit()
+        assert_equal((2, 1), migrate_extras(batch_size=1))
+        assert_equal({'id1': 'expert', 'id3': 'pilot'}, self._levels())
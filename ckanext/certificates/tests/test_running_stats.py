@@ -0,0 +1,100 @@
+import pickle
+
+from nose.tools import assert_equal
+
+from ckanext.certificates.running_stats import StatsCount, StatsList
+
+
+class TestMerge(object):
+    def test_count(self):
+        stats = StatsCount()
+        stats.increment('a')
+        other = StatsCount()
+        other.increment('a')
+        other.increment('b')
+        stats.merge(other)
+        assert_equal({'a': 2, 'b': 1}, stats)
+
+    def test_list(self):
+        stats = StatsList()
+        stats.add('a', 'x')
+        other = StatsList()
+        other.add('a', 'y')
+        other.add('b', 'z')
+        stats.merge(other)
+        assert_equal({'a': ['x', 'y'], 'b': ['z']}, stats)
+        assert_equal(['y'], other['a'])
+
+    def test_list_bounded(self):
+        stats = StatsList(max_values=2)
+        for value in 'uvw':
+            stats.add('a', value)
+        other = StatsList(max_values=2)
+        other.add('a', 'x')
+        stats.merge(other)
+        assert_equal(['u', 'v'], stats['a'])
+        assert_equal(4, stats.count('a'))
+
+
+class TestBounded(object):
+    def test_first(self):
+        stats = StatsList(max_values=3)
+        for i in range(1000):
+            stats.add('a', i)
+        assert_equal([0, 1, 2], stats['a'])
+        assert_equal(1000, stats.count('a'))
+        assert_equal(0, stats.count('b'))
+
+    def test_reservoir(self):
+        stats = StatsList(max_values=10, sampling='reservoir')
+        for i in range(1000):
+            stats.add('a', i)
+        assert_equal(10, len(set(stats['a'])))
+        assert_equal(1000, stats.count('a'))
+        # a sample of them all, not just the first
+        assert max(stats['a']) >= 10
+
+    def test_report_shape(self):
+        unbounded = StatsList()
+        bounded = StatsList(max_values=20)
+        short = StatsList(max_values=5)
+        for stats in (unbounded, bounded, short):
+            for i in range(100):
+                stats.add('Certificate unchanged', 'http://x/%s' % i)
+            stats.add('Certificate added', 'http://y')
+        assert_equal(unbounded.report(), bounded.report())
+        assert_equal("\tCertificate unchanged: 100 ['http://x/0', "
+                     "'http://x/1', 'http://x/2', 'http://x/3', "
+                     "'http://x/4'...\n"
+                     "\tCertificate added: 1 ['http://y']", short.report())
+
+    def test_pickle(self):
+        stats = StatsList(max_values=2, sampling='reservoir')
+        for i in range(5):
+            stats.add('a', '%s-%s', 'x', i)
+        copied = pickle.loads(pickle.dumps(stats, 2))
+        assert_equal(5, copied.count('a'))
+        assert_equal(2, copied.max_values)
+        assert_equal('reservoir', copied.sampling)
+        assert_equal(stats['a'], copied['a'])
+
+
+class TestLazyMessage(object):
+    def test_lazy(self):
+        formatted = []
+
+        class Value(object):
+            def __str__(self):
+                formatted.append(True)
+                return 'value'
+        stats = StatsList(max_values=1)
+        message = stats.add('a', '%s', Value())
+        stats.add('a', '%s', Value())
+        assert_equal([], formatted)
+        assert_equal('a: value', str(message))
+        assert_equal("\ta: 2 ['value'...", stats.report())
+
+    def test_unicode(self):
+        message = StatsList().add('a', '%s', u'caf\xe9')
+        assert_equal(u'a: caf\xe9', unicode(message))
+        assert_equal('a: caf\xc3\xa9', str(message))
@@ -0,0 +1,34 @@
+import json
+
+from nose.tools import assert_equal
+
+from ckanext.certificates.search import index_fields, certificate_hash
+
+cert = {'level': 'pilot', 'certification_type': 'self certified',
+        'status': 'published', 'created_at': '2014-01-01T00:00:00Z',
+        'title': 'Planning applications'}
+
+
+class TestIndexFields(object):
+    def test_fields(self):
+        cert_json = json.dumps(cert)
+        assert_equal({'certificate_level': 'pilot',
+                      'certificate_type': 'self certified',
+                      'certificate_status': 'published',
+                      'certificate_created_at': '2014-01-01T00:00:00Z',
+                      'certificate_hash': certificate_hash(cert_json)},
+                     index_fields(cert_json))
+
+    def test_missing_values(self):
+        fields = index_fields(json.dumps({'level': 'raw', 'status': ''}))
+        assert_equal(['certificate_hash', 'certificate_level'], sorted(fields))
+
+    def test_no_certificate(self):
+        assert_equal({}, index_fields(None))
+        assert_equal({}, index_fields('INVALID'))
+        assert_equal({}, index_fields('[]'))
+
+    def test_hash_changes(self):
+        assert certificate_hash(json.dumps(cert)) != \
+            certificate_hash(json.dumps(dict(cert, level='standard')))
+        assert_equal(certificate_hash('{}'), certificate_hash(u'{}'))
@@ -0,0 +1,113 @@
+import pickle
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.certificates.site_url import SiteUrlMatcher, \
+    RegexSiteUrlMatcher, get_site_url_matcher, package_name_from_url
+
+
+class TestSiteUrlMatcher:
+    def setup(self):
+        self.matcher = SiteUrlMatcher(['http://data.gov.uk',
+                                       'https://mirror.example.org/catalogue/',
+                                       'https://mirror.example.org'])
+
+    def test_dataset(self):
+        assert_equal('a', self.matcher.match('http://data.gov.uk/dataset/a'))
+        assert_equal('a', self.matcher.match('http://data.gov.uk/dataset/a/'))
+        assert_equal('gbc_planning_applications', self.matcher.match(
+            'http://data.gov.uk/dataset/gbc_planning_applications?x=1#y'))
+
+    def test_scheme_and_www(self):
+        for url in ('https://data.gov.uk/dataset/a',
+                    'http://www.data.gov.uk/dataset/a',
+                    'HTTPS://WWW.Data.Gov.UK/dataset/a'):
+            assert_equal('a', self.matcher.match(url))
+
+    def test_path_prefix(self):
+        assert_equal('b', self.matcher.match(
+            'http://mirror.example.org/catalogue/dataset/b'))
+        assert_equal('c', self.matcher.match(
+            'http://mirror.example.org/dataset/c'))
+        assert_equal('', self.matcher.match(
+            'http://mirror.example.org/catalogue/publisher/d'))
+
+    def test_not_a_dataset(self):
+        assert_equal('', self.matcher.match('http://data.gov.uk/publisher/a'))
+        assert_equal('', self.matcher.match('http://data.gov.uk/dataset/'))
+        assert_equal('', self.matcher.match('http://data.gov.uk'))
+
+    def test_other_site(self):
+        for url in ('http://other_site/dataset/a',
+                    'http://data.gov.uk.example.com/dataset/a',
+                    ' http://data.gov.uk/dataset/a',
+                    'ftp://data.gov.uk/dataset/a',
+                    'data.gov.uk/dataset/a',
+                    ''):
+            assert_equal(None, self.matcher.match(url))
+
+    def test_port(self):
+        matcher = SiteUrlMatcher(['http://localhost:5000'])
+        assert_equal('a', matcher.match('http://localhost:5000/dataset/a'))
+        assert_equal(None, matcher.match('http://localhost/dataset/a'))
+
+    def test_invalid_site_url(self):
+        assert_raises(ValueError, SiteUrlMatcher, ['data.gov.uk'])
+
+    def test_pickle(self):
+        matcher = pickle.loads(pickle.dumps(self.matcher))
+        assert_equal('a', matcher.match('http://data.gov.uk/dataset/a'))
+
+
+class TestRegexSiteUrlMatcher:
+    def test_match(self):
+        matcher = RegexSiteUrlMatcher('https?://(catalog\.)?data\.gov')
+        assert_equal('a', matcher.match(
+            'http://catalog.data.gov/dataset/a'))
+        assert_equal('', matcher.match('http://data.gov/publisher/a'))
+        assert_equal(None, matcher.match('http://other_site/dataset/a'))
+        # it can match anywhere in the URL
+        assert_equal('a', matcher.match(' http://catalog.data.gov/dataset/a'))
+
+
+class TestGetSiteUrlMatcher:
+    def test_regex(self):
+        matcher = get_site_url_matcher({
+            'ckanext.certificates.site_url_regex': 'http://data.gov.uk',
+            'ckanext.certificates.site_urls': 'http://other'})
+        assert isinstance(matcher, RegexSiteUrlMatcher)
+
+    def test_site_urls(self):
+        matcher = get_site_url_matcher({
+            'ckanext.certificates.site_urls':
+            'http://data.gov.uk\n http://old.data.gov.uk/catalogue',
+            'ckan.site_url': 'http://localhost:5000'})
+        assert_equal(['http://data.gov.uk', 'http://old.data.gov.uk/catalogue'],
+                     matcher.site_urls)
+
+    def test_site_url(self):
+        matcher = get_site_url_matcher({
+            'ckanext.certificates.site_url': 'http://data.gov.uk',
+            'ckan.site_url': 'http://localhost:5000'})
+        assert_equal(['http://data.gov.uk'], matcher.site_urls)
+        matcher = get_site_url_matcher({'ckan.site_url':
+                                        'http://localhost:5000'})
+        assert_equal(['http://localhost:5000'], matcher.site_urls)
+
+    def test_site_url_variations(self):
+        matcher = get_site_url_matcher({
+            'ckanext.certificates.site_url': 'https://www.data.gov.uk'})
+        for url in ('http://data.gov.uk/dataset/a',
+                    'http://www.data.gov.uk/dataset/a',
+                    'https://data.gov.uk/dataset/a'):
+            assert_equal('a', matcher.match(url))
+
+
+class TestPackageNameFromUrl:
+    def test_simple(self):
+        url = 'http://data.gov.uk/dataset/gbc_planning_applications'
+        assert_equal('gbc_planning_applications', package_name_from_url(url))
+
+    def test_trailing_slash(self):
+        url = 'http://data.gov.uk/dataset/gbc_planning_applications/'
+        assert_equal('gbc_planning_applications', package_name_from_url(url))
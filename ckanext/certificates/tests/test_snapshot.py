@@ -0,0 +1,98 @@
+import gzip
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.certificates.snapshot import SnapshotReader, SnapshotWriter
+
+
+def _entry(i):
+    return {'id': 'https://certificates.theodi.org/datasets/%d' % i,
+            'about': 'http://data.gov.uk/dataset/d%d' % i,
+            'alternate': 'https://certificates.theodi.org/c/%d.json' % i,
+            'updated': '2014-01-01T00:00:00Z'}
+
+
+def _badge(i):
+    return {'level': 'pilot', 'title': u'Dataset \xe9 %d' % i}
+
+
+class TestSnapshot(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'snapshot.jsonl.gz')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _record(self, batches, batch_size=2, failed=()):
+        writer = SnapshotWriter(self.path)
+        entries = writer.record_entries(_entry(i) for i in range(batches *
+                                                                 batch_size))
+        for batch in range(batches):
+            urls = [entries.next()['alternate'] for i in range(batch_size)]
+            start = batch * batch_size
+            writer.record_badges(urls, [
+                None if i in failed else _badge(i)
+                for i in range(start, start + batch_size)])
+        writer.close()
+
+    def test_replay(self):
+        self._record(3, failed=[3])
+        reader = SnapshotReader(self.path)
+        entries = list(reader.entries())
+        assert_equal([_entry(i) for i in range(6)], entries)
+        assert_equal([_badge(0), _badge(4), None, _badge(5)],
+                     reader.fetch([entries[i]['alternate']
+                                   for i in (0, 4, 3, 5)]))
+        reader.close()
+
+    def test_interleaved(self):
+        # as fetch uses it: a batch of entries, then their badges
+        self._record(3)
+        reader = SnapshotReader(self.path)
+        entries = reader.entries()
+        for batch in range(3):
+            urls = [entries.next()['alternate'] for i in range(2)]
+            assert_equal([_badge(batch * 2), _badge(batch * 2 + 1)],
+                         reader.fetch(urls))
+        assert_equal([], list(entries))
+
+    def test_badges_ahead_of_entries(self):
+        self._record(3)
+        reader = SnapshotReader(self.path)
+        assert_equal([_badge(5)], reader.fetch([_entry(5)['alternate']]))
+        assert_equal(6, len(list(reader.entries())))
+
+    def test_lookahead(self):
+        self._record(3)
+        reader = SnapshotReader(self.path, lookahead=2)
+        assert_equal([None], reader.fetch([_entry(5)['alternate']]))
+        assert_equal(6, len(list(reader.entries())))
+
+    def test_unfetched_badges_bounded(self):
+        # e.g. replaying with certificates already stored, whose badges
+        # are never fetched
+        self._record(10)
+        reader = SnapshotReader(self.path, lookahead=4)
+        assert_equal(20, len(list(reader.entries())))
+        assert_equal(4, len(reader._badges))
+        assert_equal([_badge(19)], reader.fetch([_entry(19)['alternate']]))
+
+    def test_append(self):
+        self._record(1)
+        writer = SnapshotWriter(self.path)
+        list(writer.record_entries([_entry(9)]))
+        writer.close()
+        ids = [entry['id'] for entry in SnapshotReader(self.path).entries()]
+        assert_equal([_entry(0)['id'], _entry(1)['id'], _entry(9)['id']],
+                     ids)
+
+    def test_format(self):
+        self._record(1)
+        lines = gzip.open(self.path).read().splitlines()
+        assert_equal(4, len(lines))
+        assert lines[0].startswith('["entry",{')
+        assert lines[2].startswith('["badge","https://')
@@ -20,13 +20,17 @@ setup(
 	include_package_data=True,
 	zip_safe=False,
 	install_requires=[
-	    "requests>=1.1.0",
+	    "requests>=2.12.0",
 	    "lxml"
 	],
+	extras_require={
+	    'async': ['gevent'],
+	},
 	entry_points=\
 	"""
     [paste.paster_command]
     fetch_certs = ckanext.certificates.commands:CertificateCommand
+    certificates = ckanext.certificates.commands:CertificateAdminCommand
 
     [ckan.plugins]
 	certificates=ckanext.certificates.plugin:CertificatesPlugin